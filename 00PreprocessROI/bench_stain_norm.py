@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+import os, sys
+import argparse, time
+import numpy as np
+import pandas as pd
+import cv2
+
+from stain_utils import MacenkoNormalizer, ReinhardNormalizer, VahadaneNormalizer
+from stain_utils import MACENKO_REF_STAINS, MACENKO_REF_MAX_CONC
+
+
+def set_args():
+    parser = argparse.ArgumentParser(description = "Benchmark Stain Normalizers on Synthetic H&E Tiles")
+    parser.add_argument("--tile_num",         type=int,       default=64)
+    parser.add_argument("--tile_size",        type=int,       default=512)
+    parser.add_argument("--batch_size",       type=int,       default=16)
+    parser.add_argument("--rand_seed",        type=int,       default=1234)
+
+    args = parser.parse_args()
+    return args
+
+
+def synthesize_tiles(tile_num, tile_size, rng, io_max=240):
+    # Beer-Lambert rendering of smooth H&E concentration fields with per-tile stain drift
+    tiles, truths = [], []
+    for _ in range(tile_num):
+        conc = rng.rand(tile_size, tile_size, 2).astype(np.float32)
+        conc = cv2.GaussianBlur(conc, (0, 0), sigmaX=4)
+        conc = np.maximum(conc - np.percentile(conc, 30, axis=(0, 1)), 0)
+        conc = (conc / np.percentile(conc, 99, axis=(0, 1))).reshape(-1, 2).astype(np.float64)
+        stains = MACENKO_REF_STAINS + rng.normal(0, 0.08, MACENKO_REF_STAINS.shape)
+        stains = np.abs(stains) / np.linalg.norm(stains, axis=0)
+        src_conc = conc * rng.uniform(0.6, 1.6, 2)
+        tile = np.clip(io_max * np.exp(-src_conc.dot(stains.T)), 0, 255).astype(np.uint8)
+        truth = np.clip(io_max * np.exp(-(conc * MACENKO_REF_MAX_CONC).dot(MACENKO_REF_STAINS.T)), 0, 255).astype(np.uint8)
+        tiles.append(tile.reshape(tile_size, tile_size, 3))
+        truths.append(truth.reshape(tile_size, tile_size, 3))
+
+    return np.stack(tiles), np.stack(truths)
+
+
+def time_normalizer(process, tiles, batch_size=None):
+    start = time.time()
+    if batch_size is None:
+        outputs = [process(tile) for tile in tiles]
+    else:
+        outputs = [process(tiles[ind:ind+batch_size]) for ind in range(0, len(tiles), batch_size)]
+    outputs = np.concatenate([np.asarray(ele).reshape(-1, *tiles.shape[1:]) for ele in outputs])
+    return time.time() - start, outputs
+
+
+if __name__ == "__main__":
+    args = set_args()
+    rng = np.random.RandomState(args.rand_seed)
+    tiles, truths = synthesize_tiles(args.tile_num, args.tile_size, rng)
+    print("Synthesized {} tiles of size {}".format(len(tiles), args.tile_size))
+
+    normalizers = {
+        "macenko": MacenkoNormalizer(),
+        "vahadane": VahadaneNormalizer(),
+        "reinhard": ReinhardNormalizer().fit(truths[0]),
+    }
+    results = {}
+    for name, normalizer in normalizers.items():
+        results[name] = time_normalizer(normalizer.process, tiles)
+        results[name + "-batch"] = time_normalizer(normalizer.process_batch, tiles, args.batch_size)
+    # reference implementation, when installed
+    try:
+        start = time.time()
+        from histocartography.preprocessing import MacenkoStainNormalizer
+        print("Import histocartography took {:.2f}s".format(time.time() - start))
+        results["histocartography"] = time_normalizer(MacenkoStainNormalizer().process, tiles)
+    except ImportError:
+        print("histocartography not installed, skip comparison")
+
+    bench_rows = []
+    for name, (elapsed, outputs) in results.items():
+        row = [name, len(tiles) / elapsed, np.mean(np.abs(outputs.astype(np.float64) - truths))]
+        if "histocartography" in results:
+            row.append(np.mean(np.abs(outputs.astype(np.float64) - results["histocartography"][1])))
+        bench_rows.append(row)
+    bench_cols = ["Normalizer", "Tiles/s", "MAE-Truth"]
+    if "histocartography" in results:
+        bench_cols.append("MAE-Histocartography")
+    bench_df = pd.DataFrame(bench_rows, columns=bench_cols)
+    print(bench_df.to_string(index=False, float_format="{:.3f}".format))
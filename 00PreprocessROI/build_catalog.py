@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+
+import os, sys
+import argparse, time
+
+from catalog_utils import build_catalog, load_lesions
+
+
+def set_args():
+    parser = argparse.ArgumentParser(description = "Build Cohort Catalog of Lesions and Derived Files")
+    parser.add_argument("--data_root",        type=str,       default="/Data")
+    parser.add_argument("--slide_roi_dir",    type=str,       default="SlidesROIs")
+    parser.add_argument("--catalog_name",     type=str,       default="Catalog.db")
+    parser.add_argument("--datasets",         type=str,       nargs="+", default=["Japan", "USA", "China"])
+
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    args = set_args()
+
+    slide_roi_root = os.path.join(args.data_root, args.slide_roi_dir)
+    catalog_path = os.path.join(slide_roi_root, args.catalog_name)
+    start = time.time()
+    build_catalog(catalog_path, slide_roi_root, args.datasets)
+    lesion_df = load_lesions(catalog_path)
+    print("Catalog {} holds {} lesions, built in {:.2f}s".format(catalog_path, len(lesion_df), time.time() - start))
+    print(lesion_df.groupby(["dataset", "stage"]).size())
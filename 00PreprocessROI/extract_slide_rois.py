@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+import os, sys
+import argparse
+import multiprocessing
+import numpy as np
+import pandas as pd
+import tifffile
+
+from annotate_utils import index_imagescope_dir, rect_boxes
+from slide_utils import format_roi_name, get_slide_page, read_tiff_region
+from tile_utils import write_png
+
+
+def set_args():
+    parser = argparse.ArgumentParser(description = "Crop Annotated ROIs from Whole-Slide Pyramids")
+    parser.add_argument("--data_root",        type=str,       default="/Data")
+    parser.add_argument("--lesion_dir",       type=str,       default="SlidesROIs")
+    parser.add_argument("--slide_dir",        type=str,       default="Slides")
+    parser.add_argument("--anno_dir",         type=str,       default="SlideAnnotations")
+    parser.add_argument("--block_dir",        type=str,       default="RegionROIs")
+    parser.add_argument("--dataset",          type=str,       default="Japan", choices=["Japan", "USA", "China"])
+    parser.add_argument("--slide_exts",       type=str,       nargs="+", default=[".tiff", ".tif", ".svs"])
+    parser.add_argument("--level",            type=int,       default=0, help="pyramid level to crop from")
+    parser.add_argument("--workers",          type=int,       default=8)
+
+    args = parser.parse_args()
+    return args
+
+
+# slides stay open within a worker process
+slide_cache = {}
+
+def crop_roi(task):
+    slide_path, level, level_box, roi_path = task
+    if slide_path not in slide_cache:
+        slide_cache[slide_path] = tifffile.TiffFile(slide_path)
+    page, _ = get_slide_page(slide_cache[slide_path], level)
+    w_start, h_start, w_len, h_len = level_box
+    roi_img = read_tiff_region(page, h_start, w_start, h_len, w_len)[..., :3]
+    # write then rename so that interrupted runs can be resumed, a leftover .part is never taken for a ROI
+    roi_dir, roi_name = os.path.split(roi_path)
+    tmp_path = os.path.join(roi_dir, ".tmp-{}-{}.part".format(os.getpid(), roi_name))
+    try:
+        write_png(tmp_path, roi_img)
+        os.replace(tmp_path, roi_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return roi_name
+
+
+if __name__ == "__main__":
+    args = set_args()
+
+    lesion_root_dir = os.path.join(args.data_root, args.lesion_dir, args.dataset)
+    slide_dir = os.path.join(lesion_root_dir, args.slide_dir)
+    anno_dir = os.path.join(lesion_root_dir, args.anno_dir)
+    roi_img_root = os.path.join(lesion_root_dir, args.block_dir)
+    if not os.path.exists(roi_img_root):
+        os.makedirs(roi_img_root)
+
+    # annotations from the cached index
+    index_path = os.path.join(lesion_root_dir, "{}AnnotationIndex.npz".format(args.dataset))
+    slide_annos = index_imagescope_dir(anno_dir, index_path, workers=args.workers)
+    slide_paths = {}
+    for ele in os.listdir(slide_dir):
+        slide_name, slide_ext = os.path.splitext(ele)
+        if slide_ext in args.slide_exts:
+            slide_paths[slide_name] = os.path.join(slide_dir, ele)
+
+    # one task per rectangle, grouped by slide so workers reuse opened slides
+    task_list, level_rows = [], []
+    for slide_name in sorted(slide_annos.keys()):
+        if slide_name not in slide_paths:
+            print("{} has annotations but no slide".format(slide_name))
+            continue
+        # annotations are in level 0 coordinates, names keep the level 0 corner
+        # and the Wlen/Hlen of the cropped level, so that they always match the png size
+        with tifffile.TiffFile(slide_paths[slide_name]) as tif:
+            _, downsample = get_slide_page(tif, args.level)
+        for anno_name, polygons in slide_annos[slide_name].items():
+            for roi_box in rect_boxes(polygons).tolist():
+                level_box = [int(round(ele / downsample)) for ele in roi_box]
+                roi_name = format_roi_name(slide_name, roi_box[0], roi_box[1], level_box[2], level_box[3], level=args.level)
+                if args.level > 0:
+                    level_rows.append((roi_name, args.level, downsample))
+                roi_path = os.path.join(roi_img_root, roi_name + ".png")
+                if not os.path.exists(roi_path):
+                    task_list.append((slide_paths[slide_name], args.level, level_box, roi_path))
+    print("{} ROIs to crop".format(len(task_list)))
+    # downsampling of lower level crops, ROI pixels times Downsample plus Wstart/Hstart give level 0 coordinates
+    if len(level_rows) > 0:
+        level_path = os.path.join(lesion_root_dir, "{}ROILevels.csv".format(args.dataset))
+        level_df = pd.DataFrame(level_rows, columns=["ROI", "Level", "Downsample"])
+        if os.path.exists(level_path):
+            level_df = pd.concat([pd.read_csv(level_path), level_df]).drop_duplicates("ROI", keep="last")
+        level_df.sort_values("ROI").to_csv(level_path, index=False)
+
+    with multiprocessing.Pool(args.workers) as pool:
+        for ind, roi_name in enumerate(pool.imap_unordered(crop_roi, task_list)):
+            print("Crop {}/{} {}".format(ind+1, len(task_list), roi_name))
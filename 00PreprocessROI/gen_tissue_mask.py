@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+import os, sys
+import argparse
+import multiprocessing
+import numpy as np
+import pandas as pd
+from skimage import io
+import cv2
+
+from tile_utils import read_png_size, read_png_thumbnail, tissue_mask
+
+
+def set_args():
+    parser = argparse.ArgumentParser(description = "Segment Tissue on Downsampled ROIs")
+    parser.add_argument("--data_root",        type=str,       default="/Data")
+    parser.add_argument("--lesion_dir",       type=str,       default="SlidesROIs")
+    parser.add_argument("--block_dir",        type=str,       default="RegionROIs")
+    parser.add_argument("--tissue_dir",       type=str,       default="TissueMasks")
+    parser.add_argument("--dataset",          type=str,       default="Japan", choices=["Japan", "USA", "China"])
+    parser.add_argument("--downsample",       type=int,       default=16)
+    parser.add_argument("--workers",          type=int,       default=8)
+
+    args = parser.parse_args()
+    return args
+
+
+def segment_tissue(task):
+    roi_img_path, mask_path, downsample = task
+    width, height = read_png_size(roi_img_path)
+    mask = tissue_mask(read_png_thumbnail(roi_img_path, downsample))
+    # close small gaps between nuclei and stroma
+    mask = cv2.morphologyEx(mask.astype(np.uint8), cv2.MORPH_CLOSE, np.ones((5, 5), np.uint8))
+    io.imsave(mask_path, mask * 255, check_contrast=False)
+    tissue_fraction = np.mean(mask)
+    return [width, height, downsample, tissue_fraction * width * height, tissue_fraction]
+
+
+if __name__ == "__main__":
+    args = set_args()
+
+    lesion_root_dir = os.path.join(args.data_root, args.lesion_dir, args.dataset)
+    roi_img_root = os.path.join(lesion_root_dir, args.block_dir)
+    tissue_root = os.path.join(lesion_root_dir, args.tissue_dir)
+    if not os.path.exists(tissue_root):
+        os.makedirs(tissue_root)
+    roi_list = sorted([os.path.splitext(ele)[0] for ele in os.listdir(roi_img_root) if ele.endswith(".png")])
+
+    task_list = [(os.path.join(roi_img_root, ele + ".png"), os.path.join(tissue_root, ele + ".png"), args.downsample) for ele in roi_list]
+    tissue_list = []
+    with multiprocessing.Pool(args.workers) as pool:
+        for ind, tissue_vals in enumerate(pool.imap(segment_tissue, task_list, chunksize=4)):
+            if (ind + 1) % 100 == 0:
+                print("Segment tissue {}/{}".format(ind+1, len(roi_list)))
+            tissue_list.append(tissue_vals)
+
+    # tissue area in full resolution pixels
+    tissue_df = pd.DataFrame(tissue_list, columns=["Width", "Height", "Downsample", "TissueArea", "TissueFraction"])
+    tissue_df.insert(0, "ROI", roi_list)
+    tissue_area_path = os.path.join(lesion_root_dir, "{}TissueAreas.csv".format(args.dataset))
+    tissue_df.to_csv(tissue_area_path, index=False)
+    print("Mean tissue fraction of {} ROIs: {:.3f}".format(len(tissue_df), tissue_df["TissueFraction"].mean()))
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+import os, sys
+import argparse, time
+import numpy as np
+
+from annotate_utils import index_imagescope_dir, rect_boxes
+
+
+def set_args():
+    parser = argparse.ArgumentParser(description = "Index ImageScope Lesion Annotations")
+    parser.add_argument("--data_root",        type=str,       default="/Data")
+    parser.add_argument("--lesion_dir",       type=str,       default="SlidesROIs")
+    parser.add_argument("--anno_dir",         type=str,       default="SlideAnnotations")
+    parser.add_argument("--dataset",          type=str,       default="Japan", choices=["Japan", "USA", "China"])
+    parser.add_argument("--workers",          type=int,       default=8)
+
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    args = set_args()
+
+    lesion_root_dir = os.path.join(args.data_root, args.lesion_dir, args.dataset)
+    anno_dir = os.path.join(lesion_root_dir, args.anno_dir)
+    if not os.path.exists(anno_dir):
+        sys.exit("Annotations of {} not exist".format(args.dataset))
+    index_path = os.path.join(lesion_root_dir, "{}AnnotationIndex.npz".format(args.dataset))
+
+    start = time.time()
+    slide_annos = index_imagescope_dir(anno_dir, index_path, workers=args.workers)
+    region_num = sum([len(polys) for anno_dict in slide_annos.values() for polys in anno_dict.values()])
+    roi_num = sum([len(rect_boxes(polys)) for anno_dict in slide_annos.values() for polys in anno_dict.values()])
+    print("Index {} slides with {} regions ({} rectangular ROIs) in {:.2f}s".format(
+        len(slide_annos), region_num, roi_num, time.time() - start))
@@ -1,10 +1,16 @@
 # -*- coding: utf-8 -*-
 
 import os, sys
-import argparse, shutil
+import argparse, shutil, functools, hashlib, json
+import multiprocessing
 import numpy as np
 from skimage import io
-from histocartography.preprocessing import MacenkoStainNormalizer
+
+from stain_utils import MacenkoNormalizer, ReinhardNormalizer, VahadaneNormalizer
+from stain_utils import estimate_cohort_stains, save_stain_ref, load_stain_ref, normalize_stains
+from stain_utils import MACENKO_REF_STAINS, MACENKO_REF_MAX_CONC
+from tile_utils import read_png_size, iter_png_strips, read_png_thumbnail, write_png, PNGStripWriter
+from qc_utils import filter_qc_rois
 
 
 def set_args():
@@ -12,13 +18,130 @@ def set_args():
     parser.add_argument("--data_root",        type=str,       default="/Data")
     parser.add_argument("--lesion_dir",       type=str,       default="SlidesROIs")
     parser.add_argument("--block_dir",        type=str,       default="RegionROIs")
-    parser.add_argument("--norm_dir",         type=str,       default="MacenkoROIs")    
-    parser.add_argument("--dataset",          type=str,       default="Japan", choices=["Japan", "USA", "China"])    
+    parser.add_argument("--norm_dir",         type=str,       default="MacenkoROIs")
+    parser.add_argument("--dataset",          type=str,       default="Japan", choices=["Japan", "USA", "China"])
+    parser.add_argument("--workers",          type=int,       default=1)
+    parser.add_argument("--overwrite",        action="store_true", help="remove previous results instead of resuming")
+    parser.add_argument("--normalizer",       type=str,       default="histocartography", choices=["histocartography", "macenko", "reinhard", "vahadane"])
+    parser.add_argument("--target_img",       type=str,       default="", help="target image of reinhard normalizer")
+    parser.add_argument("--stain_mode",       type=str,       default="roi", choices=["roi", "cohort"])
+    parser.add_argument("--stain_ref_dir",    type=str,       default="StainRefs")
+    parser.add_argument("--target_ref",       type=str,       default="", help="cohort whose stain matrix is the target, default Macenko reference")
+    parser.add_argument("--estimate_ref",     action="store_true", help="re-estimate the cohort stain matrix")
+    parser.add_argument("--ref_roi_num",      type=int,       default=64)
+    parser.add_argument("--ref_pixel_num",    type=int,       default=20000)
+    parser.add_argument("--rand_seed",        type=int,       default=1234)
+    parser.add_argument("--tile_size",        type=int,       default=1024)
+    parser.add_argument("--tile_pixels",      type=int,       default=64000000, help="ROIs larger than this are normalized tile by tile")
+    parser.add_argument("--sample_factor",    type=int,       default=8, help="downsampling of the ROI used for tiled stain statistics")
 
     args = parser.parse_args()
     return args
 
 
+# one normalizer per worker process
+normalizer = None
+cached_params = None
+tile_params = None
+
+def init_worker(stain_params=None, tile_args=None, norm_args=None):
+    global normalizer, cached_params, tile_params
+    cached_params, tile_params = stain_params, tile_args
+    norm_args = {"normalizer": "histocartography"} if norm_args is None else norm_args
+    if stain_params is not None:
+        normalizer = functools.partial(normalize_stains, **stain_params)
+    elif norm_args["normalizer"] == "macenko":
+        normalizer = MacenkoNormalizer().process
+    elif norm_args["normalizer"] == "vahadane":
+        normalizer = VahadaneNormalizer().process
+    elif norm_args["normalizer"] == "reinhard":
+        normalizer = ReinhardNormalizer().fit(io.imread(norm_args["target_img"])).process
+    else:
+        # heavy dependency, only imported when asked for
+        from histocartography.preprocessing import MacenkoStainNormalizer
+        normalizer = MacenkoStainNormalizer().process
+
+
+def norm_param_hash(args, stain_params):
+    # everything that changes the normalized pixels, outputs made with other parameters are redone
+    norm_params = {"stain_mode": args.stain_mode, "tile_size": args.tile_size, "tile_pixels": args.tile_pixels,
+                   "sample_factor": args.sample_factor}
+    if stain_params is None:
+        norm_params.update({"normalizer": args.normalizer, "target_img": args.target_img})
+    else:
+        # source and target references, re-estimating or another --target_ref changes the hash
+        norm_params.update({key: np.asarray(val).round(8).tolist() for key, val in stain_params.items()})
+    return hashlib.sha1(json.dumps(norm_params, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def load_param_log(log_path):
+    # parameter hash of every finished output, later lines win
+    done_hashes = {}
+    if os.path.exists(log_path):
+        with open(log_path) as fp:
+            for line in fp:
+                fields = line.strip().split(",")
+                if len(fields) == 2:
+                    done_hashes[fields[0]] = fields[1]
+    return done_hashes
+
+
+def is_up_to_date(src_path, dst_path, done_hash, param_hash):
+    return done_hash == param_hash and os.path.exists(dst_path) and os.path.getmtime(dst_path) >= os.path.getmtime(src_path)
+
+
+def tmp_img_path(img_path):
+    # not ending in .png, a leftover of a killed run is never listed as a ROI
+    img_dir, img_name = os.path.split(img_path)
+    return os.path.join(img_dir, ".tmp-{}-{}.part".format(os.getpid(), img_name))
+
+
+def atomic_imsave(img_path, img):
+    # write next to the target then rename, a killed run never leaves a partial png
+    tmp_path = tmp_img_path(img_path)
+    try:
+        write_png(tmp_path, img)
+        os.replace(tmp_path, img_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def normalize_roi_tiled(roi_img_path, norm_img_path, width, height):
+    # global stain statistics from the cohort cache, or in roi mode from a subsample of this ROI
+    # with the same numpy Macenko that normalizes the smaller ROIs whole
+    stain_params = cached_params
+    if stain_params is None:
+        stain_params = MacenkoNormalizer().stain_params(read_png_thumbnail(roi_img_path, tile_params["sample_factor"]))
+    # read, normalize and write tile by tile
+    tile_size = tile_params["tile_size"]
+    tmp_path = tmp_img_path(norm_img_path)
+    try:
+        writer = PNGStripWriter(tmp_path, width, height)
+        for strip in iter_png_strips(roi_img_path, tile_size):
+            norm_strip = np.empty((strip.shape[0], width, 3), dtype=np.uint8)
+            for left in range(0, width, tile_size):
+                norm_strip[:, left:left+tile_size] = normalize_stains(strip[:, left:left+tile_size], **stain_params)
+            writer.write(norm_strip)
+        writer.close()
+        os.replace(tmp_path, norm_img_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def normalize_roi(task):
+    roi_img_path, norm_img_path = task
+    width, height = read_png_size(roi_img_path)
+    if width * height > tile_params["tile_pixels"]:
+        normalize_roi_tiled(roi_img_path, norm_img_path, width, height)
+    else:
+        image = io.imread(roi_img_path)
+        img_norm = normalizer(image)
+        atomic_imsave(norm_img_path, img_norm)
+    return os.path.basename(norm_img_path)
+
+
 if __name__ == "__main__":
     args = set_args()
 
@@ -26,19 +149,76 @@ if __name__ == "__main__":
     # identify all images need to normalize
     roi_img_root = os.path.join(lesion_root_dir, args.block_dir)
     img_list = sorted([ele for ele in os.listdir(roi_img_root) if ele.endswith(".png")])
+    # skip ROIs failing quality control
+    img_list = filter_qc_rois(img_list, os.path.join(lesion_root_dir, "{}ROIQC.csv".format(args.dataset)))
 
     # setup stain normalization results location
     roi_norm_root = os.path.join(lesion_root_dir, args.norm_dir)
-    if os.path.exists(roi_norm_root):
+    if args.overwrite and os.path.exists(roi_norm_root):
         shutil.rmtree(roi_norm_root)
-    os.makedirs(roi_norm_root)
+    if not os.path.exists(roi_norm_root):
+        os.makedirs(roi_norm_root)
+
+    # cohort mode: estimate stain matrix once from sampled ROIs, then apply it to every ROI
+    stain_params = None
+    if args.stain_mode == "cohort":
+        stain_ref_dir = os.path.join(args.data_root, args.lesion_dir, args.stain_ref_dir)
+        if not os.path.exists(stain_ref_dir):
+            os.makedirs(stain_ref_dir)
+        src_ref_path = os.path.join(stain_ref_dir, "{}MacenkoStains.npz".format(args.dataset))
+        if args.estimate_ref or not os.path.exists(src_ref_path):
+            rng = np.random.RandomState(args.rand_seed)
+            ref_num = min(args.ref_roi_num, len(img_list))
+            ref_list = [img_list[ind] for ind in sorted(rng.choice(len(img_list), ref_num, replace=False))]
+            print("Estimate {} stain matrix from {} ROIs".format(args.dataset, ref_num))
+            src_stains, src_max_conc = estimate_cohort_stains([os.path.join(roi_img_root, ele) for ele in ref_list],
+                pixel_num=args.ref_pixel_num, rng=rng, tile_pixels=args.tile_pixels, sample_factor=args.sample_factor)
+            save_stain_ref(src_ref_path, src_stains, src_max_conc)
+        src_stains, src_max_conc = load_stain_ref(src_ref_path)
+        tgt_stains, tgt_max_conc = MACENKO_REF_STAINS, MACENKO_REF_MAX_CONC
+        if args.target_ref != "":
+            tgt_ref_path = os.path.join(stain_ref_dir, "{}MacenkoStains.npz".format(args.target_ref))
+            if not os.path.exists(tgt_ref_path):
+                sys.exit("Stain reference of {} not exist".format(args.target_ref))
+            tgt_stains, tgt_max_conc = load_stain_ref(tgt_ref_path)
+        stain_params = {"src_stains": src_stains, "src_max_conc": src_max_conc,
+                        "tgt_stains": tgt_stains, "tgt_max_conc": tgt_max_conc}
+
+    tile_args = {"tile_size": args.tile_size, "tile_pixels": args.tile_pixels, "sample_factor": args.sample_factor}
+    norm_args = {"normalizer": args.normalizer, "target_img": args.target_img}
+    if args.normalizer == "reinhard" and not os.path.exists(args.target_img):
+        sys.exit("Reinhard normalizer needs --target_img")
 
-    # normalize image one-by-one
-    normalizer = MacenkoStainNormalizer()
-    for num, img_name in enumerate(img_list):
-        print("Normalize {}/{} name: {}".format(num+1, len(img_list), img_name))
+    # skip ROIs whose normalized output is newer than the source and made with the same parameters
+    param_hash = norm_param_hash(args, stain_params)
+    param_log_path = os.path.join(roi_norm_root, ".norm_params.csv")
+    done_hashes = load_param_log(param_log_path)
+    task_list = []
+    for img_name in img_list:
         roi_img_path = os.path.join(roi_img_root, img_name)
-        image = io.imread(roi_img_path)
-        img_norm = normalizer.process(image)
         norm_img_path = os.path.join(roi_norm_root, img_name)
-        io.imsave(norm_img_path, img_norm)
\ No newline at end of file
+        if not is_up_to_date(roi_img_path, norm_img_path, done_hashes.get(img_name), param_hash):
+            task_list.append((roi_img_path, norm_img_path))
+    print("{} ROIs done before, {} ROIs to normalize".format(len(img_list) - len(task_list), len(task_list)))
+    # the other normalizers have no tiled version, large ROIs go through the numpy Macenko instead
+    if args.stain_mode == "roi" and args.normalizer != "macenko":
+        large_rois = [os.path.basename(ele[0]) for ele in task_list if np.prod(read_png_size(ele[0])) > args.tile_pixels]
+        if len(large_rois) > 0:
+            print("{} ROIs above --tile_pixels (e.g. {}) are normalized tile by tile with the numpy macenko, not {}".format(
+                len(large_rois), large_rois[0], args.normalizer))
+
+    # normalize images in a pool of workers, each finished ROI is logged with its parameters
+    with open(param_log_path, "a") as log_fp:
+        if args.workers > 1:
+            with multiprocessing.Pool(args.workers, initializer=init_worker, initargs=(stain_params, tile_args, norm_args)) as pool:
+                for num, img_name in enumerate(pool.imap_unordered(normalize_roi, task_list)):
+                    log_fp.write("{},{}\n".format(img_name, param_hash))
+                    log_fp.flush()
+                    print("Normalize {}/{} name: {}".format(num+1, len(task_list), img_name))
+        else:
+            init_worker(stain_params, tile_args, norm_args)
+            for num, task in enumerate(task_list):
+                img_name = normalize_roi(task)
+                log_fp.write("{},{}\n".format(img_name, param_hash))
+                log_fp.flush()
+                print("Normalize {}/{} name: {}".format(num+1, len(task_list), img_name))
@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+
+import os, sys
+import pandas as pd
+
+
+def filter_qc_rois(roi_list, qc_path):
+    # drop ROIs failing roi_quality_check.py, names with or without file extension, all kept without a QC table
+    if not os.path.exists(qc_path):
+        return roi_list
+    qc_df = pd.read_csv(qc_path)
+    qc_fail_rois = set(qc_df.loc[~qc_df["Pass"], "ROI"])
+    return [ele for ele in roi_list if os.path.splitext(ele)[0] not in qc_fail_rois]
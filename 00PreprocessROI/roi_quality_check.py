@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+import os, sys
+import argparse
+import multiprocessing
+import numpy as np
+import pandas as pd
+from skimage import io
+import cv2
+
+from tile_utils import read_png_size, read_png_thumbnail, tissue_mask
+
+
+def set_args():
+    parser = argparse.ArgumentParser(description = "Quality Control of ROIs on Downsampled Copies")
+    parser.add_argument("--data_root",        type=str,       default="/Data")
+    parser.add_argument("--lesion_dir",       type=str,       default="SlidesROIs")
+    parser.add_argument("--block_dir",        type=str,       default="RegionROIs")
+    parser.add_argument("--thumb_dir",        type=str,       default="ThumbROIs")
+    parser.add_argument("--dataset",          type=str,       default="Japan", choices=["Japan", "USA", "China"])
+    parser.add_argument("--downsample",       type=int,       default=4)
+    parser.add_argument("--min_tissue",       type=float,     default=0.2, help="minimum tissue fraction")
+    parser.add_argument("--min_blur",         type=float,     default=20.0, help="minimum variance of laplacian on tissue")
+    parser.add_argument("--max_saturation",   type=float,     default=0.3, help="maximum fraction of over-saturated tissue")
+    parser.add_argument("--workers",          type=int,       default=8)
+
+    args = parser.parse_args()
+    return args
+
+
+def roi_quality(thumb):
+    thumb = np.ascontiguousarray(thumb[..., :3])
+    mask = tissue_mask(thumb)
+    tissue_fraction = np.mean(mask)
+    blur_score, saturation_score = 0.0, 0.0
+    if np.any(mask):
+        gray = cv2.cvtColor(thumb, cv2.COLOR_RGB2GRAY)
+        blur_score = np.var(cv2.Laplacian(gray, cv2.CV_64F)[mask])
+        hsv = cv2.cvtColor(thumb, cv2.COLOR_RGB2HSV)
+        saturated = (hsv[:, :, 1] > 230) | (hsv[:, :, 2] < 30)
+        saturation_score = np.mean(saturated[mask])
+
+    return tissue_fraction, blur_score, saturation_score
+
+
+def check_roi(task):
+    roi_img_path, thumb_path, downsample = task
+    width, height = read_png_size(roi_img_path)
+    thumb = read_png_thumbnail(roi_img_path, downsample)
+    io.imsave(thumb_path, thumb, check_contrast=False)
+    return [width, height] + list(roi_quality(thumb))
+
+
+if __name__ == "__main__":
+    args = set_args()
+
+    lesion_root_dir = os.path.join(args.data_root, args.lesion_dir, args.dataset)
+    roi_img_root = os.path.join(lesion_root_dir, args.block_dir)
+    thumb_root = os.path.join(lesion_root_dir, args.thumb_dir)
+    if not os.path.exists(thumb_root):
+        os.makedirs(thumb_root)
+    roi_list = sorted([os.path.splitext(ele)[0] for ele in os.listdir(roi_img_root) if ele.endswith(".png")])
+
+    task_list = [(os.path.join(roi_img_root, ele + ".png"), os.path.join(thumb_root, ele + ".png"), args.downsample) for ele in roi_list]
+    qc_list = []
+    with multiprocessing.Pool(args.workers) as pool:
+        for ind, qc_vals in enumerate(pool.imap(check_roi, task_list, chunksize=4)):
+            if (ind + 1) % 100 == 0:
+                print("Check {}/{}".format(ind+1, len(roi_list)))
+            qc_list.append(qc_vals)
+
+    qc_df = pd.DataFrame(qc_list, columns=["Width", "Height", "TissueFraction", "BlurScore", "SaturationScore"])
+    qc_df.insert(0, "ROI", roi_list)
+    qc_df["Pass"] = (qc_df["TissueFraction"] >= args.min_tissue) & (qc_df["BlurScore"] >= args.min_blur) & \
+        (qc_df["SaturationScore"] <= args.max_saturation)
+    qc_path = os.path.join(lesion_root_dir, "{}ROIQC.csv".format(args.dataset))
+    qc_df.to_csv(qc_path, index=False)
+    print("{} of {} ROIs pass quality control".format(qc_df["Pass"].sum(), len(qc_df)))
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+import os, sys
+import numpy as np
+import tifffile
+
+
+def format_roi_name(slide_name, w_start, h_start, w_len, h_len, level=0):
+    # Wstart/Hstart in level 0 coordinates, Wlen/Hlen in pixels of the cropped level
+    # crops of a lower level carry a Level suffix, so they never share a name with level 0 crops
+    roi_name = "{}-Wstart{:06d}Hstart{:06d}Wlen{:06d}Hlen{:06d}".format(slide_name, w_start, h_start, w_len, h_len)
+    if level > 0:
+        roi_name += "Level{:d}".format(level)
+    return roi_name
+
+
+def get_slide_page(tif, level=0):
+    # page of the requested pyramid level and its downsampling to level 0
+    levels = tif.series[0].levels
+    if level >= len(levels):
+        sys.exit("{} only has {} levels".format(tif.filehandle.path, len(levels)))
+    page = levels[level].keyframe
+    downsample = levels[0].keyframe.imagewidth / page.imagewidth
+
+    return page, downsample
+
+
+def read_tiff_region(page, top, left, height, width, fill_val=255):
+    # decode only the tiles overlapping [top:top+height, left:left+width]
+    out = np.full((height, width, page.samplesperpixel), fill_val, dtype=page.dtype)
+    bottom, right = min(top + height, page.imagelength), min(left + width, page.imagewidth)
+    in_top, in_left = max(top, 0), max(left, 0)
+    if bottom <= in_top or right <= in_left:
+        return out
+    if not page.is_tiled:
+        region = page.asarray()[in_top:bottom, in_left:right]
+        out[in_top-top:bottom-top, in_left-left:right-left] = region.reshape(bottom-in_top, right-in_left, -1)
+        return out
+
+    tile_h, tile_w = page.tilelength, page.tilewidth
+    tiles_across = (page.imagewidth + tile_w - 1) // tile_w
+    fh = page.parent.filehandle
+    jpegtables = page.tags.get("JPEGTables", None)
+    if jpegtables is not None:
+        jpegtables = jpegtables.value
+    for tile_row in range(in_top // tile_h, (bottom - 1) // tile_h + 1):
+        for tile_col in range(in_left // tile_w, (right - 1) // tile_w + 1):
+            index = tile_row * tiles_across + tile_col
+            fh.seek(page.dataoffsets[index])
+            data = fh.read(page.databytecounts[index])
+            tile, _, _ = page.decode(data, index, jpegtables=jpegtables)
+            tile = tile.reshape(tile.shape[-3:])
+            # overlap between this tile and the requested region
+            tile_top, tile_left = tile_row * tile_h, tile_col * tile_w
+            y0, y1 = max(in_top, tile_top), min(bottom, tile_top + tile.shape[0])
+            x0, x1 = max(in_left, tile_left), min(right, tile_left + tile.shape[1])
+            out[y0-top:y1-top, x0-left:x1-left] = tile[y0-tile_top:y1-tile_top, x0-tile_left:x1-tile_left]
+
+    return out
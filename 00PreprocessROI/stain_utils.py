@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+
+import os, sys
+import numpy as np
+from skimage import io
+
+
+# H&E reference stain vectors (columns) and max concentrations from Macenko et al.
+MACENKO_REF_STAINS = np.array([[0.5626, 0.2159],
+                               [0.7201, 0.8012],
+                               [0.4062, 0.5581]])
+MACENKO_REF_MAX_CONC = np.array([1.9705, 1.0308])
+
+
+def rgb_to_od(img, io_max=240):
+    # optical density of every pixel as a (N, 3) array
+    rgb = np.asarray(img)[..., :3].reshape(-1, 3).astype(np.float64)
+    return -np.log((rgb + 1.0) / io_max)
+
+
+def estimate_stain_matrix(od, beta=0.15, alpha=1):
+    # drop transparent pixels, project onto the plane of the two main eigenvectors
+    return estimate_stain_matrices(od[None], beta=beta, alpha=alpha)[0]
+
+
+def get_concentrations(od, stains):
+    # least squares solution for all pixels at once
+    return od.dot(np.linalg.pinv(stains).T)
+
+
+def estimate_max_conc(od, stains, percentile=99):
+    return np.percentile(get_concentrations(od, stains), percentile, axis=0)
+
+
+def sample_tissue_od(img, pixel_num, beta=0.15, io_max=240, rng=None):
+    rng = np.random if rng is None else rng
+    od = rgb_to_od(img, io_max=io_max)
+    od = od[np.all(od >= beta, axis=1)]
+    if len(od) > pixel_num:
+        od = od[rng.choice(len(od), pixel_num, replace=False)]
+    return od
+
+
+def read_sample_img(img_path, tile_pixels=None, sample_factor=8):
+    # ROIs above tile_pixels are sampled from a thumbnail, never decoded whole
+    from tile_utils import read_png_size, read_png_thumbnail
+    if tile_pixels is not None and img_path.endswith(".png"):
+        width, height = read_png_size(img_path)
+        if width * height > tile_pixels:
+            return read_png_thumbnail(img_path, sample_factor)
+    return io.imread(img_path)
+
+
+def estimate_cohort_stains(img_paths, pixel_num=20000, beta=0.15, alpha=1, io_max=240, rng=None, tile_pixels=None, sample_factor=8):
+    # pool tissue pixels of the sampled ROIs, then estimate a single stain matrix
+    od_list = []
+    for img_path in img_paths:
+        od_list.append(sample_tissue_od(read_sample_img(img_path, tile_pixels, sample_factor), pixel_num, beta=beta, io_max=io_max, rng=rng))
+    od = np.concatenate(od_list, axis=0)
+    stains = estimate_stain_matrix(od, beta=beta, alpha=alpha)
+    max_conc = estimate_max_conc(od, stains)
+
+    return stains, max_conc
+
+
+def save_stain_ref(ref_path, stains, max_conc):
+    np.savez(ref_path, stains=stains, max_conc=max_conc)
+
+
+def load_stain_ref(ref_path):
+    ref = np.load(ref_path)
+    return ref["stains"], ref["max_conc"]
+
+
+def normalize_stains(img, src_stains, src_max_conc, tgt_stains=MACENKO_REF_STAINS,
+                     tgt_max_conc=MACENKO_REF_MAX_CONC, io_max=240):
+    # apply cached source / target stain statistics, no per-image estimation
+    conc = get_concentrations(rgb_to_od(img, io_max=io_max), src_stains)
+    conc *= tgt_max_conc / src_max_conc
+    norm = io_max * np.exp(-conc.dot(tgt_stains.T))
+    norm = np.clip(norm, 0, 255).astype(np.uint8)
+
+    return norm.reshape(img.shape[0], img.shape[1], 3)
+
+
+def masked_percentile(vals, mask, q):
+    # row-wise linear percentile over the masked entries of a (B, N) array
+    sort_vals = np.sort(np.where(mask, vals, np.inf), axis=1)
+    pos = (mask.sum(axis=1) - 1) * q / 100.0
+    low = np.floor(pos).astype(np.int64)
+    high = np.minimum(low + 1, vals.shape[1] - 1)
+    low_vals = np.take_along_axis(sort_vals, low[:, None], axis=1)[:, 0]
+    high_vals = np.take_along_axis(sort_vals, high[:, None], axis=1)[:, 0]
+    high_vals = np.where(np.isinf(high_vals), low_vals, high_vals)
+    return low_vals + (pos - low) * (high_vals - low_vals)
+
+
+def estimate_stain_matrices(od, beta=0.15, alpha=1, min_pixel_num=10):
+    # batched Macenko estimation on (B, N, 3) optical densities, one eigen-decomposition call
+    mask = np.all(od >= beta, axis=2)
+    empty = mask.sum(axis=1) < min_pixel_num
+    mask[empty] = True
+    weight = mask.astype(np.float64)
+    pixel_num = weight.sum(axis=1)
+    mean = np.matmul(weight[:, None, :], od)[:, 0] / pixel_num[:, None]
+    cen = (od - mean[:, None, :]) * weight[:, :, None]
+    cov = np.matmul(cen.transpose(0, 2, 1), cen) / (pixel_num - 1)[:, None, None]
+    _, eigvecs = np.linalg.eigh(cov)
+    plane = eigvecs[:, :, 1:3]
+    proj = np.matmul(od, plane)
+    phi = np.arctan2(proj[..., 1], proj[..., 0])
+    min_phi = masked_percentile(phi, mask, alpha)
+    max_phi = masked_percentile(phi, mask, 100 - alpha)
+    v_min = np.matmul(plane, np.stack([np.cos(min_phi), np.sin(min_phi)], axis=1)[:, :, None])[:, :, 0]
+    v_max = np.matmul(plane, np.stack([np.cos(max_phi), np.sin(max_phi)], axis=1)[:, :, None])[:, :, 0]
+    # hematoxylin first
+    h_first = (v_min[:, 0] > v_max[:, 0])[:, None, None]
+    stains = np.where(h_first, np.stack([v_min, v_max], axis=2), np.stack([v_max, v_min], axis=2))
+    stains *= np.where(stains.sum(axis=1) < 0, -1.0, 1.0)[:, None, :]
+    # blank images keep the reference stains
+    stains[empty] = MACENKO_REF_STAINS
+
+    return stains
+
+
+def apply_stains_batch(od, stains, tgt_stains, tgt_max_conc, io_max=240, percentile=99):
+    # od (B, N, 3), stains (B, 3, 2): concentrations, rescaling and reconstruction for the batch
+    conc = np.matmul(od, np.linalg.pinv(stains).transpose(0, 2, 1))
+    max_conc = np.percentile(conc, percentile, axis=1)
+    conc *= (tgt_max_conc / max_conc)[:, None, :]
+    norm = io_max * np.exp(-np.matmul(conc, tgt_stains.T))
+    return np.clip(norm, 0, 255).astype(np.uint8)
+
+
+def stack_images(imgs):
+    imgs = np.asarray(imgs)
+    if imgs.ndim == 3:
+        imgs = imgs[None]
+    return imgs[..., :3]
+
+
+class MacenkoNormalizer:
+    def __init__(self, tgt_stains=MACENKO_REF_STAINS, tgt_max_conc=MACENKO_REF_MAX_CONC, beta=0.15, alpha=1, io_max=240):
+        self.tgt_stains, self.tgt_max_conc = tgt_stains, tgt_max_conc
+        self.beta, self.alpha, self.io_max = beta, alpha, io_max
+
+    def fit(self, target):
+        od = rgb_to_od(target, io_max=self.io_max)
+        self.tgt_stains = estimate_stain_matrix(od, beta=self.beta, alpha=self.alpha)
+        self.tgt_max_conc = estimate_max_conc(od, self.tgt_stains)
+        return self
+
+    def stain_params(self, img):
+        # normalize_stains arguments from the statistics of img, e.g. a thumbnail of a ROI normalized tile by tile
+        od = rgb_to_od(img, io_max=self.io_max)
+        stains = estimate_stain_matrix(od, beta=self.beta, alpha=self.alpha)
+        return {"src_stains": stains, "src_max_conc": estimate_max_conc(od, stains),
+                "tgt_stains": self.tgt_stains, "tgt_max_conc": self.tgt_max_conc, "io_max": self.io_max}
+
+    def process(self, img):
+        return self.process_batch(img)[0]
+
+    def process_batch(self, imgs):
+        imgs = stack_images(imgs)
+        od = rgb_to_od(imgs, io_max=self.io_max).reshape(imgs.shape[0], -1, 3)
+        stains = estimate_stain_matrices(od, beta=self.beta, alpha=self.alpha)
+        norm = apply_stains_batch(od, stains, self.tgt_stains, self.tgt_max_conc, io_max=self.io_max)
+        return norm.reshape(imgs.shape)
+
+
+# Reinhard et al. color transfer in the l-alpha-beta space
+RGB_TO_LMS = np.array([[0.3811, 0.5783, 0.0402],
+                       [0.1967, 0.7244, 0.0782],
+                       [0.0241, 0.1288, 0.8444]])
+LMS_TO_LAB = np.dot(np.diag([1.0 / np.sqrt(3), 1.0 / np.sqrt(6), 1.0 / np.sqrt(2)]),
+                    np.array([[1, 1, 1], [1, 1, -2], [1, -1, 0]]))
+
+
+def rgb_to_lab(rgb):
+    lms = np.dot(rgb.astype(np.float64) + 1.0, RGB_TO_LMS.T)
+    return np.dot(np.log10(lms), LMS_TO_LAB.T)
+
+
+def lab_to_rgb(lab):
+    lms = np.power(10.0, np.dot(lab, np.linalg.inv(LMS_TO_LAB).T))
+    return np.dot(lms, np.linalg.inv(RGB_TO_LMS).T) - 1.0
+
+
+class ReinhardNormalizer:
+    def __init__(self, tgt_means=None, tgt_stds=None):
+        self.tgt_means, self.tgt_stds = tgt_means, tgt_stds
+
+    def fit(self, target):
+        lab = rgb_to_lab(stack_images(target).reshape(-1, 3))
+        self.tgt_means, self.tgt_stds = lab.mean(axis=0), lab.std(axis=0)
+        return self
+
+    def process(self, img):
+        return self.process_batch(img)[0]
+
+    def process_batch(self, imgs):
+        if self.tgt_means is None:
+            sys.exit("Reinhard normalizer needs a target, call fit first")
+        imgs = stack_images(imgs)
+        lab = rgb_to_lab(imgs.reshape(imgs.shape[0], -1, 3))
+        means = lab.mean(axis=1, keepdims=True)
+        stds = np.maximum(lab.std(axis=1, keepdims=True), 1e-6)
+        lab = (lab - means) / stds * self.tgt_stds + self.tgt_means
+        norm = np.clip(lab_to_rgb(lab), 0, 255).astype(np.uint8)
+        return norm.reshape(imgs.shape)
+
+
+def sparse_nmf_stains(od, init_stains, lambda_c=0.01, iter_num=50, eps=1e-9):
+    # od ~ conc.dot(stains.T) with non-negative, L1 sparse concentrations (multiplicative updates)
+    stain_rows = np.maximum(init_stains.T, eps)
+    conc = np.maximum(od.dot(np.linalg.pinv(stain_rows)), eps)
+    for _ in range(iter_num):
+        conc *= od.dot(stain_rows.T) / (conc.dot(stain_rows.dot(stain_rows.T)) + lambda_c + eps)
+        stain_rows *= conc.T.dot(od) / (conc.T.dot(conc).dot(stain_rows) + eps)
+        stain_rows /= np.linalg.norm(stain_rows, axis=1, keepdims=True)
+    stains = stain_rows.T
+    if stains[0, 0] < stains[0, 1]:
+        stains = stains[:, ::-1]
+
+    return stains
+
+
+class VahadaneNormalizer(MacenkoNormalizer):
+    # Vahadane-lite: Macenko initialization refined by a few sparse NMF iterations on sampled pixels
+    def __init__(self, pixel_num=10000, lambda_c=0.01, iter_num=50, **kwargs):
+        super().__init__(**kwargs)
+        self.pixel_num, self.lambda_c, self.iter_num = pixel_num, lambda_c, iter_num
+
+    def process_batch(self, imgs):
+        imgs = stack_images(imgs)
+        od = rgb_to_od(imgs, io_max=self.io_max).reshape(imgs.shape[0], -1, 3)
+        stains = estimate_stain_matrices(od, beta=self.beta, alpha=self.alpha)
+        rng = np.random.RandomState(0)
+        for ind in range(len(stains)):
+            tissue_od = od[ind][np.all(od[ind] >= self.beta, axis=1)]
+            if len(tissue_od) < 10:
+                continue
+            if len(tissue_od) > self.pixel_num:
+                tissue_od = tissue_od[rng.choice(len(tissue_od), self.pixel_num, replace=False)]
+            stains[ind] = sparse_nmf_stains(tissue_od, stains[ind], self.lambda_c, self.iter_num)
+        norm = apply_stains_batch(od, stains, self.tgt_stains, self.tgt_max_conc, io_max=self.io_max)
+        return norm.reshape(imgs.shape)
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+import os, sys
+import struct, zlib
+import numpy as np
+import cv2
+
+try:
+    import pyvips
+except ImportError:
+    pyvips = None
+
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def png_chunk(tag, data):
+    return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+
+
+def read_png_size(png_path):
+    # width & height from the IHDR chunk, no pixel decoding
+    with open(png_path, "rb") as fp:
+        header = fp.read(24)
+    if header[:8] != PNG_SIGNATURE or header[12:16] != b"IHDR":
+        sys.exit("{} is not a png file".format(png_path))
+    width, height = struct.unpack(">II", header[16:24])
+    return width, height
+
+
+def iter_png_strips(png_path, strip_height):
+    # pyvips decodes sequentially, only one strip is in memory at a time
+    if pyvips is not None:
+        img = pyvips.Image.new_from_file(png_path, access="sequential")
+        region = pyvips.Region.new(img)
+        for top in range(0, img.height, strip_height):
+            cur_height = min(strip_height, img.height - top)
+            buf = region.fetch(0, top, img.width, cur_height)
+            yield np.frombuffer(buf, dtype=np.uint8).reshape(cur_height, img.width, img.bands)
+    else:
+        reader = PNGStripReader(png_path)
+        for top in range(0, reader.height, strip_height):
+            yield reader.read(strip_height)
+        reader.close()
+
+
+def read_png_thumbnail(png_path, factor):
+    if pyvips is not None:
+        width, _ = read_png_size(png_path)
+        thumb = pyvips.Image.thumbnail(png_path, max(1, width // factor))
+        return np.ndarray(buffer=thumb.write_to_memory(), dtype=np.uint8,
+                          shape=[thumb.height, thumb.width, thumb.bands])
+    else:
+        # strips are a multiple of factor rows high, only one of them is decoded at a time
+        thumb_rows = [strip[::factor, ::factor] for strip in iter_png_strips(png_path, factor * 64)]
+        return np.concatenate(thumb_rows, axis=0)
+
+
+def tissue_mask(thumb, min_sat=20, max_gray=220):
+    # tissue is darker and more colorful than the glass background
+    thumb = np.ascontiguousarray(thumb[..., :3])
+    hsv = cv2.cvtColor(thumb, cv2.COLOR_RGB2HSV)
+    gray = cv2.cvtColor(thumb, cv2.COLOR_RGB2GRAY)
+    mask = (hsv[:, :, 1] > min_sat) & (gray < max_gray)
+    mask = cv2.morphologyEx(mask.astype(np.uint8), cv2.MORPH_OPEN, np.ones((3, 3), np.uint8))
+    return mask > 0
+
+
+class PNGStripReader:
+    # streaming 8-bit gray / RGB / RGBA png decoder, IDAT data is inflated strip by strip
+    # and every strip is wrapped into a small png for cv2, the row above it goes first unfiltered
+    def __init__(self, png_path):
+        self.png_path = png_path
+        self.fp = open(png_path, "rb")
+        if self.fp.read(8) != PNG_SIGNATURE:
+            sys.exit("{} is not a png file".format(png_path))
+        tag, self.ihdr = self._read_chunk()
+        self.width, self.height, bit_depth, color_type, _, _, interlace = struct.unpack(">IIBBBBB", self.ihdr)
+        if tag != b"IHDR" or bit_depth != 8 or color_type not in (0, 2, 6) or interlace != 0:
+            sys.exit("{} is not an 8-bit non-interlaced gray / RGB / RGBA png, install pyvips to read it".format(png_path))
+        self.channels = {0: 1, 2: 3, 6: 4}[color_type]
+        self.decompressor = zlib.decompressobj()
+        self.pending, self.prior_row = b"", None
+        self.row_num = 0
+
+    def _read_chunk(self):
+        length, tag = struct.unpack(">I4s", self.fp.read(8))
+        data = self.fp.read(length)
+        self.fp.read(4)
+        return tag, data
+
+    def _inflate(self, size):
+        # the next size bytes of filtered rows, never inflating much more than asked for
+        parts, have = [self.pending], len(self.pending)
+        while have < size:
+            out = self.decompressor.decompress(self.decompressor.unconsumed_tail, size - have)
+            if len(out) == 0:
+                if self.decompressor.eof:
+                    break
+                tag, data = self._read_chunk()
+                if tag == b"IEND":
+                    break
+                if tag == b"IDAT":
+                    out = self.decompressor.decompress(data, size - have)
+            parts.append(out)
+            have += len(out)
+        raw = b"".join(parts)
+        self.pending = raw[size:]
+        return raw[:size]
+
+    def read(self, row_num):
+        row_num = min(row_num, self.height - self.row_num)
+        raw = self._inflate(row_num * (self.width * self.channels + 1))
+        skip = 0
+        if self.prior_row is not None:
+            raw, skip = b"\x00" + self.prior_row + raw, 1
+        ihdr = self.ihdr[:4] + struct.pack(">I", row_num + skip) + self.ihdr[8:]
+        png = PNG_SIGNATURE + png_chunk(b"IHDR", ihdr) + png_chunk(b"IDAT", zlib.compress(raw, 0)) + png_chunk(b"IEND", b"")
+        strip = cv2.imdecode(np.frombuffer(png, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+        if strip is None or strip.shape[0] != row_num + skip:
+            sys.exit("{} is truncated or corrupted".format(self.png_path))
+        if self.channels == 1:
+            strip = strip[:, :, None]
+        else:
+            strip = cv2.cvtColor(strip, cv2.COLOR_BGR2RGB if self.channels == 3 else cv2.COLOR_BGRA2RGBA)
+        strip = strip[skip:]
+        self.prior_row = strip[-1].tobytes()
+        self.row_num += row_num
+        return strip
+
+    def close(self):
+        self.fp.close()
+
+
+class PNGStripWriter:
+    # streaming 8-bit png encoder, rows are filtered (Sub) and deflated strip by strip
+    def __init__(self, png_path, width, height, channels=3, level=6):
+        self.width, self.height, self.channels = width, height, channels
+        self.row_num = 0
+        self.fp = open(png_path, "wb")
+        self.fp.write(PNG_SIGNATURE)
+        color_type = {1: 0, 3: 2, 4: 6}[channels]
+        self._write_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0))
+        self.compressor = zlib.compressobj(level)
+
+    def _write_chunk(self, tag, data):
+        self.fp.write(png_chunk(tag, data))
+
+    def write(self, strip):
+        rows = np.ascontiguousarray(strip, dtype=np.uint8).reshape(strip.shape[0], -1)
+        if rows.shape[1] != self.width * self.channels:
+            sys.exit("Strip width not matching png width")
+        ch = self.channels
+        filtered = np.empty((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+        filtered[:, 0] = 1
+        filtered[:, 1:ch+1] = rows[:, :ch]
+        np.subtract(rows[:, ch:], rows[:, :-ch], out=filtered[:, ch+1:])
+        data = self.compressor.compress(filtered.tobytes())
+        if len(data) > 0:
+            self._write_chunk(b"IDAT", data)
+        self.row_num += rows.shape[0]
+
+    def close(self):
+        self._write_chunk(b"IDAT", self.compressor.flush())
+        self._write_chunk(b"IEND", b"")
+        self.fp.close()
+        if self.row_num != self.height:
+            sys.exit("Only {} of {} png rows written".format(self.row_num, self.height))
+
+
+def write_png(png_path, img):
+    # whole image through the strip writer, the format never depends on the file suffix
+    img = np.ascontiguousarray(img, dtype=np.uint8)
+    writer = PNGStripWriter(png_path, img.shape[1], img.shape[0], channels=1 if img.ndim == 2 else img.shape[2])
+    writer.write(img)
+    writer.close()
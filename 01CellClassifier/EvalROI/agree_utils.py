@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+import os, sys
+import itertools
+import numpy as np
+
+
+SCORE_LEVELS = ["Outstanding", "Good", "Tolerable", "Poor"]
+
+
+def score_bins(scores):
+    # 100 - Outstanding, [80, 100) - Good, [60, 80) - Tolerable, others - Poor
+    scores = np.asarray(scores, dtype=np.float64)
+    # ratings are percentages, anything outside [0, 100] is a data entry error and never binned silently
+    bad_scores = (scores < 0) | (scores > 100)
+    if np.any(bad_scores):
+        sys.exit("{} scores outside [0, 100], e.g. {}".format(np.count_nonzero(bad_scores), scores[bad_scores][0]))
+    levels = 3 - np.digitize(scores, [60, 80, 100])
+    return levels.astype(np.int64)
+
+
+def confusion_counts(rates1, rates2, level_num, weights=None):
+    # weights (boot_num, unit_num) give one matrix per bootstrap replicate
+    pair_codes = np.asarray(rates1) * level_num + np.asarray(rates2)
+    if weights is None:
+        return np.bincount(pair_codes, minlength=level_num * level_num).reshape(level_num, level_num)
+    pair_onehot = np.zeros((len(pair_codes), level_num * level_num), dtype=np.float64)
+    pair_onehot[np.arange(len(pair_codes)), pair_codes] = 1.0
+    return (weights @ pair_onehot).reshape(-1, level_num, level_num)
+
+
+def disagreement_weights(level_num, weight_type="quadratic"):
+    level_diffs = np.abs(np.arange(level_num)[:, None] - np.arange(level_num)[None, :]).astype(np.float64)
+    if weight_type == "quadratic":
+        return (level_diffs / max(level_num - 1, 1)) ** 2
+    if weight_type == "linear":
+        return level_diffs / max(level_num - 1, 1)
+    return (level_diffs > 0).astype(np.float64)
+
+
+def weighted_kappa(conf_mats, weight_type="quadratic"):
+    # Cohen's kappa of one (L, L) or a batch (B, L, L) of confusion matrices
+    conf_mats = np.asarray(conf_mats, dtype=np.float64)
+    level_num = conf_mats.shape[-1]
+    dis_weights = disagreement_weights(level_num, weight_type)
+    totals = conf_mats.sum(axis=(-2, -1), keepdims=True)
+    observed = conf_mats / totals
+    expected = observed.sum(axis=-1, keepdims=True) * observed.sum(axis=-2, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        kappas = 1.0 - (observed * dis_weights).sum(axis=(-2, -1)) / (expected * dis_weights).sum(axis=(-2, -1))
+    return kappas
+
+
+def unit_coincidences(ratings, level_num):
+    # per-unit coincidence contributions of Krippendorff's alpha, ratings (rater_num, unit_num) with -1 as missing
+    ratings = np.asarray(ratings)
+    unit_counts = np.zeros((ratings.shape[1], level_num), dtype=np.float64)
+    for rater_rates in ratings:
+        valid = rater_rates >= 0
+        unit_counts[np.flatnonzero(valid), rater_rates[valid]] += 1
+    pair_num = unit_counts.sum(axis=1)
+    pairable = pair_num >= 2
+    coincidences = unit_counts[:, :, None] * unit_counts[:, None, :]
+    coincidences[:, np.arange(level_num), np.arange(level_num)] -= unit_counts
+    coincidences[pairable] /= (pair_num[pairable] - 1)[:, None, None]
+    coincidences[~pairable] = 0
+    return coincidences.reshape(len(unit_counts), -1)
+
+
+def krippendorff_alpha(coincidences, metric="interval"):
+    # alpha of one (L, L) or a batch (B, L, L) of coincidence matrices
+    coincidences = np.asarray(coincidences, dtype=np.float64)
+    level_num = coincidences.shape[-1]
+    level_totals = coincidences.sum(axis=-1)
+    total = level_totals.sum(axis=-1)
+    levels = np.arange(level_num, dtype=np.float64)
+    if metric == "interval":
+        deltas = np.broadcast_to((levels[:, None] - levels[None, :]) ** 2, coincidences.shape)
+    elif metric == "ordinal":
+        # squared sum of marginals between two levels, half of both ends
+        cum_totals = np.cumsum(level_totals, axis=-1)
+        low, high = np.minimum.outer(levels, levels).astype(np.int64), np.maximum.outer(levels, levels).astype(np.int64)
+        between = cum_totals[..., high] - cum_totals[..., low] + level_totals[..., low]
+        deltas = (between - (level_totals[..., low] + level_totals[..., high]) / 2.0) ** 2
+    else:
+        deltas = np.broadcast_to(1.0 - np.eye(level_num), coincidences.shape)
+    observed = (coincidences * deltas).sum(axis=(-2, -1))
+    expected = (level_totals[..., :, None] * level_totals[..., None, :] * deltas).sum(axis=(-2, -1)) / (total - 1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return 1.0 - observed / expected
+
+
+def bootstrap_weights(unit_num, boot_num, rng):
+    # how many times each unit is drawn in each replicate, (boot_num, unit_num)
+    draws = rng.randint(0, unit_num, size=(boot_num, unit_num)) + np.arange(boot_num)[:, None] * unit_num
+    return np.bincount(draws.ravel(), minlength=boot_num * unit_num).reshape(boot_num, unit_num).astype(np.float64)
+
+
+def percentile_ci(boot_vals, ci=0.95):
+    boot_vals = boot_vals[np.isfinite(boot_vals)]
+    if len(boot_vals) == 0:
+        return np.nan, np.nan
+    return tuple(np.percentile(boot_vals, [50 * (1 - ci), 50 * (1 + ci)]))
+
+
+def rater_agreement(ratings, level_num, boot_num=2000, ci=0.95, weight_type="quadratic", metric="interval", rng=None):
+    # pairwise weighted kappas & Krippendorff's alpha with bootstrap intervals over units
+    ratings = np.asarray(ratings)
+    rng = np.random.RandomState() if rng is None else rng
+    weights = bootstrap_weights(ratings.shape[1], boot_num, rng)
+
+    pair_stats = {}
+    for rater1, rater2 in itertools.combinations(range(len(ratings)), 2):
+        both = (ratings[rater1] >= 0) & (ratings[rater2] >= 0)
+        conf_mat = confusion_counts(ratings[rater1][both], ratings[rater2][both], level_num)
+        boot_kappas = weighted_kappa(confusion_counts(ratings[rater1][both], ratings[rater2][both], level_num, weights[:, both]), weight_type)
+        pair_stats[(rater1, rater2)] = {"conf_mat": conf_mat, "kappa": weighted_kappa(conf_mat, weight_type),
+                                        "kappa_ci": percentile_ci(boot_kappas, ci)}
+
+    unit_coins = unit_coincidences(ratings, level_num)
+    alpha = krippendorff_alpha(unit_coins.sum(axis=0).reshape(level_num, level_num), metric)
+    boot_alphas = krippendorff_alpha((weights @ unit_coins).reshape(-1, level_num, level_num), metric)
+
+    return pair_stats, alpha, percentile_ci(boot_alphas, ci)
@@ -7,6 +7,8 @@ import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
 
+from agree_utils import SCORE_LEVELS, score_bins, rater_agreement
+
 
 def set_args():
     parser = argparse.ArgumentParser(description = "Evaluate ROI-Level Cell Classification")
@@ -16,86 +18,66 @@ def set_args():
     parser.add_argument("--dataset",          type=str,       default="Japan", choices=["Japan", "USA", "China"])
     parser.add_argument("--vis_dir",          type=str,       default="VisPlots")    
     parser.add_argument("--plot_format",      type=str,       default=".png", choices=[".png", ".pdf"])          
+    parser.add_argument("--raters",           type=str,       nargs="+", default=["Frank", "Serrano"])
+    parser.add_argument("--cell_types",       type=str,       nargs="+", default=["AEC", "LYM", "OC"])
+    parser.add_argument("--kappa_weights",    type=str,       default="quadratic", choices=["quadratic", "linear", "nominal"])
+    parser.add_argument("--alpha_metric",     type=str,       default="ordinal", choices=["ordinal", "interval", "nominal"])
+    parser.add_argument("--boot_num",         type=int,       default=5000)
     parser.add_argument("--seed",             type=int,       default=1234)
 
     args = parser.parse_args()
     return args
 
 
-def score_map(score):
-    val = None
-    if score == 100:
-        val = 0
-    elif score >=80 and score < 100:
-        val = 1
-    elif score >=60 and score < 80:
-        val = 2
-    else:
-        val = 3
-
-    return val
-
-
 if __name__ == "__main__":
     args = set_args()
     random.seed(args.seed)
     np.random.seed(args.seed)
 
     data_root = os.path.join(args.data_root, args.celltype_dir)
-    frank_eval_roi_dir = os.path.join(data_root, args.roi_eval_dir, "EvaluationFrank")
-    frank_eval_roi_path = os.path.join(frank_eval_roi_dir, "{}-Evaluation.xlsx".format(args.dataset))
-    if not os.path.exists(frank_eval_roi_path):
-        sys.exit("Frank's evaluation of {} not exist".format(args.dataset))
-
-    serrano_eval_roi_dir = os.path.join(data_root, args.roi_eval_dir, "EvaluationSerrano")
-    serrano_eval_roi_path = os.path.join(serrano_eval_roi_dir, "{}-Evaluation.xlsx".format(args.dataset))
-    if not os.path.exists(serrano_eval_roi_path):
-        sys.exit("Serrano's evaluation of {} not exist".format(args.dataset))
-
+    if len(args.raters) < 2:
+        sys.exit("Consistency needs at least two raters")
+    rater_eval_dfs = []
+    for rater in args.raters:
+        eval_roi_path = os.path.join(data_root, args.roi_eval_dir, "Evaluation{}".format(rater), "{}-Evaluation.xlsx".format(args.dataset))
+        if not os.path.exists(eval_roi_path):
+            sys.exit("{}'s evaluation of {} not exist".format(rater, args.dataset))
+        rater_eval_dfs.append(pd.read_excel(eval_roi_path))
+    if len(set([len(ele) for ele in rater_eval_dfs])) != 1:
+        sys.exit("Raters evaluated different numbers of ROIs")
 
     vis_dir = os.path.join(data_root, args.vis_dir)
     if not os.path.exists(vis_dir):
         os.makedirs(vis_dir)    
 
-
-    # obtain Frank's evaluation lst
-    frank_eval_df = pd.read_excel(frank_eval_roi_path)
-    frank_aec_lst = [int(ele) for ele in frank_eval_df["AEC"].tolist()]
-    frank_lym_lst = [int(ele) for ele in frank_eval_df["LYM"].tolist()]
-    frank_oc_lst = [int(ele) for ele in frank_eval_df["OC"].tolist()]
-
-    # obtain Serrano's evaluation list
-    serrano_eval_df = pd.read_excel(serrano_eval_roi_path)
-    serrano_aec_lst = [int(ele) for ele in serrano_eval_df["AEC"].tolist()]
-    serrano_lym_lst = [int(ele) for ele in serrano_eval_df["LYM"].tolist()]
-    serrano_oc_lst = [int(ele) for ele in serrano_eval_df["OC"].tolist()]   
-
-    aec_matrix = np.zeros((4, 4), dtype = np.int32)
-    for f1, s1 in zip(frank_aec_lst, serrano_aec_lst):
-        ind1 = score_map(f1)
-        ind2 = score_map(s1)
-        aec_matrix[ind1, ind2] += 1
-    lym_matrix = np.zeros((4, 4), dtype = np.int32)
-    for f1, s1 in zip(frank_lym_lst, serrano_lym_lst):
-        ind1 = score_map(f1)
-        ind2 = score_map(s1)
-        lym_matrix[ind1, ind2] += 1    
-    oc_matrix = np.zeros((4, 4), dtype = np.int32)
-    for f1, s1 in zip(frank_oc_lst, serrano_oc_lst):
-        ind1 = score_map(f1)
-        ind2 = score_map(s1)
-        oc_matrix[ind1, ind2] += 1            
-
-    # draw consistensy map
-    categories = ["Outstanding", "Good", "Tolerable", "Poor"]
-    fig, axes = plt.subplots(1, 3, figsize=(18, 5))
-    sns.heatmap(aec_matrix, annot=True, fmt="d", cmap="Blues", xticklabels=categories, yticklabels=categories, ax=axes[0])
-    sns.heatmap(lym_matrix, annot=True, fmt="d", cmap="Blues", xticklabels=categories, yticklabels=categories, ax=axes[1])
-    sns.heatmap(oc_matrix, annot=True, fmt="d", cmap="Blues", xticklabels=categories, yticklabels=categories, ax=axes[2])
-    axes[0].set_title("AEC")
-    axes[1].set_title("LYM")
-    axes[2].set_title("OC")
+    # binned scores (rater_num, roi_num) per cell type, missing scores as -1
+    rng = np.random.RandomState(args.seed)
+    agree_rows, cell_pair_stats = [], {}
+    for cell_type in args.cell_types:
+        cell_scores = np.stack([ele[cell_type].to_numpy(dtype=np.float64) for ele in rater_eval_dfs])
+        cell_ratings = np.where(np.isnan(cell_scores), -1, score_bins(np.nan_to_num(cell_scores)))
+        pair_stats, alpha, alpha_ci = rater_agreement(cell_ratings, len(SCORE_LEVELS), boot_num=args.boot_num, rng=rng,
+                                                      weight_type=args.kappa_weights, metric=args.alpha_metric)
+        cell_pair_stats[cell_type] = pair_stats
+        for (rater1, rater2), stats in pair_stats.items():
+            agree_rows.append([cell_type, args.raters[rater1], args.raters[rater2], stats["kappa"], stats["kappa_ci"][0], stats["kappa_ci"][1]])
+        agree_rows.append([cell_type, "All", "All", alpha, alpha_ci[0], alpha_ci[1]])
+    agree_df = pd.DataFrame(agree_rows, columns=["CellType", "Rater1", "Rater2", "Agreement", "CILow", "CIHigh"])
+    agree_df.insert(3, "Measure", ["Kappa" if ele != "All" else "Alpha" for ele in agree_df["Rater1"]])
+    print(agree_df.round(3).to_string(index=False))
+    agree_path = os.path.join(data_root, args.roi_eval_dir, "{}-Agreement.csv".format(args.dataset))
+    agree_df.to_csv(agree_path, index=False)
+
+    # draw consistensy map, one row per rater pair
+    rater_pairs = list(cell_pair_stats[args.cell_types[0]].keys())
+    fig, axes = plt.subplots(len(rater_pairs), len(args.cell_types), figsize=(6 * len(args.cell_types), 5 * len(rater_pairs)), squeeze=False)
+    for row_ind, (rater1, rater2) in enumerate(rater_pairs):
+        for col_ind, cell_type in enumerate(args.cell_types):
+            stats = cell_pair_stats[cell_type][(rater1, rater2)]
+            sns.heatmap(stats["conf_mat"], annot=True, fmt="d", cmap="Blues", xticklabels=SCORE_LEVELS, yticklabels=SCORE_LEVELS, ax=axes[row_ind, col_ind])
+            pair_name = "" if len(rater_pairs) == 1 else "{} vs {} ".format(args.raters[rater1], args.raters[rater2])
+            axes[row_ind, col_ind].set_title("{}{} (kappa {:.2f})".format(pair_name, cell_type, stats["kappa"]))
     # plt.tight_layout()
     fig.suptitle("{} Consistency Matrix of ROI-Level Cellular Recognition Evaluations".format(args.dataset))
     cv_conf_mat_path = os.path.join(vis_dir, "ROI_eval_consistency_{}".format(args.dataset) + args.plot_format)
-    plt.savefig(cv_conf_mat_path, transparent=False, dpi=300)   
\ No newline at end of file
+    plt.savefig(cv_conf_mat_path, transparent=False, dpi=300)
\ No newline at end of file
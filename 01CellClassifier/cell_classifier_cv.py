@@ -7,11 +7,12 @@ import pandas as pd
 import xgboost as xgb
 import matplotlib.pyplot as plt
 from sklearn.ensemble import RandomForestClassifier
-from sklearn.model_selection import cross_val_score, cross_val_predict
 from sklearn.metrics import confusion_matrix
 import matplotlib.pyplot as plt
 import seaborn as sns
 
+from cv_utils import load_cell_features, cell_fea_matrix, cross_validate_clf, save_cv_result, load_cv_result, load_model_params
+
 
 def set_args():
     parser = argparse.ArgumentParser(description = "Evaluate Cell Classification")
@@ -22,6 +23,9 @@ def set_args():
     parser.add_argument("--dataset",          type=str,       default="Japan", choices=["Japan", "USA"])    
     parser.add_argument("--plot_format",      type=str,       default=".png", choices=[".png", ".pdf"])         
     parser.add_argument("--seed",             type=int,       default=1234)
+    parser.add_argument("--model_params",     type=str,       default=None, help="json of XGBClassifier parameters")
+    parser.add_argument("--cv_jobs",          type=int,       default=-1, help="parallel folds, -1 for all cores, -2 all but one")
+    parser.add_argument("--replot",           action="store_true", help="redraw plots from saved cross-validation results")
 
     args = parser.parse_args()
     return args
@@ -43,32 +47,28 @@ if __name__ == "__main__":
     if not os.path.exists(cellmodel_dir):
         os.makedirs(cellmodel_dir)
 
-    cell_fea_path = os.path.join(cell_fea_dir, "cell_feas.csv")
-    cell_fea_df = pd.read_csv(cell_fea_path)
-    # obtain features
-    X = cell_fea_df[["Area", "Intensity", "Roundness"]].to_numpy().astype(np.float64)
-    # obtain labels
-    cell_fea_df["Class"] = cell_fea_df["Label"]
-    cell_fea_df.loc[cell_fea_df["Class"] == "AEC", "Class"] = 0
-    cell_fea_df.loc[cell_fea_df["Class"] == "LYM", "Class"] = 1
-    cell_fea_df.loc[cell_fea_df["Class"] == "OC", "Class"] = 2
-    y = cell_fea_df["Class"].to_numpy().astype(np.int64)
-    
-    # cross-validation
-    clf = xgb.XGBClassifier()
-    scores = cross_val_score(clf, X, y, cv=5)
+    cv_result_path = os.path.join(cellmodel_dir, "{}_cell_classifier_cv.pkl".format(args.dataset))
+    if args.replot:
+        cv_result = load_cv_result(cv_result_path)
+    else:
+        cell_fea_path = os.path.join(cell_fea_dir, "cell_feas.csv")
+        cell_fea_df = load_cell_features(cell_fea_path)
+        X, y = cell_fea_matrix(cell_fea_df)
+        # cross-validation, each fold trained once
+        clf = xgb.XGBClassifier(**load_model_params(args.model_params))
+        cv_result = cross_validate_clf(clf, X, y, cv=5, n_jobs=args.cv_jobs)
+        save_cv_result(cv_result, cv_result_path)
+        # fit & save model
+        clf.fit(X, y) 
+        celltype_model_path = os.path.join(cellmodel_dir, "{}_cell_classifier.model".format(args.dataset))
+        pickle.dump(clf, open(celltype_model_path, "wb"))
+        # native booster for batched inference
+        clf.get_booster().save_model(os.path.splitext(celltype_model_path)[0] + ".json")
+    scores, cv_conf_mat = cv_result["scores"], cv_result["conf_mat"]
     print("%0.3f accuracy with a standard deviation of %0.3f" % (scores.mean(), scores.std()))
-    # confusion matrix
-    y_pred = cross_val_predict(clf, X, y, cv=5)
-    cv_conf_mat = confusion_matrix(y, y_pred)
     print("CV Confusion Matrix:")
     print(cv_conf_mat)
 
-    # fit & save model
-    clf.fit(X, y) 
-    celltype_model_path = os.path.join(cellmodel_dir, "{}_cell_classifier.model".format(args.dataset))
-    pickle.dump(clf, open(celltype_model_path, "wb"))
-
     # plot the confusion matrix
     fig, axes = plt.subplots(1, 1, figsize=(8, 6))
     categories = ["AEC", "LYM", "OC"]
@@ -4,6 +4,8 @@ import os, sys
 import argparse, json
 import numpy as np
 
+from labelme_utils import index_labelme_dir
+
 
 def set_args():
     parser = argparse.ArgumentParser(description = "Count Annotated Cell Numbers")
@@ -23,21 +25,10 @@ if __name__ == "__main__":
     if not os.path.exists(annotation_dir):
         sys.exit("Annotations donot exist.")
 
-    # collect cell annotations
-    roi_list = sorted([os.path.splitext(ele)[0] for ele in os.listdir(annotation_dir) if ele.endswith(".json")])
-    cell_dict = {}
-    for cur_roi in roi_list:
-        cur_annotation_path = os.path.join(annotation_dir, cur_roi + ".json")
-        cur_dict = None
-        with open(cur_annotation_path) as fp:
-            cur_dict = json.load(fp)
-        cell_lst = cur_dict["shapes"]
-        for cur_cell in cell_lst:
-            cell_label = cur_cell["label"]
-            if cell_label not in cell_dict:
-                cell_dict[cell_label] = 1
-            else:
-                cell_dict[cell_label] += 1
+    # collect cell annotations from the cached index
+    index_path = os.path.join(celltype_root, args.dataset, "AnnotationIndex.pkl")
+    _, anno_point_df = index_labelme_dir(annotation_dir, index_path)
+    cell_dict = anno_point_df["Label"].value_counts().to_dict()
 
     # Summary cell annotations
     cell_lst = ["AEC", "LYM", "OC"]
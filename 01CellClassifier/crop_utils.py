@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+import os, sys
+import numpy as np
+import pandas as pd
+
+
+CROP_INDEX_COLUMNS = ["ROI", "Label", "X", "Y", "Y1", "Y2", "X1", "X2", "Height", "Width", "Channels", "Offset"]
+
+
+class CropStoreWriter:
+    # ragged uint8 crops appended to one binary file, offsets kept in a csv index
+    def __init__(self, store_dir, store_name="cell_crops"):
+        self.bin_path = os.path.join(store_dir, store_name + ".bin")
+        self.index_path = os.path.join(store_dir, store_name + ".csv")
+        self.tmp_bin_path = os.path.join(store_dir, ".tmp-{}-{}.bin".format(os.getpid(), store_name))
+        self.fp = open(self.tmp_bin_path, "wb")
+        self.offset = 0
+        self.index_rows = []
+
+    def add(self, crop, roi, label, x, y, bbox):
+        crop = np.ascontiguousarray(crop, dtype=np.uint8)
+        if crop.ndim == 2:
+            crop = crop[..., None]
+        y1, y2, x1, x2 = [int(ele) for ele in bbox]
+        self.index_rows.append([roi, label, x, y, y1, y2, x1, x2, crop.shape[0], crop.shape[1], crop.shape[2], self.offset])
+        self.fp.write(crop.tobytes())
+        self.offset += crop.nbytes
+
+    def close(self):
+        self.fp.close()
+        index_df = pd.DataFrame(self.index_rows, columns=CROP_INDEX_COLUMNS)
+        os.replace(self.tmp_bin_path, self.bin_path)
+        index_df.to_csv(self.index_path, index=False)
+        return index_df
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.fp.close()
+            os.remove(self.tmp_bin_path)
+
+
+class CropStore:
+    # memory-mapped reader of a packed crop store
+    def __init__(self, store_dir, store_name="cell_crops"):
+        self.index_df = pd.read_csv(os.path.join(store_dir, store_name + ".csv"), dtype={"ROI": str, "Label": str})
+        bin_path = os.path.join(store_dir, store_name + ".bin")
+        self.data = np.memmap(bin_path, dtype=np.uint8, mode="r") if os.path.getsize(bin_path) > 0 else np.zeros(0, np.uint8)
+        self.shapes = self.index_df[["Height", "Width", "Channels"]].to_numpy(dtype=np.int64)
+        self.offsets = self.index_df["Offset"].to_numpy(dtype=np.int64)
+
+    def __len__(self):
+        return len(self.index_df)
+
+    def __getitem__(self, ind):
+        height, width, channels = self.shapes[ind]
+        crop_size = height * width * channels
+        return np.array(self.data[self.offsets[ind]:self.offsets[ind] + crop_size]).reshape(height, width, channels)
+
+    def read_batch(self, inds):
+        # random access, crops in the order of inds
+        return [self[ind] for ind in inds]
+
+    def iter_batches(self, batch_size=256, labels=None):
+        # sequential pass in storage order, optionally restricted to some labels
+        store_inds = np.arange(len(self))
+        if labels is not None:
+            store_inds = store_inds[self.index_df["Label"].isin(labels).to_numpy()]
+        for start in range(0, len(store_inds), batch_size):
+            batch_inds = store_inds[start:start + batch_size]
+            yield self.index_df.iloc[batch_inds], self.read_batch(batch_inds)
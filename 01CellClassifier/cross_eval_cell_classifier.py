@@ -6,98 +6,124 @@ import numpy as np
 import pandas as pd
 import xgboost as xgb
 import matplotlib.pyplot as plt
-from sklearn.ensemble import RandomForestClassifier
-from sklearn.model_selection import cross_val_score, cross_val_predict
+from joblib import Parallel, delayed
+from sklearn.base import clone
 from sklearn.metrics import confusion_matrix, accuracy_score
-import matplotlib.pyplot as plt
 import seaborn as sns
 
+from cv_utils import CELL_CATEGORIES, load_cell_features, cell_fea_matrix, cross_validate_clf, load_model_params, resolve_n_jobs
+
 
 def set_args():
     parser = argparse.ArgumentParser(description = "Evaluate Cell Classification")
     parser.add_argument("--data_root",        type=str,       default="/Data")
     parser.add_argument("--celltype_dir",     type=str,       default="CellClassifier")
-    parser.add_argument("--cellmodel_dir",    type=str,       default="CellModels")    
-    parser.add_argument("--vis_dir",          type=str,       default="VisPlots")   
-    parser.add_argument("--plot_format",      type=str,       default=".png", choices=[".png", ".pdf"])                
+    parser.add_argument("--cellmodel_dir",    type=str,       default="CellModels")
+    parser.add_argument("--vis_dir",          type=str,       default="VisPlots")
+    parser.add_argument("--plot_format",      type=str,       default=".png", choices=[".png", ".pdf"])
+    parser.add_argument("--cohorts",          type=str,       nargs="+", default=None, help="all cohorts with CellFeas if not set")
+    parser.add_argument("--model_params",     type=str,       default=None, help="json of XGBClassifier parameters")
+    parser.add_argument("--retrain",          action="store_true", help="train cohort models even if saved ones exist")
+    parser.add_argument("--workers",          type=int,       default=-1, help="parallel jobs, -1 for all cores, -2 all but one")
     parser.add_argument("--seed",             type=int,       default=1234)
 
     args = parser.parse_args()
     return args
 
 
+def fit_model(clf, X, y, n_threads):
+    model = clone(clf)
+    model.set_params(n_jobs=n_threads)
+    return model.fit(X, y)
+
+
 if __name__ == "__main__":
     args = set_args()
     random.seed(args.seed)
     np.random.seed(args.seed)
+    worker_num = resolve_n_jobs(args.workers)
 
-    vis_dir = os.path.join(args.data_root, args.celltype_dir, args.vis_dir)
+    celltype_root = os.path.join(args.data_root, args.celltype_dir)
+    vis_dir = os.path.join(celltype_root, args.vis_dir)
     if not os.path.exists(vis_dir):
-        os.makedirs(vis_dir)    
-    cellmodel_dir = os.path.join(args.data_root, args.celltype_dir, "CellModels")
+        os.makedirs(vis_dir)
+    cellmodel_dir = os.path.join(celltype_root, args.cellmodel_dir)
     if not os.path.exists(cellmodel_dir):
         os.makedirs(cellmodel_dir)
 
-    # load japan features
-    japan_data_root = os.path.join(args.data_root, args.celltype_dir, "Japan")
-    japan_cell_fea_dir = os.path.join(japan_data_root, "CellFeas")
-    japan_cell_fea_path = os.path.join(japan_cell_fea_dir, "cell_feas.csv")
-    japan_cell_fea_df = pd.read_csv(japan_cell_fea_path)
-    # obtain features
-    japan_X = japan_cell_fea_df[["Area", "Intensity", "Roundness"]].to_numpy().astype(np.float64)
-    # obtain labels
-    japan_cell_fea_df["Class"] = japan_cell_fea_df["Label"]
-    japan_cell_fea_df.loc[japan_cell_fea_df["Class"] == "AEC", "Class"] = 0
-    japan_cell_fea_df.loc[japan_cell_fea_df["Class"] == "LYM", "Class"] = 1
-    japan_cell_fea_df.loc[japan_cell_fea_df["Class"] == "OC", "Class"] = 2
-    japan_y = japan_cell_fea_df["Class"].to_numpy().astype(np.int64)
-
-    # load japan classifier
-    japan_celltype_model_path = os.path.join(cellmodel_dir, "Japan_cell_classifier.model")
-    japan_cell_clf = pickle.load(open(japan_celltype_model_path, "rb"))
+    # all cohort features in one frame
+    cohorts = args.cohorts
+    if cohorts is None:
+        cohorts = sorted([ele for ele in os.listdir(celltype_root) if os.path.exists(os.path.join(celltype_root, ele, "CellFeas", "cell_feas.csv"))])
+    if len(cohorts) < 2:
+        sys.exit("Cross-cohort evaluation needs at least two cohorts, found {}.".format(cohorts))
+    cell_fea_df = pd.concat([load_cell_features(os.path.join(celltype_root, cohort, "CellFeas", "cell_feas.csv"), source=cohort)
+                             for cohort in cohorts], ignore_index=True)
+    X, y = cell_fea_matrix(cell_fea_df)
+    cohort_masks = {cohort: (cell_fea_df["Sources"] == cohort).to_numpy() for cohort in cohorts}
+    print("Cohorts: " + ", ".join(["{} ({} cells)".format(cohort, np.sum(cohort_masks[cohort])) for cohort in cohorts]))
 
-    # load NYU features
-    nyu_data_root = os.path.join(args.data_root, args.celltype_dir, "USA")
-    nyu_cell_fea_dir = os.path.join(nyu_data_root, "CellFeas")
-    nyu_cell_fea_path = os.path.join(nyu_cell_fea_dir, "cell_feas.csv")
-    nyu_cell_fea_df = pd.read_csv(nyu_cell_fea_path)
-    # obtain features
-    nyu_X = nyu_cell_fea_df[["Area", "Intensity", "Roundness"]].to_numpy().astype(np.float64)
-    # obtain labels
-    nyu_cell_fea_df["Class"] = nyu_cell_fea_df["Label"]
-    nyu_cell_fea_df.loc[nyu_cell_fea_df["Class"] == "AEC", "Class"] = 0
-    nyu_cell_fea_df.loc[nyu_cell_fea_df["Class"] == "LYM", "Class"] = 1
-    nyu_cell_fea_df.loc[nyu_cell_fea_df["Class"] == "OC", "Class"] = 2
-    nyu_y = nyu_cell_fea_df["Class"].to_numpy().astype(np.int64)
+    # one model per cohort & per leave-one-cohort-out combination
+    clf = xgb.XGBClassifier(**load_model_params(args.model_params))
+    models, train_jobs = {}, []
+    for cohort in cohorts:
+        cohort_model_path = os.path.join(cellmodel_dir, "{}_cell_classifier.model".format(cohort))
+        if os.path.exists(cohort_model_path) and not args.retrain:
+            models[cohort] = pickle.load(open(cohort_model_path, "rb"))
+        else:
+            train_jobs.append((cohort, cohort_masks[cohort]))
+        train_jobs.append(("All-but-" + cohort, ~cohort_masks[cohort]))
+    cpu_num = os.cpu_count() or 1
+    job_num = max(1, min(len(train_jobs), worker_num))
+    fitted = Parallel(n_jobs=job_num)(delayed(fit_model)(clf, X[train_mask], y[train_mask], max(1, cpu_num // job_num))
+                                      for _, train_mask in train_jobs)
+    models.update({name: model for (name, _), model in zip(train_jobs, fitted)})
 
-    # load NYU classifier
-    nyu_celltype_model_path = os.path.join(cellmodel_dir, "USA_cell_classifier.model")
-    nyu_cell_clf = pickle.load(open(nyu_celltype_model_path, "rb"))
+    # train cohort x test cohort, in-cohort cells use out-of-fold predictions
+    model_names = cohorts + ["All-but-" + cohort for cohort in cohorts]
+    acc_df = pd.DataFrame(np.nan, index=model_names, columns=cohorts)
+    conf_mats = {}
+    for test_cohort in cohorts:
+        test_mask = cohort_masks[test_cohort]
+        test_X, test_y = X[test_mask], y[test_mask]
+        for model_name in model_names:
+            if model_name == test_cohort:
+                test_pred = cross_validate_clf(clf, test_X, test_y, cv=5, n_jobs=args.workers)["y_pred"]
+            elif model_name == "All-but-" + test_cohort or model_name in cohorts:
+                test_pred = models[model_name].predict(test_X)
+            else:
+                # the test cohort is part of this model's training cells
+                continue
+            acc_df.loc[model_name, test_cohort] = accuracy_score(test_y, test_pred)
+            conf_mats[(model_name, test_cohort)] = confusion_matrix(test_y, test_pred, labels=range(len(CELL_CATEGORIES)))
+    print("Accuracy (rows: training cells, columns: test cohort)")
+    print(acc_df.round(3).to_string())
+    acc_df.to_csv(os.path.join(cellmodel_dir, "cross_eval_accuracy.csv"))
+    with open(os.path.join(cellmodel_dir, "cross_eval_conf_mats.pkl"), "wb") as fp:
+        pickle.dump(conf_mats, fp)
 
-    # Evaluate Japan Cell Classifier on NYU Cells
-    nyu_pred = japan_cell_clf.predict(nyu_X)
-    nyu_conf_mat = confusion_matrix(nyu_y, nyu_pred)
-    print("Japan model on USA cells:")
-    print(nyu_conf_mat)
-    nyu_acc = accuracy_score(nyu_y, nyu_pred)
-    print("Accuracy: {:.3f}".format(nyu_acc))
-    # Evaluate NYU Cell Classifier on Japan Cells
-    japan_pred = nyu_cell_clf.predict(japan_X)
-    japan_conf_mat = confusion_matrix(japan_y, japan_pred)
-    print("USA model on japan cells:")
-    print(japan_conf_mat)
-    japan_acc = accuracy_score(japan_y, japan_pred)
-    print("Accuracy: {:.3f}".format(japan_acc)) 
+    # plot the accuracy matrix
+    fig, axes = plt.subplots(1, 1, figsize=(3 + 2 * len(cohorts), 2 + len(model_names)))
+    sns.set(font_scale=1.4)
+    sns.heatmap(acc_df, annot=True, fmt=".3f", cmap="Blues", vmin=0.0, vmax=1.0, ax=axes)
+    axes.set_xlabel("Test cohort")
+    axes.set_ylabel("Training cells")
+    plt.tight_layout()
+    acc_mat_path = os.path.join(vis_dir, "cross_eval_acc_mat" + args.plot_format)
+    plt.savefig(acc_mat_path, transparent=True, dpi=300)
+    plt.close(fig)
 
-    # plot the confusion matrix
-    fig, axes = plt.subplots(1, 2, figsize=(15, 6))
-    categories = ["AEC", "LYM", "OC"]
+    # plot the confusion matrices of all cross-cohort pairs
+    pair_keys = [key for key in conf_mats if key[0] != key[1]]
+    col_num = len(cohorts)
+    row_num = int(math.ceil(len(pair_keys) * 1.0 / col_num))
+    fig, axes = plt.subplots(row_num, col_num, figsize=(7.5 * col_num, 6 * row_num), squeeze=False)
     sns.set(font_scale=1.8)
-    sns.heatmap(nyu_conf_mat, annot=True, annot_kws={"size": 20}, fmt="d", cmap="Blues", xticklabels=categories, yticklabels=categories, ax=axes[0])
-    axes[0].set_title("Japan model on USA cells - Acc:{:.3f}".format(nyu_acc), fontsize=16)
-    sns.heatmap(japan_conf_mat, annot=True, annot_kws={"size": 20}, fmt="d", cmap="Blues", xticklabels=categories,yticklabels=categories, ax=axes[1])
-    axes[1].set_title("USA model on Japan cells - Acc:{:.3f}".format(japan_acc), fontsize=16)
-    # fig.suptitle("Cell Classifier Cross-Cohort Evaluation")
-
+    for ax, (model_name, test_cohort) in zip(axes.ravel(), pair_keys):
+        sns.heatmap(conf_mats[(model_name, test_cohort)], annot=True, annot_kws={"size": 20}, fmt="d", cmap="Blues",
+                    xticklabels=CELL_CATEGORIES, yticklabels=CELL_CATEGORIES, ax=ax)
+        ax.set_title("{} model on {} cells - Acc:{:.3f}".format(model_name, test_cohort, acc_df.loc[model_name, test_cohort]), fontsize=16)
+    for ax in axes.ravel()[len(pair_keys):]:
+        ax.axis("off")
     conf_mat_path = os.path.join(vis_dir, "cross_eval_conf_mat" + args.plot_format)
-    plt.savefig(conf_mat_path, transparent=True, dpi=300) 
\ No newline at end of file
+    plt.savefig(conf_mat_path, transparent=True, dpi=300)
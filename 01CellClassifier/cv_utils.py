@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+import os, sys
+import json, pickle
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from sklearn.base import clone
+from sklearn.metrics import accuracy_score, confusion_matrix
+from sklearn.model_selection import StratifiedKFold
+
+
+CELL_CATEGORIES = ["AEC", "LYM", "OC"]
+CELL_FEA_NAMES = ["Area", "Intensity", "Roundness"]
+
+
+def load_cell_features(cell_fea_path, source=None):
+    # annotated cell features with integer classes AEC-0, LYM-1, OC-2
+    cell_fea_df = pd.read_csv(cell_fea_path)
+    cell_fea_df["Class"] = cell_fea_df["Label"].map({name: ind for ind, name in enumerate(CELL_CATEGORIES)})
+    if source is not None:
+        cell_fea_df["Sources"] = source
+    return cell_fea_df
+
+
+def cell_fea_matrix(cell_fea_df):
+    X = cell_fea_df[CELL_FEA_NAMES].to_numpy().astype(np.float64)
+    y = cell_fea_df["Class"].to_numpy().astype(np.int64)
+    return X, y
+
+
+def load_model_params(model_param_path):
+    # XGBClassifier keyword arguments, e.g. written by tune_cell_classifier.py
+    if model_param_path is None:
+        return {}
+    if not os.path.exists(model_param_path):
+        sys.exit("{} not exist.".format(model_param_path))
+    with open(model_param_path) as fp:
+        return json.load(fp)
+
+
+def fit_fold(clf, X, y, train_inds, test_inds, fold_threads):
+    fold_clf = clone(clf)
+    if "n_jobs" in fold_clf.get_params():
+        fold_clf.set_params(n_jobs=fold_threads)
+    fold_clf.fit(X[train_inds], y[train_inds])
+    return fold_clf, fold_clf.predict(X[test_inds]), fold_clf.predict_proba(X[test_inds])
+
+
+def resolve_n_jobs(n_jobs):
+    # joblib semantics: -1 all cores, -2 all but one, ...
+    if n_jobs == 0:
+        sys.exit("n_jobs should be a positive count or negative as in joblib, not 0")
+    cpu_num = os.cpu_count() or 1
+    return n_jobs if n_jobs > 0 else max(1, cpu_num + 1 + n_jobs)
+
+
+def cross_validate_clf(clf, X, y, cv=5, n_jobs=-1):
+    # every fold trained once, folds run in parallel and share the cores
+    folds = list(StratifiedKFold(n_splits=cv).split(X, y))
+    cpu_num = os.cpu_count() or 1
+    fold_jobs = min(len(folds), resolve_n_jobs(n_jobs))
+    fold_threads = max(1, cpu_num // fold_jobs)
+    fold_results = Parallel(n_jobs=fold_jobs)(delayed(fit_fold)(clf, X, y, train_inds, test_inds, fold_threads)
+                                              for train_inds, test_inds in folds)
+
+    class_num = len(np.unique(y))
+    y_pred = np.zeros(len(y), dtype=np.int64)
+    y_proba = np.zeros((len(y), class_num), dtype=np.float64)
+    scores, fold_models = [], []
+    for (train_inds, test_inds), (fold_clf, fold_pred, fold_proba) in zip(folds, fold_results):
+        y_pred[test_inds] = fold_pred
+        y_proba[test_inds] = fold_proba
+        scores.append(accuracy_score(y[test_inds], fold_pred))
+        fold_models.append(fold_clf)
+
+    cv_result = {
+        "scores": np.array(scores),
+        "y_true": y,
+        "y_pred": y_pred,
+        "y_proba": y_proba,
+        "folds": folds,
+        "fold_models": fold_models,
+        "conf_mat": confusion_matrix(y, y_pred),
+    }
+    return cv_result
+
+
+def save_cv_result(cv_result, cv_result_path):
+    with open(cv_result_path, "wb") as fp:
+        pickle.dump(cv_result, fp)
+
+
+def load_cv_result(cv_result_path):
+    if not os.path.exists(cv_result_path):
+        sys.exit("{} not exist, run cross-validation first.".format(cv_result_path))
+    with open(cv_result_path, "rb") as fp:
+        return pickle.load(fp)
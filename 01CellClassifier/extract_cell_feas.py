@@ -8,7 +8,10 @@ from skimage import io
 import cv2
 import pandas as pd
 
-from seg_utils import bounding_box
+from seg_utils import bounding_box, find_roi_seg, load_roi_segs, CellIndex
+from crop_utils import CropStoreWriter
+from fea_utils import cell_features, BASE_FEA_NAMES, CELL_FEA_NAMES
+from labelme_utils import index_labelme_dir
 
 
 def set_args():
@@ -18,6 +21,8 @@ def set_args():
     parser.add_argument("--roi_img_dir",      type=str,       default="MacenkoROIs")
     parser.add_argument("--roi_seg_dir",      type=str,       default="RegionSegs")
     parser.add_argument("--dataset",          type=str,       default="Japan", choices=["Japan", "USA"]) 
+    parser.add_argument("--crop_format",      type=str,       default="packed", choices=["packed", "png"])
+    parser.add_argument("--extended_feas",    action="store_true", help="full CELL_FEA_NAMES table instead of Area / Intensity / Roundness")
 
     args = parser.parse_args()
     return args
@@ -35,9 +40,13 @@ if __name__ == "__main__":
         shutil.rmtree(cell_fea_dir)
     os.makedirs(cell_fea_dir)
 
-    # collect cell annotations
-    roi_list = sorted([os.path.splitext(ele)[0] for ele in os.listdir(annotation_dir) if ele.endswith(".json")])
-    cell_labels, cell_areas, cell_intensities, cell_circularities = [], [], [], []
+    # collect cell annotations from the cached index
+    anno_file_df, anno_point_df = index_labelme_dir(annotation_dir, os.path.join(data_root, "AnnotationIndex.pkl"))
+    roi_list = anno_file_df["ROI"].tolist()
+    roi_point_dfs = dict(list(anno_point_df.groupby("ROI", sort=False)))
+    cell_fea_dfs = []
+    # masked cell crops packed into one file with an offset index
+    crop_writer = CropStoreWriter(cell_fea_dir) if args.crop_format == "packed" else None
 
     for ind, cur_roi in enumerate(roi_list):
         # print("Extract {}/{} annotation on {}".format(ind+1, len(roi_list), cur_roi))
@@ -45,44 +54,45 @@ if __name__ == "__main__":
         if not os.path.exists(roi_img_path):
             sys.exit("{} do not have image.".format(cur_roi))
         roi_img = io.imread(roi_img_path)
-        roi_seg_mask = np.zeros((roi_img.shape[0], roi_img.shape[1]), dtype = np.uint16)
+        roi_seg_mask = None
         # load HoVer-Net reference
-        roi_seg_path = os.path.join(roi_seg_dir, cur_roi + ".json")
+        roi_seg_path = find_roi_seg(roi_seg_dir, cur_roi)
         if not os.path.exists(roi_seg_path):
             sys.exit("{} do not have segmentation.".format(cur_roi))
-        cell_reference_dict = {}
-        with open(roi_seg_path, 'r') as fp:
-            cell_reference_dict = json.load(fp)
-        cell_keys = [key for key in cell_reference_dict]
-        cell_label_dict = {}
-        for ind, key in enumerate(cell_keys):
-            cur_cell_dict = cell_reference_dict[key]
-            cur_cell_phenotype = cur_cell_dict["type"]
-            cell_val = int(key)
-            cell_label_dict[cell_val] = cur_cell_phenotype
-            cell_cnt = np.asarray(cur_cell_dict["contour"])
-            cell_cnt = np.expand_dims(cell_cnt, axis=1)
-            cv2.drawContours(roi_seg_mask, contours=[cell_cnt, ], contourIdx=0, color=cell_val, thickness=-1)
+        roi_segs = load_roi_segs(roi_seg_path)
+        cell_keys = roi_segs.ids.tolist()
+        cell_cnts = roi_segs.contours()
+        # spatial index over cell bounding boxes, masks are only rendered around looked-up cells
+        cell_index = CellIndex(cell_cnts)
         # load annotations
-        cell_annotation_path = os.path.join(annotation_dir, cur_roi + ".json")
-        cell_annotation_dict = None
-        with open(cell_annotation_path) as fp:
-            cell_annotation_dict = json.load(fp)
-        cell_lst = cell_annotation_dict["shapes"]
-        for ind, cur_cell in enumerate(cell_lst):
-            cell_label = cur_cell["label"]
-            cur_points = cur_cell["points"][0]
-            point_h = int(math.floor(cur_points[1] + 0.5))
-            point_w = int(math.floor(cur_points[0] + 0.5))
-            point_val = roi_seg_mask[point_h, point_w]
+        roi_point_df = roi_point_dfs.get(cur_roi, anno_point_df.iloc[:0])
+        roi_cell_labels, roi_cell_cnts = [], []
+        for cell_label, point_x, point_y in zip(roi_point_df["Label"], roi_point_df["X"], roi_point_df["Y"]):
+            point_h = int(math.floor(point_y + 0.5))
+            point_w = int(math.floor(point_x + 0.5))
+            cell_ind = cell_index.locate(point_w, point_h)
             # get mask
-            inst_map = np.array(roi_seg_mask == point_val, np.uint8)
+            if cell_ind >= 0:
+                # window of the cell bounding box with margin, overlapping cells drawn in the same order
+                box_x1, box_y1, box_x2, box_y2 = cell_index.bboxes[cell_ind]
+                win_x1, win_y1 = max(box_x1 - 2, 0), max(box_y1 - 2, 0)
+                win_x2, win_y2 = min(box_x2 + 2, roi_img.shape[1]), min(box_y2 + 2, roi_img.shape[0])
+                inst_map = np.array(cell_index.render(win_x1, win_y1, win_x2, win_y2) == cell_ind + 1, np.uint8)
+            else:
+                # point on background, the full ROI mask is needed
+                if roi_seg_mask is None:
+                    roi_seg_mask = np.zeros((roi_img.shape[0], roi_img.shape[1]), dtype = np.uint16)
+                    for key, cell_cnt in zip(cell_keys, cell_cnts):
+                        cv2.drawContours(roi_seg_mask, contours=[cell_cnt, ], contourIdx=0, color=int(key), thickness=-1)
+                win_x1, win_y1 = 0, 0
+                inst_map = np.array(roi_seg_mask == 0, np.uint8)
             y1, y2, x1, x2  = bounding_box(inst_map)
+            y1, y2, x1, x2 = y1 + win_y1, y2 + win_y1, x1 + win_x1, x2 + win_x1
             y1 = y1 - 2 if y1 - 2 >= 0 else y1
             x1 = x1 - 2 if x1 - 2 >= 0 else x1
-            x2 = x2 + 2 if x2 + 2 <= roi_seg_mask.shape[1] - 1 else x2
-            y2 = y2 + 2 if y2 + 2 <= roi_seg_mask.shape[0] - 1 else y2
-            inst_cell_crop = inst_map[y1:y2, x1:x2]
+            x2 = x2 + 2 if x2 + 2 <= roi_img.shape[1] - 1 else x2
+            y2 = y2 + 2 if y2 + 2 <= roi_img.shape[0] - 1 else y2
+            inst_cell_crop = inst_map[y1-win_y1:y2-win_y1, x1-win_x1:x2-win_x1]
             cell_mask = np.zeros((inst_cell_crop.shape[0], inst_cell_crop.shape[1], 3), dtype=np.uint8)
             contours, hierarchy = cv2.findContours(inst_cell_crop, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
             contours = sorted(contours, key=lambda x: cv2.contourArea(x), reverse=True)
@@ -90,27 +100,28 @@ if __name__ == "__main__":
             cv2.drawContours(cell_mask, contours=[cell_cnt, ], contourIdx=0, color=(1, 1, 1), thickness=-1)
             cell_img = roi_img[y1:y2, x1:x2]
             mask_cell_img = cell_img * cell_mask
-            cur_cell_type_dir = os.path.join(cell_fea_dir, cell_label)
-            if not os.path.exists(cur_cell_type_dir):
-                os.makedirs(cur_cell_type_dir)
-            cur_cell_type_name = cur_roi + "-X" + str(point_w) + "-Y" + str(point_h)
-            cur_cell_type_path = os.path.join(cur_cell_type_dir, cur_cell_type_name + ".png")
-            io.imsave(cur_cell_type_path, mask_cell_img)
+            if crop_writer is not None:
+                crop_writer.add(mask_cell_img, cur_roi, cell_label, point_w, point_h, (y1, y2, x1, x2))
+            else:
+                cur_cell_type_dir = os.path.join(cell_fea_dir, cell_label)
+                if not os.path.exists(cur_cell_type_dir):
+                    os.makedirs(cur_cell_type_dir)
+                cur_cell_type_name = cur_roi + "-X" + str(point_w) + "-Y" + str(point_h)
+                cur_cell_type_path = os.path.join(cur_cell_type_dir, cur_cell_type_name + ".png")
+                io.imsave(cur_cell_type_path, mask_cell_img)
 
-            # cell features
-            cell_area = cv2.contourArea(cell_cnt)
-            cell_intensity = np.mean(cv2.mean(cell_img, mask=cell_mask[:,:,0])[:3])
-            # Roundness
-            cnt_perimeter = cv2.arcLength(cell_cnt, True)
-            cell_circularity = 4 * 3.14 * cell_area / (cnt_perimeter * cnt_perimeter)
-            # add features
-            cell_labels.append(cell_label)
-            cell_areas.append(cell_area)
-            cell_intensities.append(cell_intensity)
-            cell_circularities.append(cell_circularity)
+            # cell contour in ROI coordinates
+            roi_cell_labels.append(cell_label)
+            roi_cell_cnts.append(cell_cnt + np.array([x1, y1], dtype=cell_cnt.dtype))
 
-    cell_fea_df = pd.DataFrame(list(zip(cell_labels, cell_areas, cell_intensities, cell_circularities)),
-        columns =["Label", "Area", "Intensity", "Roundness"])
+        # cell features of all annotated cells in the ROI
+        roi_fea_df = cell_features(roi_img, roi_cell_cnts, fea_names=CELL_FEA_NAMES if args.extended_feas else BASE_FEA_NAMES)
+        roi_fea_df.insert(0, "Label", roi_cell_labels)
+        cell_fea_dfs.append(roi_fea_df)
+
+    if crop_writer is not None:
+        crop_writer.close()
+    cell_fea_df = pd.concat(cell_fea_dfs, ignore_index=True)
     cell_fea_path = os.path.join(cell_fea_dir, "cell_feas.csv")
     cell_fea_df.to_csv(cell_fea_path, index=False)
     
\ No newline at end of file
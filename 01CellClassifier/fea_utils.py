@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+
+import os, sys
+import numpy as np
+import pandas as pd
+from skimage import color
+import cv2
+
+
+def to_cell_cnts(contour_lists):
+    # nested [[x, y], ...] lists to opencv int32 contours
+    return [np.expand_dims(np.asarray(cnt, dtype=np.int32), axis=1) for cnt in contour_lists]
+
+
+def draw_label_map(cell_cnts, shape):
+    # cell index + 1 per pixel, later cells are drawn over earlier ones
+    label_map = np.zeros(shape[:2], dtype=np.int32)
+    for ind, cell_cnt in enumerate(cell_cnts):
+        cv2.drawContours(label_map, contours=[cell_cnt, ], contourIdx=0, color=ind + 1, thickness=-1)
+    return label_map
+
+
+def ragged_points(cell_cnts):
+    # contours to (offsets, (N, 2) int64 points), points of contour i are points[offsets[i]:offsets[i+1]]
+    offsets = np.concatenate([[0, ], np.cumsum([len(cnt) for cnt in cell_cnts])]).astype(np.int64)
+    if offsets[-1] == 0:
+        return offsets, np.zeros((0, 2), dtype=np.int64)
+    return offsets, np.concatenate([np.asarray(cnt).reshape(-1, 2) for cnt in cell_cnts]).astype(np.int64)
+
+
+def contour_bboxes(offsets, points):
+    # cv2.boundingRect (x, y, w, h) of every contour, zeros for empty ones
+    bboxes = np.zeros((len(offsets) - 1, 4), dtype=np.int64)
+    filled = np.flatnonzero(np.diff(offsets) > 0)
+    if len(filled) > 0:
+        starts = offsets[filled]
+        pt_min, pt_max = np.minimum.reduceat(points, starts, axis=0), np.maximum.reduceat(points, starts, axis=0)
+        bboxes[filled, :2], bboxes[filled, 2:] = pt_min, pt_max - pt_min + 1
+    return bboxes
+
+
+def polygon_measures(offsets, points):
+    # cv2.contourArea and closed cv2.arcLength of every contour at once, each point paired with its predecessor
+    areas, perimeters = np.zeros(len(offsets) - 1), np.zeros(len(offsets) - 1)
+    filled = np.flatnonzero(np.diff(offsets) > 0)
+    if len(filled) == 0:
+        return areas, perimeters
+    starts, ends = offsets[filled], offsets[filled + 1]
+    prev_pts = np.empty_like(points)
+    prev_pts[1:] = points[:-1]
+    prev_pts[starts] = points[ends - 1]
+    # shoelace terms are exact integers, so are their sums
+    cross = prev_pts[:, 0] * points[:, 1] - prev_pts[:, 1] * points[:, 0]
+    areas[filled] = np.abs(np.add.reduceat(cross, starts)) * 0.5
+    # segment lengths in float32 as opencv does, their float64 sums are exact
+    steps = (points - prev_pts).astype(np.float32)
+    seg_lens = np.sqrt(steps[:, 0] * steps[:, 0] + steps[:, 1] * steps[:, 1])
+    perimeters[filled] = np.add.reduceat(seg_lens, starts, dtype=np.float64)
+    return areas, perimeters
+
+
+def mask_runs(mask, x=0, y=0):
+    # horizontal runs of equal nonzero values: (value, row, first column, length), offset by (x, y)
+    mask_h, mask_w = mask.shape
+    flat_vals = mask.ravel()
+    starts = np.ones(len(flat_vals), dtype=bool)
+    starts[1:] = flat_vals[1:] != flat_vals[:-1]
+    starts[::mask_w] = True
+    starts = np.flatnonzero(starts)
+    run_lens = np.diff(np.append(starts, len(flat_vals)))
+    run_vals = flat_vals[starts]
+    filled = run_vals != 0
+    starts = starts[filled]
+    return run_vals[filled], starts // mask_w + y, starts % mask_w + x, run_lens[filled]
+
+
+def cell_runs(cell_cnts, shape, label_map=None, bboxes=None, offsets=None, points=None):
+    # raster runs (cell index, row, first column, length) of every filled contour inside the image, grouped by cell,
+    # each contour is filled in its own box so cells sharing pixels all keep them
+    img_h, img_w = shape[:2]
+    if label_map is not None:
+        # pixels as assigned by the given instance map
+        run_vals, run_rows, run_cols, run_lens = mask_runs(label_map)
+        runs = [(run_vals.astype(np.int64) - 1, run_rows, run_cols, run_lens)]
+    else:
+        if offsets is None:
+            offsets, points = ragged_points(cell_cnts)
+        points = np.asarray(points, dtype=np.int64).reshape(-1, 2)
+        if bboxes is None:
+            bboxes = contour_bboxes(offsets, points)
+        box_x, box_y, box_w, box_h = bboxes.T
+        # boxes of similar width stacked into one canvas, at most twice the pixels of the boxes
+        canvas_ws = 2 ** np.ceil(np.log2(np.maximum(box_w, 1))).astype(np.int64)
+        canvas_ws[box_w == 0] = 0
+        cnt_lens = np.diff(offsets)
+        pt_cells = np.repeat(np.arange(len(cnt_lens)), cnt_lens)
+        runs = []
+        for canvas_w in np.unique(canvas_ws[canvas_ws > 0]):
+            inds = np.flatnonzero(canvas_ws == canvas_w)
+            row_starts = np.cumsum(box_h[inds]) - box_h[inds]
+            canvas = np.zeros((int(box_h[inds].sum()), int(canvas_w)), dtype=np.uint8)
+            # every canvas row belongs to a single contour, one fill draws them all exactly as drawContours one by one
+            box_pts = cnt_lens[inds]
+            pt_shifts = np.repeat(np.stack([-box_x[inds], row_starts - box_y[inds]], axis=1), box_pts, axis=0)
+            canvas_pts = (points[(canvas_ws == canvas_w)[pt_cells]] + pt_shifts).astype(np.int32).reshape(-1, 1, 2)
+            pt_ends = np.cumsum(box_pts).tolist()
+            canvas_cnts = [canvas_pts[pt_end - pt_num:pt_end] for pt_end, pt_num in zip(pt_ends, box_pts.tolist())]
+            cv2.fillPoly(canvas, pts=canvas_cnts, color=1)
+            _, rows, cols, lens = mask_runs(canvas)
+            row_inds = np.repeat(np.arange(len(inds)), box_h[inds])[rows]
+            run_cells = inds[row_inds]
+            runs.append((run_cells, rows - row_starts[row_inds] + box_y[run_cells], cols + box_x[run_cells], lens))
+    if len(runs) == 0:
+        return [np.zeros(0, dtype=np.int64) for _ in range(4)]
+    run_cells, run_rows, run_cols, run_lens = [np.concatenate(ele).astype(np.int64) for ele in zip(*runs)]
+    # cut at the image border
+    run_ends = np.minimum(run_cols + run_lens, img_w)
+    run_cols = np.maximum(run_cols, 0)
+    inside = (run_rows >= 0) & (run_rows < img_h) & (run_ends > run_cols)
+    run_order = np.flatnonzero(inside)
+    run_order = run_order[np.argsort(run_cells[run_order], kind="stable")]
+    return run_cells[run_order], run_rows[run_order], run_cols[run_order], (run_ends - run_cols)[run_order]
+
+
+def run_pixels(run_rows, run_cols, run_lens, img_w):
+    # flat pixel indices covered by the runs, in run order
+    run_offsets = np.cumsum(run_lens) - run_lens
+    return np.repeat(run_rows * img_w + run_cols - run_offsets, run_lens) + np.arange(run_lens.sum())
+
+
+def contour_hull_areas(cell_cnts):
+    # cv2.contourArea of the convex hull of every contour, zeros for empty ones
+    return np.array([cv2.contourArea(cv2.convexHull(cnt)) if len(cnt) > 0 else 0.0 for cnt in cell_cnts], dtype=np.float64)
+
+
+# skimage rgb2hed of uint8 pixels by table lookup, optical density of each input channel times its stain matrix row
+HED_LUTS = np.ascontiguousarray(((np.log(np.maximum(np.arange(256) * (1.0 / 255), 1e-6)) / np.log(1e-6))[:, None, None]
+                                 * color.hed_from_rgb[None, :, :]).transpose(2, 1, 0))
+
+
+def pixel_sums(img_planes, cell_num, run_cells, run_rows, run_cols, run_lens, bboxes, sum_groups=()):
+    # per cell pixel count and RGB sums, square sums, H/E, texture and raw moments in cell box coordinates
+    # only for the sum_groups asked for
+    pix_inds = run_pixels(run_rows, run_cols, run_lens, img_planes["R"].shape[1])
+    # the runs come grouped by cell, so are the pixels
+    pix_counts = np.bincount(run_cells, weights=run_lens, minlength=cell_num)
+    filled = np.flatnonzero(pix_counts > 0)
+    cell_starts = (np.cumsum(pix_counts) - pix_counts)[filled].astype(np.int64)
+
+    def cell_sums(pix_vals):
+        sums = np.zeros(cell_num, dtype=np.float64)
+        if len(filled) > 0:
+            sums[filled] = np.add.reduceat(pix_vals, cell_starts, dtype=np.float64)
+        return sums
+
+    def run_sums(run_vals):
+        return np.bincount(run_cells, weights=run_vals, minlength=cell_num)
+
+    sum_dict = {"Count": pix_counts}
+    # integer pixels and filter responses, squares come separately so their sums stay exact
+    rgb_pixs = [np.take(img_planes[ch_name].ravel(), pix_inds) for ch_name in ["R", "G", "B"]]
+    for ch_name, ch_pixs in zip(["R", "G", "B"], rgb_pixs):
+        sum_dict[ch_name] = cell_sums(ch_pixs)
+        if "RGB2" in sum_groups:
+            ch_pixs = ch_pixs.astype(np.int32)
+            sum_dict[ch_name + "2"] = cell_sums(ch_pixs * ch_pixs)
+    for stain_ind, stain_name in enumerate(["H", "E"] if "HED" in sum_groups else []):
+        stain_luts = HED_LUTS[stain_ind]
+        stain_pixs = np.take(stain_luts[0], rgb_pixs[0])
+        stain_pixs += np.take(stain_luts[1], rgb_pixs[1])
+        stain_pixs += np.take(stain_luts[2], rgb_pixs[2])
+        np.maximum(stain_pixs, 0, out=stain_pixs)
+        sum_dict[stain_name], sum_dict[stain_name + "2"] = cell_sums(stain_pixs), cell_sums(stain_pixs * stain_pixs)
+    if "Texture" in sum_groups:
+        grad_x = np.take(img_planes["GradX"].ravel(), pix_inds).astype(np.int32)
+        grad_y = np.take(img_planes["GradY"].ravel(), pix_inds).astype(np.int32)
+        grad_sqs = grad_x * grad_x + grad_y * grad_y
+        sum_dict["Grad"], sum_dict["Grad2"] = cell_sums(np.sqrt(grad_sqs)), cell_sums(grad_sqs)
+        lap_pixs = np.take(img_planes["Lap"].ravel(), pix_inds).astype(np.int32)
+        sum_dict["Lap"], sum_dict["Lap2"] = cell_sums(lap_pixs), cell_sums(lap_pixs * lap_pixs)
+    if "Moments" not in sum_groups:
+        return sum_dict
+    # moments in closed form per run
+    run_x = (run_cols - bboxes[run_cells, 0]).astype(np.float64)
+    run_y = (run_rows - bboxes[run_cells, 1]).astype(np.float64)
+    run_n = run_lens.astype(np.float64)
+    sum_dict["X"] = run_sums(run_n * run_x + run_n * (run_n - 1) / 2)
+    sum_dict["XX"] = run_sums(run_n * run_x * run_x + run_x * run_n * (run_n - 1) + (run_n - 1) * run_n * (2 * run_n - 1) / 6)
+    sum_dict["Y"] = run_sums(run_n * run_y)
+    sum_dict["YY"] = run_sums(run_n * run_y * run_y)
+    sum_dict["XY"] = run_sums(run_y * (run_n * run_x + run_n * (run_n - 1) / 2))
+    return sum_dict
+
+
+# the three columns the cell classifier uses, the extended table on request only
+BASE_FEA_NAMES = ["Area", "Intensity", "Roundness"]
+CELL_FEA_NAMES = ["Area", "Intensity", "Roundness", "Perimeter", "HullArea", "Solidity", "PixelArea",
+                  "CentroidX", "CentroidY", "MajorAxis", "MinorAxis", "Eccentricity", "Orientation",
+                  "Nu20", "Nu11", "Nu02", "Hu1", "Hu2", "MeanR", "StdR", "MeanG", "StdG", "MeanB", "StdB",
+                  "HematoxylinMean", "HematoxylinStd", "EosinMean", "EosinStd", "GradientMean", "GradientStd", "LaplacianStd"]
+# pixel sums beyond the counts and RGB sums, gathered only when one of their features is asked for
+FEA_SUM_GROUPS = {
+    "RGB2": ["StdR", "StdG", "StdB"],
+    "HED": ["HematoxylinMean", "HematoxylinStd", "EosinMean", "EosinStd"],
+    "Texture": ["GradientMean", "GradientStd", "LaplacianStd"],
+    "Moments": ["CentroidX", "CentroidY", "MajorAxis", "MinorAxis", "Eccentricity", "Orientation",
+                "Nu20", "Nu11", "Nu02", "Hu1", "Hu2"],
+}
+
+
+def cell_features(roi_img, cell_cnts, label_map=None, offsets=None, points=None, batch_size=4096, fea_names=BASE_FEA_NAMES):
+    # one row per contour, pixel sums gathered over the runs of batch_size cells at a time, bounded memory on large ROIs
+    fea_names = list(fea_names)
+    unknown_names = [ele for ele in fea_names if ele not in CELL_FEA_NAMES]
+    if len(unknown_names) > 0:
+        sys.exit("Unknown cell features: {}".format(unknown_names))
+    sum_groups = set([group for group, names in FEA_SUM_GROUPS.items() if any([ele in fea_names for ele in names])])
+    cell_num = len(cell_cnts)
+    if cell_num == 0:
+        return pd.DataFrame({name: np.zeros(0, dtype=np.float64) for name in fea_names})
+    rgb_img = np.ascontiguousarray(roi_img[..., :3])
+    if offsets is None:
+        offsets, points = ragged_points(cell_cnts)
+    points = np.asarray(points, dtype=np.int64).reshape(-1, 2)
+    bboxes = contour_bboxes(offsets, points)
+    img_planes = dict(zip(["R", "G", "B"], cv2.split(rgb_img)))
+    if "Texture" in sum_groups:
+        # texture from integer filter responses, every sum is exact and repeatable
+        gray_img = cv2.cvtColor(rgb_img, cv2.COLOR_RGB2GRAY)
+        img_planes["GradX"], img_planes["GradY"] = cv2.Sobel(gray_img, cv2.CV_16S, 1, 0), cv2.Sobel(gray_img, cv2.CV_16S, 0, 1)
+        img_planes["Lap"] = cv2.Laplacian(gray_img, cv2.CV_16S)
+    if label_map is not None:
+        label_runs = cell_runs(cell_cnts, rgb_img.shape, label_map)
+    sum_dict = {}
+    for batch_start in range(0, cell_num, batch_size):
+        batch_end = min(batch_start + batch_size, cell_num)
+        if label_map is not None:
+            run_start, run_end = np.searchsorted(label_runs[0], [batch_start, batch_end])
+            run_cells, run_rows, run_cols, run_lens = [ele[run_start:run_end] for ele in label_runs]
+            run_cells = run_cells - batch_start
+        else:
+            pt_start, pt_end = offsets[batch_start], offsets[batch_end]
+            run_cells, run_rows, run_cols, run_lens = cell_runs(cell_cnts[batch_start:batch_end], rgb_img.shape,
+                bboxes=bboxes[batch_start:batch_end], offsets=offsets[batch_start:batch_end + 1] - pt_start, points=points[pt_start:pt_end])
+        batch_sums = pixel_sums(img_planes, batch_end - batch_start, run_cells, run_rows, run_cols, run_lens,
+                                bboxes[batch_start:batch_end], sum_groups)
+        for sum_name, sum_vals in batch_sums.items():
+            sum_dict.setdefault(sum_name, np.zeros(cell_num, dtype=np.float64))[batch_start:batch_end] = sum_vals
+
+    fea_dict = {}
+    with np.errstate(divide="ignore", invalid="ignore"):
+        pix_counts = sum_dict["Count"]
+        inv_counts = 1.0 / pix_counts
+
+        def mean_std(sum_name):
+            means = sum_dict[sum_name] * inv_counts
+            sq_means = sum_dict[sum_name + "2"] * inv_counts
+            return means, np.sqrt(np.maximum(sq_means - means * means, 0.0))
+
+        # shape
+        cell_areas, cell_perimeters = polygon_measures(offsets, points)
+        for ch_name in ["R", "G", "B"]:
+            if "RGB2" in sum_groups:
+                fea_dict["Mean" + ch_name], fea_dict["Std" + ch_name] = mean_std(ch_name)
+            else:
+                fea_dict["Mean" + ch_name] = sum_dict[ch_name] * inv_counts
+        # same definitions as the original Area / Intensity / Roundness columns
+        fea_dict["Area"] = cell_areas
+        fea_dict["Intensity"] = (fea_dict["MeanR"] + fea_dict["MeanG"] + fea_dict["MeanB"]) / 3
+        fea_dict["Roundness"] = 4 * 3.14 * cell_areas / (cell_perimeters * cell_perimeters)
+        fea_dict["Perimeter"] = cell_perimeters
+        if "HullArea" in fea_names or "Solidity" in fea_names:
+            fea_dict["HullArea"] = contour_hull_areas(cell_cnts)
+            fea_dict["Solidity"] = cell_areas / fea_dict["HullArea"]
+        fea_dict["PixelArea"] = pix_counts
+        if "Moments" in sum_groups:
+            # central moments of the filled pixels
+            loc_x, loc_y = sum_dict["X"] * inv_counts, sum_dict["Y"] * inv_counts
+            mu20 = sum_dict["XX"] * inv_counts - loc_x * loc_x
+            mu02 = sum_dict["YY"] * inv_counts - loc_y * loc_y
+            mu11 = sum_dict["XY"] * inv_counts - loc_x * loc_y
+            eig_common = np.sqrt(((mu20 - mu02) / 2) ** 2 + mu11 ** 2)
+            eig_major, eig_minor = (mu20 + mu02) / 2 + eig_common, np.maximum((mu20 + mu02) / 2 - eig_common, 0.0)
+            fea_dict["CentroidX"], fea_dict["CentroidY"] = bboxes[:, 0] + loc_x, bboxes[:, 1] + loc_y
+            fea_dict["MajorAxis"], fea_dict["MinorAxis"] = 4 * np.sqrt(eig_major), 4 * np.sqrt(eig_minor)
+            fea_dict["Eccentricity"] = np.sqrt(1 - eig_minor / eig_major)
+            fea_dict["Orientation"] = 0.5 * np.arctan2(2 * mu11, mu20 - mu02)
+            fea_dict["Nu20"], fea_dict["Nu11"], fea_dict["Nu02"] = mu20 * inv_counts, mu11 * inv_counts, mu02 * inv_counts
+            fea_dict["Hu1"] = fea_dict["Nu20"] + fea_dict["Nu02"]
+            fea_dict["Hu2"] = (fea_dict["Nu20"] - fea_dict["Nu02"]) ** 2 + 4 * fea_dict["Nu11"] ** 2
+        if "HED" in sum_groups:
+            # color deconvolved hematoxylin & eosin
+            fea_dict["HematoxylinMean"], fea_dict["HematoxylinStd"] = mean_std("H")
+            fea_dict["EosinMean"], fea_dict["EosinStd"] = mean_std("E")
+        if "Texture" in sum_groups:
+            fea_dict["GradientMean"], fea_dict["GradientStd"] = mean_std("Grad")
+            fea_dict["LaplacianStd"] = mean_std("Lap")[1]
+
+    return pd.DataFrame({name: fea_dict[name] for name in fea_names})
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+import os, sys
+import json, hashlib, pickle
+import pandas as pd
+
+
+INDEX_FILE_COLUMNS = ["ROI", "MTime", "Size", "SHA1"]
+INDEX_POINT_COLUMNS = ["ROI", "Label", "X", "Y", "ShapeType", "PointNum"]
+
+
+def file_sha1(file_path):
+    sha1 = hashlib.sha1()
+    with open(file_path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def parse_labelme_points(annotation_path, roi_name):
+    # one row per shape, located by its first point
+    with open(annotation_path) as fp:
+        anno_dict = json.load(fp)
+    point_rows = []
+    for cur_shape in anno_dict["shapes"]:
+        cur_points = cur_shape["points"]
+        point_rows.append([roi_name, cur_shape["label"], cur_points[0][0], cur_points[0][1],
+                           cur_shape.get("shape_type", "point"), len(cur_points)])
+    return point_rows
+
+
+def load_labelme_index(index_path):
+    if not os.path.exists(index_path):
+        return pd.DataFrame(columns=INDEX_FILE_COLUMNS), pd.DataFrame(columns=INDEX_POINT_COLUMNS)
+    with open(index_path, "rb") as fp:
+        index_dict = pickle.load(fp)
+    return index_dict["files"], index_dict["points"]
+
+
+def index_labelme_dir(annotation_dir, index_path):
+    # table of annotated points, only new or changed json files are parsed again
+    file_df, point_df = load_labelme_index(index_path)
+    cached_files = {row.ROI: row for row in file_df.itertuples(index=False)}
+    roi_list = sorted([os.path.splitext(ele)[0] for ele in os.listdir(annotation_dir) if ele.endswith(".json")])
+    file_rows, keep_rois, new_rows = [], [], []
+    index_changed = set(cached_files.keys()) != set(roi_list)
+    for roi_name in roi_list:
+        annotation_path = os.path.join(annotation_dir, roi_name + ".json")
+        file_stat = os.stat(annotation_path)
+        cached = cached_files.get(roi_name, None)
+        if cached is not None and cached.MTime == file_stat.st_mtime and cached.Size == file_stat.st_size:
+            file_rows.append(list(cached))
+            keep_rois.append(roi_name)
+            continue
+        index_changed = True
+        sha1 = file_sha1(annotation_path)
+        file_rows.append([roi_name, file_stat.st_mtime, file_stat.st_size, sha1])
+        if cached is not None and cached.SHA1 == sha1:
+            # touched but unchanged
+            keep_rois.append(roi_name)
+        else:
+            new_rows.extend(parse_labelme_points(annotation_path, roi_name))
+
+    point_df = pd.concat([point_df[point_df["ROI"].isin(keep_rois)], pd.DataFrame(new_rows, columns=INDEX_POINT_COLUMNS)])
+    point_df = point_df.astype({"X": float, "Y": float, "PointNum": int})
+    # stable sort keeps the shape order inside each file
+    point_df = point_df.sort_values("ROI", kind="mergesort").reset_index(drop=True)
+    file_df = pd.DataFrame(file_rows, columns=INDEX_FILE_COLUMNS)
+    if index_changed:
+        tmp_path = os.path.join(os.path.dirname(index_path), ".tmp-{}-{}".format(os.getpid(), os.path.basename(index_path)))
+        with open(tmp_path, "wb") as fp:
+            pickle.dump({"files": file_df, "points": point_df}, fp)
+        os.replace(tmp_path, index_path)
+
+    return file_df, point_df
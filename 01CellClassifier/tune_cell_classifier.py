@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+import os, sys
+import argparse, json, random, itertools, time
+import multiprocessing
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+from sklearn.model_selection import StratifiedKFold, train_test_split
+from sklearn.metrics import accuracy_score
+
+from cv_utils import load_cell_features, cell_fea_matrix
+
+
+def set_args():
+    parser = argparse.ArgumentParser(description = "Tune XGBoost Cell Classifier with Successive Halving")
+    parser.add_argument("--data_root",        type=str,       default="/Data")
+    parser.add_argument("--celltype_dir",     type=str,       default="CellClassifier")
+    parser.add_argument("--cellmodel_dir",    type=str,       default="CellModels")
+    parser.add_argument("--datasets",         type=str,       nargs="+", default=["USA", "Japan"])
+    parser.add_argument("--max_depths",       type=int,       nargs="+", default=[2, 3, 4, 6, 8])
+    parser.add_argument("--learning_rates",   type=float,     nargs="+", default=[0.03, 0.1, 0.3])
+    parser.add_argument("--tree_methods",     type=str,       nargs="+", default=["hist", "exact"])
+    parser.add_argument("--min_estimators",   type=int,       default=50, help="estimators of the first rung")
+    parser.add_argument("--max_estimators",   type=int,       default=800)
+    parser.add_argument("--halving_factor",   type=int,       default=3)
+    parser.add_argument("--early_stopping",   type=int,       default=20, help="rounds without validation improvement")
+    parser.add_argument("--cv_folds",         type=int,       default=3)
+    parser.add_argument("--val_ratio",        type=float,     default=0.2, help="share of each training fold for early stopping")
+    parser.add_argument("--workers",          type=int,       default=8)
+    parser.add_argument("--seed",             type=int,       default=1234)
+
+    args = parser.parse_args()
+    return args
+
+
+# early_stopping_rounds moved from fit() to the constructor in xgboost 1.6
+XGB_NEW_API = tuple(int(ele) for ele in xgb.__version__.split(".")[:2]) >= (1, 6)
+
+# cell features shared by the trials of a worker
+fea_X, fea_y, cv_folds = None, None, None
+
+def init_worker(X, y, folds):
+    global fea_X, fea_y, cv_folds
+    fea_X, fea_y, cv_folds = X, y, folds
+
+
+def run_trial(trial):
+    trial_params, n_estimators, early_stopping = trial
+    fold_accs, fold_iters, train_time, infer_time = [], [], 0.0, 0.0
+    for train_inds, val_inds, test_inds in cv_folds:
+        # early stopping watches the validation slice, the test fold is only scored
+        model_params = dict(trial_params, n_estimators=n_estimators, n_jobs=1)
+        fit_params = {"eval_set": [(fea_X[val_inds], fea_y[val_inds])], "verbose": False}
+        if XGB_NEW_API:
+            model_params["early_stopping_rounds"] = early_stopping
+        else:
+            fit_params["early_stopping_rounds"] = early_stopping
+        clf = xgb.XGBClassifier(**model_params)
+        start = time.time()
+        clf.fit(fea_X[train_inds], fea_y[train_inds], **fit_params)
+        train_time += time.time() - start
+        start = time.time()
+        fold_pred = clf.predict(fea_X[test_inds])
+        infer_time += time.time() - start
+        fold_accs.append(accuracy_score(fea_y[test_inds], fold_pred))
+        fold_iters.append(clf.best_iteration + 1)
+
+    trial_result = dict(trial_params)
+    trial_result.update({
+        "n_estimators": n_estimators,
+        "best_estimators": int(np.median(fold_iters)),
+        "accuracy": np.mean(fold_accs),
+        "accuracy_std": np.std(fold_accs),
+        "train_time": train_time / len(cv_folds),
+        "infer_us_per_cell": infer_time * 1.0e6 / len(fea_y),
+    })
+    return trial_result
+
+
+if __name__ == "__main__":
+    args = set_args()
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+
+    celltype_root = os.path.join(args.data_root, args.celltype_dir)
+    cellmodel_dir = os.path.join(celltype_root, args.cellmodel_dir)
+    if not os.path.exists(cellmodel_dir):
+        os.makedirs(cellmodel_dir)
+    cell_fea_df = pd.concat([load_cell_features(os.path.join(celltype_root, dataset, "CellFeas", "cell_feas.csv"), source=dataset)
+                             for dataset in args.datasets])
+    X, y = cell_fea_matrix(cell_fea_df)
+    if not 0.0 < args.val_ratio < 1.0:
+        sys.exit("--val_ratio should be between 0 and 1.")
+    folds = []
+    for train_inds, test_inds in StratifiedKFold(n_splits=args.cv_folds, shuffle=True, random_state=args.seed).split(X, y):
+        fit_inds, val_inds = train_test_split(train_inds, test_size=args.val_ratio, stratify=y[train_inds], random_state=args.seed)
+        folds.append((fit_inds, val_inds, test_inds))
+    print("Tune on {} cells from {}".format(len(y), ", ".join(args.datasets)))
+
+    candidates = [{"max_depth": max_depth, "learning_rate": learning_rate, "tree_method": tree_method}
+                  for max_depth, learning_rate, tree_method in itertools.product(args.max_depths, args.learning_rates, args.tree_methods)]
+    n_estimators = args.min_estimators
+    trial_results = []
+    with multiprocessing.Pool(args.workers, initializer=init_worker, initargs=(X, y, folds)) as pool:
+        for rung in itertools.count():
+            # successive halving, survivors get a larger estimator budget
+            rung_results = pool.map(run_trial, [(ele, n_estimators, args.early_stopping) for ele in candidates])
+            for ele in rung_results:
+                ele["rung"] = rung
+            trial_results.extend(rung_results)
+            rung_df = pd.DataFrame(rung_results).sort_values(["accuracy", "infer_us_per_cell"], ascending=[False, True])
+            print("Rung {}: {} candidates with {} estimators, best accuracy {:.4f}".format(
+                rung, len(candidates), n_estimators, rung_df["accuracy"].iloc[0]))
+            if len(candidates) <= 1 or n_estimators >= args.max_estimators:
+                break
+            keep_num = max(1, len(candidates) // args.halving_factor)
+            candidates = [{key: ele[key] for key in ["max_depth", "learning_rate", "tree_method"]}
+                          for ele in rung_df.head(keep_num).to_dict("records")]
+            n_estimators = min(n_estimators * args.halving_factor, args.max_estimators)
+
+    # accuracy against training & inference time of all trials
+    tuning_df = pd.DataFrame(trial_results).sort_values(["rung", "accuracy"], ascending=[False, False])
+    tuning_path = os.path.join(cellmodel_dir, "cell_classifier_tuning.csv")
+    tuning_df.to_csv(tuning_path, index=False)
+    print(tuning_df.head(10).to_string(index=False))
+
+    # best model of the last rung, trained with the early-stopped number of estimators
+    best_trial = tuning_df.iloc[0]
+    best_params = {
+        "max_depth": int(best_trial["max_depth"]),
+        "learning_rate": float(best_trial["learning_rate"]),
+        "tree_method": best_trial["tree_method"],
+        "n_estimators": int(best_trial["best_estimators"]),
+    }
+    best_param_path = os.path.join(cellmodel_dir, "cell_classifier_params.json")
+    with open(best_param_path, "w") as fp:
+        json.dump(best_params, fp, indent=2)
+    print("Best parameters {} saved to {}".format(best_params, best_param_path))
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+import os, sys
+import multiprocessing
+import xml.etree.ElementTree as ET
+import numpy as np
+
+
+def iter_imagescope_regions(xml_path):
+    # stream (annotation name, vertices) pairs, elements are freed once parsed
+    # every annotation first comes once with None, so that annotations without regions are kept
+    anno_name, coords = None, []
+    for event, elem in ET.iterparse(xml_path, events=("start", "end")):
+        if event == "start":
+            if elem.tag == "Annotation":
+                anno_name = elem.attrib["Name"]
+                yield anno_name, None
+            elif elem.tag == "Region":
+                coords = []
+        elif elem.tag == "Vertex":
+            coords.append(elem.attrib["X"])
+            coords.append(elem.attrib["Y"])
+        elif elem.tag == "Region":
+            vertices = np.asarray(coords, dtype=np.float64).reshape(-1, 2) + 0.5
+            yield anno_name, vertices
+            elem.clear()
+        elif elem.tag == "Annotation":
+            elem.clear()
+
+
+def parse_imagescope_polygons(xml_path):
+    # every region of each annotation as a (K, 2) vertex array, any number of vertices
+    anno_dict = {}
+    for anno_name, vertices in iter_imagescope_regions(xml_path):
+        polygons = anno_dict.setdefault(anno_name, [])
+        if vertices is not None:
+            polygons.append(vertices)
+
+    return anno_dict
+
+
+def rect_boxes(polygons):
+    # keep 4-vertex regions as [w_start, h_start, w_len, h_len] rectangles
+    roi_boxes = []
+    for vertices in polygons:
+        vertices = vertices.astype(np.int32)
+        if vertices.shape[0] != 4:
+            continue
+        w_start, h_start = vertices.min(axis=0)
+        w_len, h_len = vertices.max(axis=0) - vertices.min(axis=0)
+        if w_len <= 0 or h_len <= 0:
+            continue
+        roi_boxes.append([w_start, h_start, w_len, h_len])
+
+    return np.asarray(roi_boxes, dtype=np.int32).reshape(-1, 4)
+
+
+def parse_imagescope_boxes(xml_path):
+    # rectangles of each annotation as an (N, 4) array of [w_start, h_start, w_len, h_len]
+    return {anno_name: rect_boxes(polygons) for anno_name, polygons in parse_imagescope_polygons(xml_path).items()}
+
+
+def parse_imagescope_rects(xml_path):
+    anno_dict = {}
+    for anno_name, roi_boxes in parse_imagescope_boxes(xml_path).items():
+        anno_dict[anno_name] = [[(w_start, h_start), (w_len, h_len)] for w_start, h_start, w_len, h_len in roi_boxes]
+
+    return anno_dict
+
+
+def parse_imagescope_dir(xml_dir, xml_names=None, workers=1):
+    # parse a directory of ImageScope xmls, keyed by slide name
+    if xml_names is None:
+        xml_names = sorted([ele for ele in os.listdir(xml_dir) if ele.endswith(".xml")])
+    xml_paths = [os.path.join(xml_dir, ele) for ele in xml_names]
+    if workers > 1 and len(xml_paths) > 1:
+        with multiprocessing.Pool(workers) as pool:
+            anno_dicts = pool.map(parse_imagescope_polygons, xml_paths)
+    else:
+        anno_dicts = [parse_imagescope_polygons(ele) for ele in xml_paths]
+
+    return {os.path.splitext(name)[0]: anno_dict for name, anno_dict in zip(xml_names, anno_dicts)}
+
+
+# bumped whenever the arrays stored in the index change, older indexes are rebuilt
+ANNO_INDEX_VERSION = 3
+ANNO_INDEX_KEYS = ["version", "slides", "mtimes", "anno_slides", "anno_names", "poly_slides", "poly_annos", "poly_offsets", "vertices"]
+
+
+def save_annotation_index(index_path, slide_annos, slide_mtimes):
+    # polygons of all slides flattened into one vertex array with offsets
+    # annotation names are stored on their own, annotations without regions load as empty lists
+    slides, mtimes, anno_slides, anno_names = [], [], [], []
+    poly_slides, poly_annos, poly_offsets, vertices = [], [], [0], []
+    for slide_ind, slide_name in enumerate(sorted(slide_annos.keys())):
+        slides.append(slide_name)
+        mtimes.append(slide_mtimes[slide_name])
+        for anno_name, polygons in slide_annos[slide_name].items():
+            anno_slides.append(slide_ind)
+            anno_names.append(anno_name)
+            for poly in polygons:
+                poly_slides.append(slide_ind)
+                poly_annos.append(anno_name)
+                vertices.append(poly)
+                poly_offsets.append(poly_offsets[-1] + len(poly))
+    vertices = np.concatenate(vertices, axis=0) if len(vertices) > 0 else np.zeros((0, 2))
+    np.savez(index_path, version=np.int64(ANNO_INDEX_VERSION),
+             slides=np.asarray(slides, dtype=str), mtimes=np.asarray(mtimes, dtype=np.float64),
+             anno_slides=np.asarray(anno_slides, dtype=np.int64), anno_names=np.asarray(anno_names, dtype=str),
+             poly_slides=np.asarray(poly_slides, dtype=np.int64), poly_annos=np.asarray(poly_annos, dtype=str),
+             poly_offsets=np.asarray(poly_offsets, dtype=np.int64), vertices=vertices.astype(np.float64))
+
+
+def load_annotation_index(index_path):
+    # an index of another format loads empty, every xml is then parsed again
+    slide_annos, slide_mtimes = {}, {}
+    index = np.load(index_path)
+    if any(key not in index.files for key in ANNO_INDEX_KEYS) or int(index["version"]) != ANNO_INDEX_VERSION:
+        print("Rebuild annotation index of an older format: {}".format(index_path))
+        return slide_annos, slide_mtimes
+    slides, poly_offsets, vertices = index["slides"].tolist(), index["poly_offsets"], index["vertices"]
+    for slide_name, mtime in zip(slides, index["mtimes"].tolist()):
+        slide_annos[slide_name] = {}
+        slide_mtimes[slide_name] = mtime
+    for slide_ind, anno_name in zip(index["anno_slides"].tolist(), index["anno_names"].tolist()):
+        slide_annos[slides[slide_ind]][anno_name] = []
+    for ind, (slide_ind, anno_name) in enumerate(zip(index["poly_slides"].tolist(), index["poly_annos"].tolist())):
+        poly = vertices[poly_offsets[ind]:poly_offsets[ind+1]]
+        slide_annos[slides[slide_ind]].setdefault(anno_name, []).append(poly)
+
+    return slide_annos, slide_mtimes
+
+
+def index_imagescope_dir(xml_dir, index_path, workers=1):
+    # load annotation polygons from the index, only new or modified xmls are parsed again
+    slide_annos, slide_mtimes = {}, {}
+    if os.path.exists(index_path):
+        slide_annos, slide_mtimes = load_annotation_index(index_path)
+    xml_names = sorted([ele for ele in os.listdir(xml_dir) if ele.endswith(".xml")])
+    cur_mtimes = {os.path.splitext(ele)[0]: os.path.getmtime(os.path.join(xml_dir, ele)) for ele in xml_names}
+    update_names = [ele for ele in xml_names if slide_mtimes.get(os.path.splitext(ele)[0]) != cur_mtimes[os.path.splitext(ele)[0]]]
+    removed = [ele for ele in slide_annos.keys() if ele not in cur_mtimes]
+    if len(update_names) > 0 or len(removed) > 0:
+        slide_annos.update(parse_imagescope_dir(xml_dir, update_names, workers=workers))
+        slide_annos = {key: val for key, val in slide_annos.items() if key in cur_mtimes}
+        save_annotation_index(index_path, slide_annos, cur_mtimes)
+
+    return slide_annos
+
+
+def points_in_polygon(points, poly, chunk_size=4000000):
+    # even-odd crossing test of (N, 2) points against all polygon edges at once
+    xi, yi = poly[:, 0][None, :], poly[:, 1][None, :]
+    xj, yj = np.roll(poly[:, 0], 1)[None, :], np.roll(poly[:, 1], 1)[None, :]
+    dy = np.where(yj == yi, 1.0, yj - yi)
+    inside = np.zeros(len(points), dtype=bool)
+    step = max(1, chunk_size // len(poly))
+    for start in range(0, len(points), step):
+        px, py = points[start:start+step, 0][:, None], points[start:start+step, 1][:, None]
+        crossing = ((yi > py) != (yj > py)) & (px < (xj - xi) * (py - yi) / dy + xi)
+        inside[start:start+step] = np.count_nonzero(crossing, axis=1) % 2 == 1
+
+    return inside
+
+
+def assign_points_to_polygons(points, polygons):
+    # index of the first polygon containing each point, -1 if none
+    # points are sorted by x once, each polygon only tests the points inside its bounding box
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    labels = np.full(len(points), -1, dtype=np.int64)
+    order = np.argsort(points[:, 0], kind="stable")
+    sort_xs = points[order, 0]
+    for poly_ind, poly in enumerate(polygons):
+        if len(poly) < 3:
+            continue
+        (x_min, y_min), (x_max, y_max) = poly.min(axis=0), poly.max(axis=0)
+        start, end = np.searchsorted(sort_xs, x_min, side="left"), np.searchsorted(sort_xs, x_max, side="right")
+        cand = order[start:end]
+        cand = cand[(points[cand, 1] >= y_min) & (points[cand, 1] <= y_max) & (labels[cand] < 0)]
+        if len(cand) == 0:
+            continue
+        labels[cand[points_in_polygon(points[cand], poly)]] = poly_ind
+
+    return labels
+
+
+def assign_cells_to_regions(cell_centroids, anno_dict, offset=(0, 0)):
+    # batched region assignment of ROI cell centroids (x, y), offset moves them to slide coordinates
+    region_names, polygons = [], []
+    for anno_name, anno_polys in anno_dict.items():
+        for poly_ind, poly in enumerate(anno_polys):
+            region_names.append((anno_name, poly_ind))
+            polygons.append(poly)
+    points = np.asarray(cell_centroids, dtype=np.float64).reshape(-1, 2) + np.asarray(offset, dtype=np.float64)
+    region_inds = assign_points_to_polygons(points, polygons)
+
+    return region_inds, region_names
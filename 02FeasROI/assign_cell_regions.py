@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+import os, sys
+import argparse, re, shutil
+import numpy as np
+import pandas as pd
+
+from seg_utils import find_roi_seg, load_roi_segs
+from annotate_utils import index_imagescope_dir, assign_cells_to_regions
+from catalog_utils import list_lesions
+from exec_utils import run_rois
+from qc_utils import filter_qc_rois
+
+
+def set_args():
+    parser = argparse.ArgumentParser(description = "Assign ROI cells to annotated lesion regions")
+    parser.add_argument("--data_root",        type=str,       default="/Data")
+    parser.add_argument("--slide_roi_dir",    type=str,       default="SlidesROIs")
+    parser.add_argument("--anno_dir",         type=str,       default="SlideAnnotations")
+    parser.add_argument("--roi_seg_dir",      type=str,       default="RegionSegs")
+    parser.add_argument("--cell_region_dir",  type=str,       default="CellRegions")
+    parser.add_argument("--dataset",          type=str,       default="Japan", choices=["Japan", "USA", "China"])
+    parser.add_argument("--catalog_name",     type=str,       default="Catalog.db")
+    parser.add_argument("--workers",          type=int,       default=8)
+
+    args = parser.parse_args()
+    return args
+
+
+def parse_roi_origin(roi_name):
+    # slide name, level 0 top-left corner and pyramid level of a <slide>-Wstart..Hstart..Wlen..Hlen..[Level..] ROI
+    match = re.search(r"-Wstart(\d{6})Hstart(\d{6})Wlen\d{6}Hlen\d{6}(?:Level(\d+))?", roi_name)
+    if match is None:
+        return None, None, 0
+    level = int(match.group(3)) if match.group(3) is not None else 0
+    return roi_name[:match.start()], (int(match.group(1)), int(match.group(2))), level
+
+
+def assign_roi(task):
+    cur_roi, roi_seg_dir, cell_region_dir, anno_dict, roi_origin, downsample = task
+    roi_segs = load_roi_segs(find_roi_seg(roi_seg_dir, cur_roi))
+    # HoVer-Net centroids when stored, mean contour points otherwise
+    cell_centroids = roi_segs.inst_centroids if roi_segs.inst_centroids is not None else roi_segs.centroids()
+    # all cells of the ROI against all regions of its slide in one batched call
+    region_inds, region_names = assign_cells_to_regions(cell_centroids * downsample, anno_dict, offset=roi_origin)
+    annos = np.asarray([ele[0] for ele in region_names] + ["", ], dtype=object)
+    regions = np.asarray([ele[1] for ele in region_names] + [-1, ], dtype=np.int64)
+    region_df = pd.DataFrame({"ID": roi_segs.ids, "Annotation": annos[region_inds], "Region": regions[region_inds]})
+    region_df.to_csv(os.path.join(cell_region_dir, cur_roi + ".csv"), index=False)
+    return cur_roi, int(np.count_nonzero(region_inds >= 0)), len(region_inds)
+
+
+if __name__ == "__main__":
+    args = set_args()
+
+    roi_data_root = os.path.join(args.data_root, args.slide_roi_dir, args.dataset)
+    anno_dir = os.path.join(roi_data_root, args.anno_dir)
+    if not os.path.exists(anno_dir):
+        sys.exit("Annotations of {} not exist".format(args.dataset))
+    roi_seg_dir = os.path.join(roi_data_root, args.roi_seg_dir)
+    cell_region_dir = os.path.join(roi_data_root, args.cell_region_dir)
+    if os.path.exists(cell_region_dir):
+        shutil.rmtree(cell_region_dir)
+    os.makedirs(cell_region_dir)
+
+    # same annotation index as 00PreprocessROI, only new or modified xmls are parsed
+    index_path = os.path.join(roi_data_root, "{}AnnotationIndex.npz".format(args.dataset))
+    slide_annos = index_imagescope_dir(anno_dir, index_path, workers=args.workers)
+    catalog_path = os.path.join(args.data_root, args.slide_roi_dir, args.catalog_name)
+    roi_list = sorted(set(list_lesions(catalog_path, args.dataset, roi_seg_dir, ".npz") + list_lesions(catalog_path, args.dataset, roi_seg_dir, ".json")))
+    roi_list = filter_qc_rois(roi_list, os.path.join(roi_data_root, "{}ROIQC.csv".format(args.dataset)))
+    # ROIs cropped from lower pyramid levels, written by extract_slide_rois.py
+    level_path = os.path.join(roi_data_root, "{}ROILevels.csv".format(args.dataset))
+    roi_downsamples = {}
+    if os.path.exists(level_path):
+        level_df = pd.read_csv(level_path)
+        roi_downsamples = dict(zip(level_df["ROI"].tolist(), level_df["Downsample"].tolist()))
+    task_list = []
+    for cur_roi in roi_list:
+        slide_name, roi_origin, level = parse_roi_origin(cur_roi)
+        if slide_name is None:
+            print("{} has no Wstart/Hstart in its name, skipped".format(cur_roi))
+            continue
+        if slide_name not in slide_annos:
+            print("{} has no annotations of slide {}, skipped".format(cur_roi, slide_name))
+            continue
+        if level > 0 and cur_roi not in roi_downsamples:
+            print("{} is cropped at level {} but has no downsampling in {}, skipped".format(cur_roi, level, level_path))
+            continue
+        task_list.append((cur_roi, roi_seg_dir, cell_region_dir, slide_annos[slide_name], roi_origin, roi_downsamples.get(cur_roi, 1.0)))
+
+    # one csv per ROI: cell ID, annotation name and region index within it, "" and -1 outside all regions
+    for ind, (cur_roi, inside_num, cell_num) in enumerate(run_rois(assign_roi, task_list, args.workers)):
+        print("Assign {}/{} {}: {}/{} cells in annotated regions".format(ind+1, len(task_list), cur_roi, inside_num, cell_num))
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+import os, sys
+import argparse, pickle, tempfile, time
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+
+from infer_utils import export_booster, load_booster, BoosterPredictor, NumpyTreePredictor
+
+
+def set_args():
+    parser = argparse.ArgumentParser(description = "Benchmark Cell Classifier Inference on Synthetic ROIs")
+    parser.add_argument("--cell_model",       type=str,       default=None, help="pickled XGBClassifier, trained on synthetic cells if not set")
+    parser.add_argument("--roi_num",          type=int,       default=200)
+    parser.add_argument("--min_roi_cells",    type=int,       default=200)
+    parser.add_argument("--max_roi_cells",    type=int,       default=5000)
+    parser.add_argument("--predict_batch",    type=int,       default=200000)
+    parser.add_argument("--rand_seed",        type=int,       default=1234)
+
+    args = parser.parse_args()
+    return args
+
+
+def synthesize_cells(cell_num, rng):
+    # Area / Intensity / Roundness of AEC, LYM and OC like clusters
+    cell_labels = rng.randint(0, 3, cell_num)
+    centers = np.array([[160.0, 120.0, 0.65], [70.0, 95.0, 0.80], [110.0, 140.0, 0.55]])
+    scales = np.array([50.0, 12.0, 0.12])
+    cell_feas = centers[cell_labels] + rng.normal(0, 1, (cell_num, 3)) * scales
+    return cell_feas, cell_labels
+
+
+if __name__ == "__main__":
+    args = set_args()
+    rng = np.random.RandomState(args.rand_seed)
+    if args.cell_model is None:
+        train_X, train_y = synthesize_cells(20000, rng)
+        cell_clf = xgb.XGBClassifier().fit(train_X, train_y)
+    else:
+        cell_clf = pickle.load(open(args.cell_model, "rb"))
+    roi_sizes = rng.randint(args.min_roi_cells, args.max_roi_cells, args.roi_num)
+    cell_X, _ = synthesize_cells(int(roi_sizes.sum()), rng)
+    roi_starts = np.concatenate([[0, ], np.cumsum(roi_sizes)])
+    print("Synthesized {} ROIs with {} cells".format(args.roi_num, len(cell_X)))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        booster_path = os.path.join(tmp_dir, "cell_classifier.json")
+        export_booster(cell_clf, booster_path)
+        predictors = {
+            "booster": BoosterPredictor(load_booster(booster_path)),
+            "numpy": NumpyTreePredictor(load_booster(booster_path)),
+        }
+
+    bench_rows = []
+    # baseline, one predict call per ROI
+    start = time.time()
+    ref_labels = np.concatenate([cell_clf.predict(cell_X[roi_starts[ind]:roi_starts[ind+1]]) for ind in range(args.roi_num)])
+    bench_rows.append(["per-ROI predict", time.time() - start, 1.0])
+    for name, predictor in predictors.items():
+        start = time.time()
+        labels = np.concatenate([predictor.predict(cell_X[ind:ind+args.predict_batch]) for ind in range(0, len(cell_X), args.predict_batch)])
+        bench_rows.append(["batched " + name, time.time() - start, np.mean(labels == ref_labels)])
+
+    bench_df = pd.DataFrame(bench_rows, columns=["Engine", "Seconds", "Agreement"])
+    bench_df["CellsPerSecond"] = len(cell_X) / bench_df["Seconds"]
+    print(bench_df.to_string(index=False))
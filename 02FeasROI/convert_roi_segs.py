@@ -3,8 +3,13 @@
 import enum
 import os, sys
 import argparse, json
+import multiprocessing
 import numpy as np
 
+from seg_utils import RoiSegsWriter, simplify_contour
+from hovernet_utils import TYPE_COLORS, remap_type, iter_hovernet_nuc
+from qc_utils import filter_qc_rois
+
 
 def set_args():
     parser = argparse.ArgumentParser(description = "Filter Segmented Cells")
@@ -13,11 +18,39 @@ def set_args():
     parser.add_argument("--raw_seg_dir",      type=str,       default="RawCellSegs")
     parser.add_argument("--update_seg_dir",   type=str,       default="RegionSegs")
     parser.add_argument("--dataset",          type=str,       default="Japan", choices=["Japan", "USA", "China"]) 
+    parser.add_argument("--seg_format",       type=str,       default="npz", choices=["npz", "json", "both"])
+    parser.add_argument("--coord_encoding",   type=str,       default="raw", choices=["raw", "chain"],
+                        help="npz contour points: raw int32 points can be memory-mapped, lossless chain codes give ~4x smaller files but are decoded into memory on every load")
+    parser.add_argument("--simplify_tol",     type=float,     default=0.0, help="Douglas-Peucker tolerance in pixels, 0 keeps every point")
+    parser.add_argument("--workers",          type=int,       default=8)
 
     args = parser.parse_args()
     return args
 
 
+def convert_roi(task):
+    raw_seg_path, roi_seg_dir, roi_name, seg_format, coord_encoding, simplify_tol = task
+    seg_exts = [".npz", ".json"] if seg_format == "both" else ["." + seg_format, ]
+    seg_writer = RoiSegsWriter(roi_seg_dir, roi_name, seg_exts, coord_encoding)
+    # raw instances are parsed one by one, ROI cell ids restart from 1
+    for roi_cid, (slide_cid, cell_seg) in enumerate(iter_hovernet_nuc(raw_seg_path), 1):
+        cell_type = remap_type(cell_seg["type"])
+        cell_bbox = None
+        if cell_seg.get("bbox", None) is not None:
+            # HoVer-Net bbox is [[rmin, cmin], [rmax, cmax]]
+            (rmin, cmin), (rmax, cmax) = cell_seg["bbox"]
+            cell_bbox = [cmin, rmin, cmax, rmax]
+        cell_cnt = simplify_contour(cell_seg["contour"], simplify_tol)
+        seg_writer.add(roi_cid, cell_type, TYPE_COLORS[cell_type], cell_cnt, cell_seg.get("centroid", None), cell_bbox)
+    seg_writer.close()
+    # stale files of the other format would shadow the new one
+    for seg_ext in [".npz", ".json"]:
+        roi_seg_path = os.path.join(roi_seg_dir, roi_name + seg_ext)
+        if seg_ext not in seg_exts and os.path.exists(roi_seg_path):
+            os.remove(roi_seg_path)
+    return roi_name, len(seg_writer)
+
+
 if __name__ == "__main__":
     args = set_args()
 
@@ -27,41 +60,10 @@ if __name__ == "__main__":
         os.makedirs(roi_seg_dir)
 
     roi_list = [os.path.splitext(ele)[0] for ele in os.listdir(raw_seg_dir) if ele.endswith("json")]
-    for ind, cur_roi in enumerate(roi_list):
-        print("Extract {}/{}".format(ind+1, len(roi_list)))
-        # raw segmentation
-        raw_seg_path = os.path.join(raw_seg_dir, cur_roi + ".json")
-        raw_seg_dict = {}
-        roi_seg_dict = {}
-        with open(raw_seg_path) as fp:
-            raw_seg_dict = json.load(fp)
-        raw_seg_dict = raw_seg_dict["nuc"]
-        roi_cid = 0
-        for slide_cid in raw_seg_dict.keys():
-            cell_seg = raw_seg_dict[slide_cid]
-            cell_cnts = np.asarray(cell_seg["contour"])
-            # rebuild the cell information
-            roi_cid += 1
-            cell_dict = {}
-            cell_type = None
-            cell_color = None
-            inst_type = cell_seg["type"]
-            if inst_type == 1:
-                cell_type = 0
-                cell_color = [255, 0, 0]
-            elif inst_type == 2 or inst_type == 4:
-                cell_type = 1
-                cell_color = [0, 255, 0]
-            else:
-                cell_type = 2
-                cell_color = [0, 0, 255]               
-            cell_dict["type"] = cell_type
-            cell_dict["color"] = cell_color
-            cell_dict["contour"] = cell_cnts.tolist()
-            roi_seg_dict[str(roi_cid)] = cell_dict
-        # save ROI segmenation
-        roi_seg_path = os.path.join(roi_seg_dir, cur_roi + ".json")
-        with open(roi_seg_path, 'w') as fp:
-            json.dump(roi_seg_dict, fp)        
-
-
+    # skip ROIs failing quality control
+    roi_list = filter_qc_rois(roi_list, os.path.join(args.data_root, args.lesion_dir, args.dataset, "{}ROIQC.csv".format(args.dataset)))
+    task_list = [(os.path.join(raw_seg_dir, cur_roi + ".json"), roi_seg_dir, cur_roi, args.seg_format, args.coord_encoding, args.simplify_tol)
+                 for cur_roi in roi_list]
+    with multiprocessing.Pool(args.workers) as pool:
+        for ind, (cur_roi, cell_num) in enumerate(pool.imap_unordered(convert_roi, task_list)):
+            print("Extract {}/{} {} with {} cells".format(ind+1, len(roi_list), cur_roi, cell_num))
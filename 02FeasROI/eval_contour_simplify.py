@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+import os, sys
+import argparse, time
+import numpy as np
+import pandas as pd
+from skimage import io
+
+from seg_utils import find_roi_seg, load_roi_segs, simplify_contour, encode_chain
+from fea_utils import cell_features, BASE_FEA_NAMES
+from infer_utils import load_cell_predictor
+from catalog_utils import list_lesions
+
+
+def set_args():
+    parser = argparse.ArgumentParser(description = "Report feature changes of simplified cell contours")
+    parser.add_argument("--data_root",        type=str,       default="/Data")
+    parser.add_argument("--slide_roi_dir",    type=str,       default="SlidesROIs")
+    parser.add_argument("--roi_img_dir",      type=str,       default="MacenkoROIs")
+    parser.add_argument("--roi_seg_dir",      type=str,       default="RegionSegs")
+    parser.add_argument("--dataset",          type=str,       default="Japan", choices=["Japan", "USA", "China"])
+    parser.add_argument("--catalog_name",     type=str,       default="Catalog.db")
+    parser.add_argument("--celltype_dir",     type=str,       default="CellType")
+    parser.add_argument("--cell_model",       type=str,       default="fusing_cell_classifier.json", help="label agreement is reported when it exists")
+    parser.add_argument("--tolerances",       type=float,     nargs="+", default=[0.5, 1.0, 1.5, 2.0, 3.0])
+    parser.add_argument("--roi_num",          type=int,       default=50, help="ROIs sampled for the report")
+    parser.add_argument("--rand_seed",        type=int,       default=1234)
+
+    args = parser.parse_args()
+    return args
+
+
+def seg_bytes(contours):
+    # raw int32 points and lossless chain coded size
+    offsets = np.concatenate([[0, ], np.cumsum([len(cnt) for cnt in contours])]).astype(np.int64)
+    coords = np.concatenate(contours).reshape(-1, 2)
+    return coords.nbytes, sum([ele.nbytes for ele in encode_chain(offsets, coords).values()])
+
+
+if __name__ == "__main__":
+    args = set_args()
+    rng = np.random.RandomState(args.rand_seed)
+
+    roi_img_dir = os.path.join(args.data_root, args.slide_roi_dir, args.dataset, args.roi_img_dir)
+    roi_seg_dir = os.path.join(args.data_root, args.slide_roi_dir, args.dataset, args.roi_seg_dir)
+    roi_list = list_lesions(os.path.join(args.data_root, args.slide_roi_dir, args.catalog_name), args.dataset, roi_img_dir, ".png")
+    if len(roi_list) > args.roi_num:
+        roi_list = sorted(rng.choice(roi_list, args.roi_num, replace=False).tolist())
+    celltype_model_path = os.path.join(args.data_root, args.celltype_dir, "CellModels", args.cell_model)
+    cell_predictor = None
+    if os.path.exists(celltype_model_path) or os.path.exists(os.path.splitext(celltype_model_path)[0] + ".model"):
+        cell_predictor = load_cell_predictor(celltype_model_path)
+
+    tolerances = [0.0, ] + sorted(args.tolerances)
+    fea_cols = BASE_FEA_NAMES
+    tol_dfs = {tol: [] for tol in tolerances}
+    tol_stats = {tol: np.zeros(4) for tol in tolerances}
+    for ind, cur_roi in enumerate(roi_list):
+        print("Simplify {}/{} {}".format(ind+1, len(roi_list), cur_roi))
+        roi_img = io.imread(os.path.join(roi_img_dir, cur_roi + ".png"))
+        roi_segs = load_roi_segs(find_roi_seg(roi_seg_dir, cur_roi))
+        if len(roi_segs) == 0:
+            continue
+        for tol in tolerances:
+            cell_cnts = [simplify_contour(cnt, tol).reshape(-1, 1, 2) for cnt in roi_segs.contours()]
+            start = time.time()
+            cell_fea_df = cell_features(roi_img, cell_cnts)
+            fea_seconds = time.time() - start
+            if cell_predictor is not None:
+                cell_fea_df["Label"] = cell_predictor.predict(cell_fea_df[fea_cols].to_numpy().astype(np.float64))
+            tol_dfs[tol].append(cell_fea_df)
+            tol_stats[tol] += [sum([len(cnt) for cnt in cell_cnts]), *seg_bytes(cell_cnts), fea_seconds]
+
+    # per-cell changes against the full contours
+    base_df = pd.concat(tol_dfs[0.0], ignore_index=True)
+    report_rows = []
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for tol in tolerances:
+            tol_df = pd.concat(tol_dfs[tol], ignore_index=True)
+            area_err = np.abs(tol_df["Area"] - base_df["Area"]) / base_df["Area"]
+            round_err = np.abs(tol_df["Roundness"] - base_df["Roundness"])
+            intensity_err = np.abs(tol_df["Intensity"] - base_df["Intensity"])
+            point_num, raw_bytes, chain_bytes, fea_seconds = tol_stats[tol]
+            report_row = [tol, point_num / len(base_df), raw_bytes, chain_bytes, fea_seconds,
+                          np.nanmean(area_err), np.nanpercentile(area_err, 95), np.nanmax(area_err),
+                          np.nanmean(round_err), np.nanpercentile(round_err, 95), np.nanmax(round_err),
+                          np.nanpercentile(intensity_err, 95)]
+            if cell_predictor is not None:
+                report_row.append(np.mean(tol_df["Label"] == base_df["Label"]))
+            report_rows.append(report_row)
+    report_cols = ["Tolerance", "PointsPerCell", "RawBytes", "ChainBytes", "FeatureSeconds",
+                   "AreaRelErrMean", "AreaRelErrP95", "AreaRelErrMax", "RoundnessErrMean", "RoundnessErrP95", "RoundnessErrMax",
+                   "IntensityErrP95"] + (["LabelAgreement", ] if cell_predictor is not None else [])
+    report_df = pd.DataFrame(report_rows, columns=report_cols)
+    print("{} cells in {} ROIs".format(len(base_df), len(roi_list)))
+    print(report_df.to_string(index=False, float_format=lambda val: "{:.4g}".format(val)))
+    report_path = os.path.join(args.data_root, args.slide_roi_dir, args.dataset, "{}ContourSimplify.csv".format(args.dataset))
+    report_df.to_csv(report_path, index=False)
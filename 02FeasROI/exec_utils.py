@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+import os, sys
+import multiprocessing
+
+
+# thread pool sizes read by BLAS / OpenMP libraries when they start
+THREAD_ENV_VARS = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "BLIS_NUM_THREADS",
+                   "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS"]
+
+
+def limit_threads(thread_num=1):
+    # N single-threaded workers on N cores, no oversubscription from the libraries below them
+    for var_name in THREAD_ENV_VARS:
+        os.environ[var_name] = str(thread_num)
+    try:
+        # pools of libraries already loaded in the parent ignore the variables
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(limits=thread_num)
+    except ImportError:
+        pass
+    import cv2
+    cv2.setNumThreads(thread_num)
+
+
+# per worker process
+roi_fn = None
+
+def init_worker(fn, init_fn=None, init_args=()):
+    global roi_fn
+    limit_threads(1)
+    roi_fn = fn
+    # models are loaded here after the fork, never shared with the parent
+    if init_fn is not None:
+        init_fn(*init_args)
+
+
+def run_task(task):
+    # sys.exit in a worker would kill it and leave the pool waiting, the parent exits instead
+    try:
+        return False, roi_fn(task)
+    except SystemExit as err:
+        return True, err.code
+
+
+def run_rois(fn, task_list, workers=1, init_fn=None, init_args=(), chunk_size=None):
+    # fn over the tasks in a pool of workers, results yielded in task order
+    if workers <= 1 or len(task_list) <= 1:
+        if init_fn is not None:
+            init_fn(*init_args)
+        for task in task_list:
+            yield fn(task)
+        return
+    workers = min(workers, len(task_list))
+    if chunk_size is None:
+        # a few chunks per worker, uneven ROIs still balance out
+        chunk_size = max(1, len(task_list) // (workers * 4))
+    with multiprocessing.Pool(workers, initializer=init_worker, initargs=(fn, init_fn, init_args)) as pool:
+        for is_exit, result in pool.imap(run_task, task_list, chunk_size):
+            if is_exit:
+                sys.exit(result)
+            yield result
@@ -9,7 +9,12 @@ import numpy as np
 from skimage import io, color
 import cv2
 
-from seg_utils import bounding_box
+from seg_utils import bounding_box, find_roi_seg, load_roi_segs
+from fea_utils import cell_features, BASE_FEA_NAMES, CELL_FEA_NAMES
+from infer_utils import load_cell_predictor
+from exec_utils import run_rois
+from qc_utils import filter_qc_rois
+from catalog_utils import list_lesions
 
 
 def set_args():
@@ -20,14 +25,71 @@ def set_args():
     parser.add_argument("--roi_seg_dir",      type=str,       default="RegionSegs")
     parser.add_argument("--cell_fea_dir",     type=str,       default="CellFeas")
     parser.add_argument("--dataset",          type=str,       default="Japan", choices=["Japan", "USA", "China"])  
+    parser.add_argument("--catalog_name",     type=str,       default="Catalog.db")
     parser.add_argument("--celltype_dir",     type=str,       default="CellType") 
     parser.add_argument("--min_cell_num",     type=int,       default=10)  
+    parser.add_argument("--cell_model",       type=str,       default="fusing_cell_classifier.json")
+    parser.add_argument("--tree_engine",      type=str,       default="xgboost", choices=["xgboost", "numpy"])
+    parser.add_argument("--roi_chunk",        type=int,       default=0, help="ROIs per task, 0 gives about four tasks per worker")
+    parser.add_argument("--extended_feas",    action="store_true", help="full CELL_FEA_NAMES table instead of Area / Intensity / Roundness")
+    parser.add_argument("--predict_cells",    type=int,       default=200000, help="cells classified per prediction call")
+    parser.add_argument("--workers",          type=int,       default=8)
     parser.add_argument("--rand_seed",        type=int,       default=1234)    
 
     args = parser.parse_args()
     return args
 
 
+def classify_rois(cell_predictor, roi_fea_dfs, cell_fea_dir):
+    # one prediction call over the cells of several ROIs
+    cell_feas = np.concatenate([ele[BASE_FEA_NAMES].to_numpy().astype(np.float64) for _, ele in roi_fea_dfs])
+    cell_labels = cell_predictor.predict(cell_feas)
+    start = 0
+    for cur_roi, cell_fea_df in roi_fea_dfs:
+        cell_fea_df["Label"] = cell_labels[start:start + len(cell_fea_df)].tolist()
+        start += len(cell_fea_df)
+        # save feature
+        cell_fea_path = os.path.join(cell_fea_dir, cur_roi + ".csv")
+        cell_fea_df.to_csv(cell_fea_path, index=False)
+
+
+# one classifier per worker
+cell_predictor = None
+
+def init_predictor(model_path, tree_engine, nthread):
+    global cell_predictor
+    cell_predictor = load_cell_predictor(model_path, tree_engine, nthread)
+
+
+def extract_rois(task):
+    roi_names, roi_img_dir, roi_seg_dir, cell_fea_dir, min_cell_num, predict_cells, fea_names = task
+    roi_fea_dfs, roi_cell_nums, pending_cells = [], [], 0
+    for cur_roi in roi_names:
+        # load image
+        roi_img_path = os.path.join(roi_img_dir, cur_roi + ".png")
+        roi_img = io.imread(roi_img_path)
+        # load segmentation
+        roi_segs = load_roi_segs(find_roi_seg(roi_seg_dir, cur_roi))
+
+        # extract features
+        cell_list = roi_segs.ids.tolist()
+        cell_cnts = roi_segs.contours()
+        cell_fea_df = cell_features(roi_img, cell_cnts, offsets=roi_segs.offsets, points=roi_segs.coords, fea_names=fea_names)
+        cell_fea_df.insert(0, "ID", cell_list)
+        roi_cell_nums.append((cur_roi, len(cell_fea_df)))
+        if len(cell_fea_df) < min_cell_num:
+            continue
+        roi_fea_dfs.append((cur_roi, cell_fea_df))
+        # cells of several ROIs are classified together, flushed once predict_cells are pending
+        pending_cells += len(cell_fea_df)
+        if pending_cells >= predict_cells:
+            classify_rois(cell_predictor, roi_fea_dfs, cell_fea_dir)
+            roi_fea_dfs, pending_cells = [], 0
+    if len(roi_fea_dfs) > 0:
+        classify_rois(cell_predictor, roi_fea_dfs, cell_fea_dir)
+    return roi_cell_nums
+
+
 if __name__ == "__main__":
     args = set_args()
     np.random.seed(args.rand_seed)    
@@ -39,63 +101,31 @@ if __name__ == "__main__":
         shutil.rmtree(cell_fea_dir)
     os.makedirs(cell_fea_dir)    
 
-    # load cell classification model
-    celltype_model_path = os.path.join(args.data_root, args.celltype_dir, "CellModels", "fusing_cell_classifier.model")
-    cell_clf = pickle.load(open(celltype_model_path, "rb"))
+    # classification model, loaded by each worker
+    celltype_model_path = os.path.join(args.data_root, args.celltype_dir, "CellModels", args.cell_model)
+    if not os.path.exists(celltype_model_path) and not os.path.exists(os.path.splitext(celltype_model_path)[0] + ".model"):
+        sys.exit("{} not exist.".format(celltype_model_path))
 
     print("="*80)
     print("****Start cell feature extraction for each ROI****")
     print("="*80)    
     # traverse all ROIs
-    roi_list = [os.path.splitext(ele)[0] for ele in os.listdir(roi_img_dir) if ele.endswith(".png")]
-    for ind, cur_roi in enumerate(roi_list):
-        if (ind + 1) % 100 == 0:
-            print("Extract {}/{}".format(ind+1, len(roi_list)))
-        # load image
-        roi_img_path = os.path.join(roi_img_dir, cur_roi + ".png")
-        roi_img = io.imread(roi_img_path)
-        # load segmentation
-        roi_seg_path = os.path.join(roi_seg_dir, cur_roi + ".json")
-        cur_roi_seg = {}
-        with open(roi_seg_path, 'r') as fp:
-            cur_roi_seg = json.load(fp)
-
-        # extract features
-        cell_list, area_list, intensity_list, roundness_list = [], [], [], []
-        for key in cur_roi_seg.keys():
-            cell_cnt = cur_roi_seg[key]["contour"]
-            cell_cnt = np.expand_dims(np.asarray(cell_cnt), axis=1)
-            # Area            
-            cell_area = cv2.contourArea(cell_cnt)
-            # Intensity 
-            x, y, w, h = cv2.boundingRect(cell_cnt)
-            nuc_mask = np.zeros((h, w), dtype=np.uint8)
-            cell_cnt[:,0,0] -= x
-            cell_cnt[:,0,1] -= y
-            cv2.drawContours(nuc_mask, contours=[cell_cnt, ], contourIdx=0, color=1, thickness=-1)
-            nuc_img = roi_img[y:y+h, x:x+w]
-            cell_intensity = np.mean(cv2.mean(nuc_img, mask=nuc_mask)[:3])
-            # Roundness
-            cnt_perimeter = cv2.arcLength(cell_cnt, True)
-            cell_roundness = 4 * 3.14 * cell_area / (cnt_perimeter * cnt_perimeter)
-            
-            # add cell information
-            cell_list.append(key)
-            area_list.append(cell_area)
-            intensity_list.append(cell_intensity)
-            roundness_list.append(cell_roundness)
-        
-        cell_fea_list = list(zip(cell_list, area_list, intensity_list, roundness_list))
-        fea_names = ["ID", "Area", "Intensity", "Roundness"]
-        cell_fea_df = pd.DataFrame(cell_fea_list, columns = fea_names)
-        # predict cell labels
-        cell_feas = cell_fea_df[["Area", "Intensity", "Roundness"]].to_numpy().astype(np.float64)
-        if len(cell_fea_df) < args.min_cell_num:
-            print("{} has too less cells detected".format(cur_roi))
-            continue
-        cell_labels = cell_clf.predict(cell_feas)
-        cell_fea_df["Label"] = cell_labels.tolist()
-
-        # save feature
-        cell_fea_path = os.path.join(cell_fea_dir, cur_roi + ".csv")
-        cell_fea_df.to_csv(cell_fea_path, index=False)        
\ No newline at end of file
+    roi_list = list_lesions(os.path.join(args.data_root, args.slide_roi_dir, args.catalog_name), args.dataset, roi_img_dir, ".png")
+    # skip ROIs failing quality control
+    roi_list = filter_qc_rois(roi_list, os.path.join(args.data_root, args.slide_roi_dir, args.dataset, "{}ROIQC.csv".format(args.dataset)))
+    # a few tasks per worker, uneven ROIs still balance out
+    roi_chunk = args.roi_chunk
+    if roi_chunk <= 0:
+        roi_chunk = max(1, int(math.ceil(len(roi_list) / (max(1, args.workers) * 4.0))))
+    task_list = [(roi_list[ind:ind + roi_chunk], roi_img_dir, roi_seg_dir, cell_fea_dir, args.min_cell_num, args.predict_cells,
+                  CELL_FEA_NAMES if args.extended_feas else BASE_FEA_NAMES)
+                 for ind in range(0, len(roi_list), roi_chunk)]
+    nthread = 1 if args.workers > 1 else None
+    roi_num = 0
+    for roi_cell_nums in run_rois(extract_rois, task_list, args.workers, init_predictor, (celltype_model_path, args.tree_engine, nthread), chunk_size=1):
+        for cur_roi, cell_num in roi_cell_nums:
+            roi_num += 1
+            if roi_num % 100 == 0:
+                print("Extract {}/{}".format(roi_num, len(roi_list)))
+            if cell_num < args.min_cell_num:
+                print("{} has too less cells detected".format(cur_roi))
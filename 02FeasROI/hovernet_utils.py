@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+import os, sys
+import json
+
+
+# HoVer-Net instance types to our AEC (0), LYM (1) and OC (2) classes
+TYPE_COLORS = {0: [255, 0, 0], 1: [0, 255, 0], 2: [0, 0, 255]}
+
+def remap_type(inst_type):
+    if inst_type == 1:
+        return 0
+    elif inst_type == 2 or inst_type == 4:
+        return 1
+    return 2
+
+
+class JsonStream:
+    # incremental json reader, values are decoded one at a time from a growing text buffer
+    def __init__(self, fp, chunk_size=1 << 20):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf, self.pos, self.eof = "", 0, False
+
+    def _fill(self):
+        chunk = self.fp.read(self.chunk_size)
+        self.eof = len(chunk) == 0
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return not self.eof
+
+    def peek(self):
+        # next non-whitespace character, empty at the end of file
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\n\r":
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, chars):
+        cur_char = self.peek()
+        if cur_char == "" or cur_char not in chars:
+            raise ValueError("Expecting one of {} but got {!r}".format(list(chars), cur_char))
+        self.pos += 1
+        return cur_char
+
+    def decode(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # a number cut at the buffer end (20. of 20.5) may continue in the next chunk
+                if self.eof or (end < len(self.buf) and self.buf[end] not in "0123456789.eE+-"):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+    def iter_members(self):
+        # keys of the object at the current position, the caller decodes or descends into each value
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.decode()
+            self.expect(":")
+            yield key
+            if self.expect(",}") == "}":
+                return
+
+
+def iter_hovernet_nuc(raw_seg_path, chunk_size=1 << 20):
+    # (instance id, instance dict) of the "nuc" entries, one instance in memory at a time
+    with open(raw_seg_path, "r") as fp:
+        stream = JsonStream(fp, chunk_size)
+        for key in stream.iter_members():
+            if key != "nuc" or stream.peek() != "{":
+                stream.decode()
+                continue
+            for inst_id in stream.iter_members():
+                yield inst_id, stream.decode()
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+import os, sys
+import json, pickle, tempfile
+import numpy as np
+import xgboost as xgb
+
+
+def export_booster(clf, model_path):
+    # native xgboost format, .json or .ubj (ubj needs xgboost >= 1.6)
+    clf.get_booster().save_model(model_path)
+
+
+def load_booster(model_path, nthread=None):
+    if not os.path.exists(model_path):
+        # fall back to the pickled XGBClassifier next to it
+        pickle_path = os.path.splitext(model_path)[0] + ".model"
+        if not os.path.exists(pickle_path):
+            sys.exit("{} not exist.".format(model_path))
+        print("{} not exist, load {}".format(model_path, pickle_path))
+        model_path = pickle_path
+    if model_path.endswith(".json") or model_path.endswith(".ubj"):
+        booster = xgb.Booster()
+        booster.load_model(model_path)
+    else:
+        with open(model_path, "rb") as fp:
+            booster = pickle.load(fp).get_booster()
+    if nthread is not None:
+        booster.set_param({"nthread": nthread})
+    return booster
+
+
+def booster_objective(booster):
+    return json.loads(booster.save_config())["learner"]["objective"]["name"]
+
+
+def probs_to_labels(probs, objective="multi:softprob"):
+    # multi:softmax boosters already predict class labels
+    if objective == "multi:softmax":
+        return np.rint(probs).astype(np.int64)
+    # binary objectives give the positive class probability only
+    if probs.ndim == 1:
+        return (probs > 0.5).astype(np.int64)
+    return np.argmax(probs, axis=1)
+
+
+class BoosterPredictor:
+    # batched class prediction with the native booster
+    def __init__(self, booster):
+        self.booster = booster
+        self.objective = booster_objective(booster)
+
+    def predict_proba(self, X):
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        if self.objective == "multi:softmax":
+            # softmax of the margins, the booster itself only outputs labels
+            margins = self.booster.inplace_predict(X, predict_type="margin")
+            probs = np.exp(margins - margins.max(axis=1, keepdims=True))
+            return probs / probs.sum(axis=1, keepdims=True)
+        return self.booster.inplace_predict(X)
+
+    def predict(self, X):
+        return probs_to_labels(self.booster.inplace_predict(np.ascontiguousarray(X, dtype=np.float32)), self.objective)
+
+
+class NumpyTreePredictor:
+    # pure numpy evaluation of a gbtree json dump, all trees advanced together level by level
+    def __init__(self, booster, batch_size=8192):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            booster.save_model(os.path.join(tmp_dir, "model.json"))
+            with open(os.path.join(tmp_dir, "model.json")) as fp:
+                model = json.load(fp)["learner"]
+        self.objective = model["objective"]["name"]
+        self.class_num = max(1, int(model["learner_model_param"]["num_class"]))
+        base_score = np.array(json.loads(model["learner_model_param"]["base_score"]), dtype=np.float64).ravel()
+        if self.objective.startswith("binary:logistic"):
+            base_score = np.log(base_score / (1.0 - base_score))
+        self.base_margin = np.broadcast_to(base_score, (self.class_num, )).copy()
+        self.batch_size = batch_size
+
+        trees = model["gradient_booster"]["model"]["trees"]
+        self.tree_classes = np.array(model["gradient_booster"]["model"]["tree_info"], dtype=np.int64)
+        # nodes of all trees concatenated, children re-indexed globally
+        node_offsets = np.cumsum([0, ] + [len(tree["left_children"]) for tree in trees])
+        self.tree_roots = node_offsets[:-1]
+        left_children = np.concatenate([np.array(tree["left_children"], dtype=np.int64) for tree in trees])
+        right_children = np.concatenate([np.array(tree["right_children"], dtype=np.int64) for tree in trees])
+        tree_of_node = np.repeat(np.arange(len(trees)), np.diff(node_offsets))
+        # leaves point to themselves so that every tree can advance max_depth steps
+        is_leaf = left_children == -1
+        node_inds = np.arange(len(left_children))
+        self.left_children = np.where(is_leaf, node_inds, left_children + node_offsets[tree_of_node]).astype(np.int32)
+        self.right_children = np.where(is_leaf, node_inds, right_children + node_offsets[tree_of_node]).astype(np.int32)
+        # children interleaved, the right child of node n sits at 2 * n + 1
+        self.children = np.stack([self.left_children, self.right_children], axis=1).ravel()
+        self.split_indices = np.concatenate([np.array(tree["split_indices"], dtype=np.int32) for tree in trees])
+        self.split_indices[is_leaf] = 0
+        # xgboost compares float32 features against float32 thresholds, leaves keep their value in split_conditions
+        self.split_conditions = np.concatenate([np.array(tree["split_conditions"], dtype=np.float32) for tree in trees])
+        self.leaf_values = np.where(is_leaf, self.split_conditions, 0).astype(np.float64)
+        self.default_left = np.concatenate([np.array(tree["default_left"], dtype=bool) for tree in trees])
+        self.max_depth = self._max_depth(is_leaf)
+
+    def _max_depth(self, is_leaf):
+        nodes, depth = self.tree_roots.copy(), 0
+        while not np.all(is_leaf[nodes]):
+            nodes = nodes[~is_leaf[nodes]]
+            nodes = np.concatenate([self.left_children[nodes], self.right_children[nodes]])
+            depth += 1
+        return depth
+
+    def predict_margin(self, X):
+        X = np.asarray(X, dtype=np.float32)
+        fea_num = X.shape[1]
+        margins = np.zeros((len(X), self.class_num), dtype=np.float64)
+        for start in range(0, len(X), self.batch_size):
+            batch_X = X[start:start + self.batch_size]
+            flat_X = batch_X.ravel()
+            row_offsets = (np.arange(len(batch_X), dtype=np.int32) * fea_num)[:, None]
+            has_missing = np.isnan(flat_X).any()
+            nodes = np.broadcast_to(self.tree_roots.astype(np.int32), (len(batch_X), len(self.tree_roots))).copy()
+            for _ in range(self.max_depth):
+                fea_vals = flat_X[row_offsets + self.split_indices[nodes]]
+                go_right = fea_vals >= self.split_conditions[nodes]
+                if has_missing:
+                    go_right = np.where(np.isnan(fea_vals), ~self.default_left[nodes], go_right)
+                nodes = self.children[2 * nodes + go_right]
+            leaf_vals = self.leaf_values[nodes]
+            for class_ind in range(self.class_num):
+                margins[start:start + len(batch_X), class_ind] = leaf_vals[:, self.tree_classes == class_ind].sum(axis=1)
+        return margins + self.base_margin
+
+    def predict_proba(self, X):
+        margins = self.predict_margin(X)
+        if self.class_num == 1:
+            return 1.0 / (1.0 + np.exp(-margins[:, 0]))
+        margins -= margins.max(axis=1, keepdims=True)
+        probs = np.exp(margins)
+        return probs / probs.sum(axis=1, keepdims=True)
+
+    def predict(self, X):
+        return probs_to_labels(self.predict_proba(X))
+
+
+def load_cell_predictor(model_path, engine="xgboost", nthread=None):
+    booster = load_booster(model_path, nthread)
+    if engine == "numpy":
+        return NumpyTreePredictor(booster)
+    return BoosterPredictor(booster)
@@ -9,7 +9,10 @@ import numpy as np
 from skimage import io, color
 import cv2
 
-from seg_utils import bounding_box
+from seg_utils import bounding_box, find_roi_seg, load_roi_segs
+from exec_utils import run_rois
+from qc_utils import filter_qc_rois
+from catalog_utils import list_lesions
 
 
 def set_args():
@@ -21,12 +24,37 @@ def set_args():
     parser.add_argument("--cell_fea_dir",     type=str,       default="CellFeas")
     parser.add_argument("--cell_overlay_dir", type=str,       default="OverlayCellType") 
     parser.add_argument("--dataset",          type=str,       default="Japan", choices=["Japan", "USA", "China"])
+    parser.add_argument("--catalog_name",     type=str,       default="Catalog.db")
+    parser.add_argument("--workers",          type=int,       default=8)
     parser.add_argument("--rand_seed",        type=int,       default=1234)    
 
     args = parser.parse_args()
     return args
 
 
+def overlay_roi(task):
+    cur_roi, roi_img_dir, roi_seg_dir, cell_fea_dir, cell_overlay_dir = task
+    # load image
+    roi_img_path = os.path.join(roi_img_dir, cur_roi + ".png")
+    roi_img = io.imread(roi_img_path)
+    # load segmentation
+    roi_segs = load_roi_segs(find_roi_seg(roi_seg_dir, cur_roi))
+    # load cell   
+    cell_fea_df = None
+    cell_fea_path = os.path.join(cell_fea_dir, cur_roi + ".csv")
+    cell_fea_df = pd.read_csv(cell_fea_path)
+    cell_id_lst, cell_label_lst = cell_fea_df["ID"].tolist(), cell_fea_df["Label"].tolist()
+    id_label_dict = {str(cid): label for cid, label in zip(cell_id_lst, cell_label_lst)}
+
+    type_color = {0: [255, 0, 0], 1: [0, 255, 0], 2: [0, 0, 255]}
+    for key, cell_cnt in zip(roi_segs.ids.tolist(), roi_segs.contours()):
+        cell_type = id_label_dict[key]
+        cv2.drawContours(roi_img, contours=[cell_cnt, ], contourIdx=0, color=type_color[cell_type], thickness=1)
+    overlay_img_path = os.path.join(cell_overlay_dir, cur_roi + ".png")
+    io.imsave(overlay_img_path, roi_img)
+    return cur_roi
+
+
 if __name__ == "__main__":
     args = set_args()
     np.random.seed(args.rand_seed)    
@@ -43,30 +71,10 @@ if __name__ == "__main__":
     print("****Start overlaying cells to each ROI****")
     print("="*80)    
     # traverse all ROIs
-    roi_list = [os.path.splitext(ele)[0] for ele in os.listdir(roi_img_dir) if ele.endswith(".png")]
-    for ind, cur_roi in enumerate(roi_list):
+    roi_list = list_lesions(os.path.join(args.data_root, args.slide_roi_dir, args.catalog_name), args.dataset, roi_img_dir, ".png")
+    # skip ROIs failing quality control
+    roi_list = filter_qc_rois(roi_list, os.path.join(args.data_root, args.slide_roi_dir, args.dataset, "{}ROIQC.csv".format(args.dataset)))
+    task_list = [(cur_roi, roi_img_dir, roi_seg_dir, cell_fea_dir, cell_overlay_dir) for cur_roi in roi_list]
+    for ind, cur_roi in enumerate(run_rois(overlay_roi, task_list, args.workers)):
         if (ind + 1) % 10 == 0:
             print("Extract {}/{}".format(ind+1, len(roi_list)))
-        # load image
-        roi_img_path = os.path.join(roi_img_dir, cur_roi + ".png")
-        roi_img = io.imread(roi_img_path)
-        # load segmentation
-        roi_seg_path = os.path.join(roi_seg_dir, cur_roi + ".json")
-        cur_roi_seg = {}
-        with open(roi_seg_path, 'r') as fp:
-            cur_roi_seg = json.load(fp)
-        # load cell   
-        cell_fea_df = None
-        cell_fea_path = os.path.join(cell_fea_dir, cur_roi + ".csv")
-        cell_fea_df = pd.read_csv(cell_fea_path)
-        cell_id_lst, cell_label_lst = cell_fea_df["ID"].tolist(), cell_fea_df["Label"].tolist()
-        id_label_dict = {str(cid): label for cid, label in zip(cell_id_lst, cell_label_lst)}
-
-        type_color = {0: [255, 0, 0], 1: [0, 255, 0], 2: [0, 0, 255]}
-        for key in cur_roi_seg.keys():
-            cell_cnt = cur_roi_seg[key]["contour"]
-            cell_cnt = np.expand_dims(np.asarray(cell_cnt), axis=1)
-            cell_type = id_label_dict[key]
-            cv2.drawContours(roi_img, contours=[cell_cnt, ], contourIdx=0, color=type_color[cell_type], thickness=1)
-        overlay_img_path = os.path.join(cell_overlay_dir, cur_roi + ".png")
-        io.imsave(overlay_img_path, roi_img)     
\ No newline at end of file
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+import os, sys
+import argparse, json, heapq
+import pandas as pd
+import numpy as np
+
+from infer_utils import load_cell_predictor
+from seg_utils import find_roi_seg, load_roi_segs
+from catalog_utils import list_lesions
+
+
+def set_args():
+    parser = argparse.ArgumentParser(description = "Sample uncertain cells for the next annotation round")
+    parser.add_argument("--data_root",        type=str,       default="/Data")
+    parser.add_argument("--slide_roi_dir",    type=str,       default="SlidesROIs")
+    parser.add_argument("--roi_seg_dir",      type=str,       default="RegionSegs")
+    parser.add_argument("--cell_fea_dir",     type=str,       default="CellFeas")
+    parser.add_argument("--dataset",          type=str,       default="Japan", choices=["Japan", "USA", "China"])
+    parser.add_argument("--catalog_name",     type=str,       default="Catalog.db")
+    parser.add_argument("--celltype_dir",     type=str,       default="CellType")
+    parser.add_argument("--cell_model",       type=str,       default="fusing_cell_classifier.json")
+    parser.add_argument("--tree_engine",      type=str,       default="xgboost", choices=["xgboost", "numpy"])
+    parser.add_argument("--predict_batch",    type=int,       default=200000, help="cells classified together across ROIs")
+    parser.add_argument("--uncertainty",      type=str,       default="margin", choices=["margin", "entropy", "least_confident"])
+    parser.add_argument("--top_k",            type=int,       default=100, help="cells to annotate per predicted class")
+    parser.add_argument("--max_roi_cells",    type=int,       default=2, help="cells to annotate per ROI and class")
+    parser.add_argument("--pool_factor",      type=int,       default=5, help="candidates kept per class, in multiples of top_k")
+    parser.add_argument("--rand_seed",        type=int,       default=1234)
+
+    args = parser.parse_args()
+    return args
+
+
+def full_probs(probs):
+    # binary objectives give the positive class probability only
+    if probs.ndim == 1:
+        return np.stack([1.0 - probs, probs], axis=1)
+    return probs
+
+
+def cell_uncertainty(probs, measure):
+    if measure == "entropy":
+        return -np.sum(probs * np.log(np.clip(probs, 1.0e-12, 1.0)), axis=1)
+    if measure == "least_confident":
+        return 1.0 - probs.max(axis=1)
+    top2 = np.partition(probs, probs.shape[1] - 2, axis=1)[:, -2:]
+    return 1.0 - (top2[:, 1] - top2[:, 0])
+
+
+class UncertainCellHeaps:
+    # the most uncertain cells of each predicted class, min-heaps of bounded size
+    def __init__(self, heap_size):
+        self.heap_size = heap_size
+        self.heaps = {}
+        self.cell_num = 0
+
+    def push_batch(self, probs, uncertainty, roi_names, cell_ids):
+        pred_labels = np.argmax(probs, axis=1)
+        for label in np.unique(pred_labels):
+            heap = self.heaps.setdefault(int(label), [])
+            cand_inds = np.flatnonzero(pred_labels == label)
+            # only the batch's own top cells can enter the heap
+            if len(cand_inds) > self.heap_size:
+                cand_inds = cand_inds[np.argpartition(-uncertainty[cand_inds], self.heap_size - 1)[:self.heap_size]]
+            if len(heap) == self.heap_size:
+                cand_inds = cand_inds[uncertainty[cand_inds] > heap[0][0]]
+            for ind in cand_inds:
+                # earlier cells win ties
+                item = (float(uncertainty[ind]), -(self.cell_num + int(ind)), roi_names[ind], cell_ids[ind], tuple(probs[ind].tolist()))
+                if len(heap) < self.heap_size:
+                    heapq.heappush(heap, item)
+                else:
+                    heapq.heappushpop(heap, item)
+        self.cell_num += len(probs)
+
+    def ranked(self, top_k, max_roi_cells):
+        # classes take turns, each picks its most uncertain cell from an ROI not yet full
+        queues = {label: sorted(heap, reverse=True) for label, heap in self.heaps.items()}
+        picked = {label: 0 for label in queues}
+        roi_counts, rank_rows = {}, []
+        while True:
+            added = False
+            for label in sorted(queues):
+                queue = queues[label]
+                while picked[label] < top_k and len(queue) > 0:
+                    uncert, _, roi_name, cell_id, probs = queue.pop(0)
+                    if roi_counts.get((roi_name, label), 0) >= max_roi_cells:
+                        continue
+                    roi_counts[(roi_name, label)] = roi_counts.get((roi_name, label), 0) + 1
+                    picked[label] += 1
+                    rank_rows.append([roi_name, cell_id, label, uncert] + list(probs))
+                    added = True
+                    break
+            if not added:
+                break
+        return rank_rows
+
+
+def cell_centers(roi_seg_path, cell_ids):
+    # HoVer-Net centroids when stored, contour centers otherwise
+    roi_segs = load_roi_segs(roi_seg_path)
+    centers = roi_segs.inst_centroids if roi_segs.inst_centroids is not None else roi_segs.centroids()
+    return centers[roi_segs.cell_inds(cell_ids)].round(1)
+
+
+if __name__ == "__main__":
+    args = set_args()
+    np.random.seed(args.rand_seed)
+
+    roi_seg_dir = os.path.join(args.data_root, args.slide_roi_dir, args.dataset, args.roi_seg_dir)
+    cell_fea_dir = os.path.join(args.data_root, args.slide_roi_dir, args.dataset, args.cell_fea_dir)
+    if not os.path.exists(cell_fea_dir):
+        sys.exit("{} not exist, extract ROI cell features first.".format(cell_fea_dir))
+    celltype_model_path = os.path.join(args.data_root, args.celltype_dir, "CellModels", args.cell_model)
+    cell_predictor = load_cell_predictor(celltype_model_path, args.tree_engine)
+
+    print("="*80)
+    print("****Start scoring cell uncertainty for each ROI****")
+    print("="*80)
+    roi_list = list_lesions(os.path.join(args.data_root, args.slide_roi_dir, args.catalog_name), args.dataset, cell_fea_dir, ".csv")
+    cell_heaps = UncertainCellHeaps(args.top_k * args.pool_factor)
+    # only one batch of features is held in memory at a time
+    batch_feas, batch_rois, batch_ids, batch_cell_num = [], [], [], 0
+    for ind, cur_roi in enumerate(roi_list):
+        if (ind + 1) % 100 == 0:
+            print("Score {}/{}".format(ind+1, len(roi_list)))
+        cell_fea_path = os.path.join(cell_fea_dir, cur_roi + ".csv")
+        cell_fea_df = pd.read_csv(cell_fea_path, usecols=["ID", "Area", "Intensity", "Roundness"], dtype={"ID": str})
+        batch_feas.append(cell_fea_df[["Area", "Intensity", "Roundness"]].to_numpy().astype(np.float64))
+        batch_rois.extend([cur_roi, ] * len(cell_fea_df))
+        batch_ids.extend(cell_fea_df["ID"].tolist())
+        batch_cell_num += len(cell_fea_df)
+        if batch_cell_num >= args.predict_batch or ind == len(roi_list) - 1:
+            probs = full_probs(cell_predictor.predict_proba(np.concatenate(batch_feas)))
+            cell_heaps.push_batch(probs, cell_uncertainty(probs, args.uncertainty), batch_rois, batch_ids)
+            batch_feas, batch_rois, batch_ids, batch_cell_num = [], [], [], 0
+    print("Scored {} cells in {} ROIs".format(cell_heaps.cell_num, len(roi_list)))
+
+    # ranked list with cell centers for the annotators
+    rank_rows = cell_heaps.ranked(args.top_k, args.max_roi_cells)
+    class_num = len(rank_rows[0]) - 4 if len(rank_rows) > 0 else 0
+    rank_df = pd.DataFrame(rank_rows, columns=["ROI", "ID", "Label", "Uncertainty"] + ["Prob{}".format(ele) for ele in range(class_num)])
+    rank_df.insert(0, "Rank", np.arange(1, len(rank_df) + 1))
+    rank_df["X"], rank_df["Y"] = np.nan, np.nan
+    for cur_roi, roi_df in rank_df.groupby("ROI"):
+        roi_seg_path = find_roi_seg(roi_seg_dir, cur_roi)
+        if os.path.exists(roi_seg_path):
+            rank_df.loc[roi_df.index, ["X", "Y"]] = cell_centers(roi_seg_path, roi_df["ID"].tolist())
+    sample_path = os.path.join(args.data_root, args.slide_roi_dir, args.dataset, "{}UncertainCells.csv".format(args.dataset))
+    rank_df.to_csv(sample_path, index=False)
+    print("{} cells from {} ROIs to annotate, saved in {}".format(len(rank_df), rank_df["ROI"].nunique(), sample_path))
@@ -9,11 +9,14 @@ import numpy as np
 from skimage import io, color
 import cv2
 
+from catalog_utils import load_lesions, parse_lesion_name
+
 
 def set_args():
     parser = argparse.ArgumentParser(description = "Extract lesion cellular ratio  features")
     parser.add_argument("--data_root",        type=str,       default="/Data")
     parser.add_argument("--slide_roi_dir",    type=str,       default="SlidesROIs")
+    parser.add_argument("--catalog_name",     type=str,       default="Catalog.db")
     parser.add_argument("--dataset",          type=str,       default="Japan", choices=["Japan", "USA", "China"]) 
     parser.add_argument("--rand_seed",        type=int,       default=1234)    
 
@@ -31,11 +34,21 @@ if __name__ == "__main__":
     lesion_fea_df = pd.read_csv(lesion_fea_path)
     lesion_names = lesion_fea_df["Lesions"].tolist()
     heights, widths = [], []
+    # ROI geometry from the cohort catalog when available
+    lesion_size_dict = {}
+    catalog_path = os.path.join(args.data_root, args.slide_roi_dir, args.catalog_name)
+    if os.path.exists(catalog_path):
+        lesion_df = load_lesions(catalog_path, args.dataset).dropna(subset=["width", "height"])
+        lesion_size_dict = {lesion: (int(width), int(height)) for lesion, width, height in zip(lesion_df["lesion"], lesion_df["width"], lesion_df["height"])}
     for cur_lesion in lesion_names:
-        w_loc = cur_lesion.find("Wlen")
-        widths.append(int(cur_lesion[w_loc+4:w_loc+10]))
-        h_loc = cur_lesion.find("Hlen")
-        heights.append(int(cur_lesion[h_loc+4:h_loc+10]))
+        # lesions a stale catalog misses fall back to the size in their names
+        if cur_lesion in lesion_size_dict:
+            roi_w, roi_h = lesion_size_dict[cur_lesion]
+        else:
+            geometry = parse_lesion_name(cur_lesion)[2]
+            roi_w, roi_h = geometry["Wlen"], geometry["Hlen"]
+        widths.append(roi_w)
+        heights.append(roi_h)
     max_height, min_height = max(heights), min(heights)
     print("Height max: {}, min: {}".format(max_height, min_height))
     max_width, min_width = max(widths), min(widths)
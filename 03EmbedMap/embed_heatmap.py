@@ -11,6 +11,8 @@ from skimage import io, color, filters
 import matplotlib.pyplot as plt
 import cv2
 
+from catalog_utils import list_lesions
+
 def set_args():
     parser = argparse.ArgumentParser(description = "Extract lesion cellular ratio  features")
     parser.add_argument("--data_root",        type=str,       default="/Data")
@@ -18,6 +20,7 @@ def set_args():
     parser.add_argument("--embed_dir",        type=str,       default="EmbedMaps")
     parser.add_argument("--heat_dir",         type=str,       default="HeatMaps")
     parser.add_argument("--dataset",          type=str,       default="Japan", choices=["Japan", "USA", "China"]) 
+    parser.add_argument("--catalog_name",     type=str,       default="Catalog.db")
     parser.add_argument("--rand_seed",        type=int,       default=1234)    
 
     args = parser.parse_args()
@@ -37,7 +40,7 @@ if __name__ == "__main__":
     os.makedirs(heatmap_dir)   
 
     # traverse all ROIs
-    roi_list = [os.path.splitext(ele)[0] for ele in os.listdir(roi_embed_dir) if ele.endswith(".png")]
+    roi_list = list_lesions(os.path.join(args.data_root, args.slide_roi_dir, args.catalog_name), args.dataset, roi_embed_dir, ".png")
 
     # organize ROI features
     for ind, ele in enumerate(roi_list):
@@ -10,6 +10,8 @@ import numpy as np
 from skimage import io, color, filters
 from skimage.feature import graycomatrix, graycoprops
 
+from catalog_utils import list_lesions
+
 
 def set_args():
     parser = argparse.ArgumentParser(description = "Extract lesion cellular ratio  features")
@@ -17,6 +19,7 @@ def set_args():
     parser.add_argument("--slide_roi_dir",    type=str,       default="SlidesROIs")
     parser.add_argument("--embed_dir",        type=str,       default="EmbedMaps")  
     parser.add_argument("--dataset",          type=str,       default="Japan", choices=["Japan", "USA", "China"]) 
+    parser.add_argument("--catalog_name",     type=str,       default="Catalog.db")
     parser.add_argument("--rand_seed",        type=int,       default=1234)    
 
     args = parser.parse_args()
@@ -36,7 +39,7 @@ if __name__ == "__main__":
             
     # Embed directory
     roi_embed_dir = os.path.join(args.data_root, args.slide_roi_dir, args.dataset, args.embed_dir)
-    roi_list = [os.path.splitext(ele)[0] for ele in os.listdir(roi_embed_dir) if ele.endswith(".png")]
+    roi_list = list_lesions(os.path.join(args.data_root, args.slide_roi_dir, args.catalog_name), args.dataset, roi_embed_dir, ".png")
 
     # roi & stage
     ROIs, Stages = [], []
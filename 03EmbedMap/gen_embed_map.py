@@ -10,6 +10,9 @@ import numpy as np
 from skimage import io, color, filters
 import cv2
 
+from seg_utils import find_roi_seg, load_roi_segs
+from catalog_utils import list_lesions, load_lesions, parse_lesion_name
+
 
 def set_args():
     parser = argparse.ArgumentParser(description = "Extract lesion cellular ratio  features")
@@ -20,6 +23,7 @@ def set_args():
     parser.add_argument("--embed_dir",        type=str,       default="EmbedMaps")
     parser.add_argument("--reduction_size",   type=int,       default=50)    
     parser.add_argument("--img_coef",         type=int,       default=320)    
+    parser.add_argument("--catalog_name",     type=str,       default="Catalog.db")
     parser.add_argument("--dataset",          type=str,       default="Japan", choices=["Japan", "USA", "China"]) 
     parser.add_argument("--rand_seed",        type=int,       default=1234)    
 
@@ -39,17 +43,24 @@ if __name__ == "__main__":
     os.makedirs(roi_embed_dir)         
     # traverse all ROIs
     cell_fea_dir = os.path.join(roi_data_root, args.cell_fea_dir)
-    roi_list = [os.path.splitext(ele)[0] for ele in os.listdir(cell_fea_dir) if ele.endswith(".csv")]
+    roi_list = list_lesions(os.path.join(args.data_root, args.slide_roi_dir, args.catalog_name), args.dataset, cell_fea_dir, ".csv")
     roi_seg_dir = os.path.join(args.data_root, args.slide_roi_dir, args.dataset, args.roi_seg_dir) 
+    # ROI geometry from the cohort catalog when available
+    lesion_size_dict = {}
+    catalog_path = os.path.join(args.data_root, args.slide_roi_dir, args.catalog_name)
+    if os.path.exists(catalog_path):
+        lesion_df = load_lesions(catalog_path, args.dataset).dropna(subset=["width", "height"])
+        lesion_size_dict = {lesion: (int(width), int(height)) for lesion, width, height in zip(lesion_df["lesion"], lesion_df["width"], lesion_df["height"])}
 
     # organize ROI features
     for ind, ele in enumerate(roi_list):
         print("Embed on {}/{}".format(ind+1, len(roi_list)))
         # initialize embed map size
-        w_loc = ele.find("Wlen")
-        roi_w = int(ele[w_loc+4:w_loc+10])
-        h_loc = ele.find("Hlen")
-        roi_h = int(ele[h_loc+4:h_loc+10])
+        if ele in lesion_size_dict:
+            roi_w, roi_h = lesion_size_dict[ele]
+        else:
+            geometry = parse_lesion_name(ele)[2]
+            roi_w, roi_h = geometry["Wlen"], geometry["Hlen"]
         embed_width = int(np.floor((0.5 + roi_w / args.reduction_size)) + 1)
         embed_height = int(np.floor((0.5 + roi_h / args.reduction_size)) + 1)
         embed_map = np.zeros((embed_height, embed_width, 3), dtype=np.float32)
@@ -60,18 +71,14 @@ if __name__ == "__main__":
         cell_ids = cell_fea_df["ID"]
         cell_labels = cell_fea_df["Label"]
        # load segmentation
-        roi_seg_path = os.path.join(roi_seg_dir, ele + ".json")
-        cur_roi_seg = {}
-        with open(roi_seg_path, "r") as fp:
-            cur_roi_seg = json.load(fp)
-        if len(cell_ids) != len(cur_roi_seg):
+        roi_segs = load_roi_segs(find_roi_seg(roi_seg_dir, ele))
+        if len(cell_ids) != len(roi_segs):
             print("{} - cell number not match in dataset {}.".format(ele, args.dataset))
             sys.exit()
 
         # fill the embed map
-        for cell_id, cell_label in zip(cell_ids, cell_labels):
-            cell_cnt = cur_roi_seg[str(cell_id)]["contour"]
-            cen_x, cen_y = np.mean(np.asarray(cell_cnt), axis=0)
+        cell_centers = roi_segs.centroids()[roi_segs.cell_inds(cell_ids)]
+        for (cen_x, cen_y), cell_label in zip(cell_centers, cell_labels):
             cen_x = int(math.floor(cen_x * 1.0 / args.reduction_size))
             cen_y = int(math.floor(cen_y * 1.0 / args.reduction_size))
             embed_map[cen_y, cen_x, cell_label] += 1.0 / (args.reduction_size * args.reduction_size)
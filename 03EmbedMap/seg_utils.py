@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+
+import os, sys
+import json, shutil, struct, zipfile
+import numpy as np
+import cv2
+
+def bounding_box(img):
+    rows = np.any(img, axis=1)
+    cols = np.any(img, axis=0)
+    rmin, rmax = np.where(rows)[0][[0, -1]]
+    cmin, cmax = np.where(cols)[0][[0, -1]]
+    # due to python indexing, need to add 1 to max
+    # else accessing will be 1px in the box, not out
+    rmax += 1
+    cmax += 1
+    return [rmin, rmax, cmin, cmax]
+
+
+SEG_FORMATS = [".npz", ".json"]
+# 8-neighbour steps of the chain code, code 8 escapes to a separately stored step
+CHAIN_STEPS = np.array([[1, 0], [1, 1], [0, 1], [-1, 1], [-1, 0], [-1, -1], [0, -1], [1, -1]], dtype=np.int64)
+CHAIN_ESCAPE = 8
+CHAIN_LUT = np.full(9, CHAIN_ESCAPE, dtype=np.uint8)
+CHAIN_LUT[(CHAIN_STEPS[:, 0] + 1) * 3 + CHAIN_STEPS[:, 1] + 1] = np.arange(8)
+
+
+def simplify_contour(contour, tolerance):
+    # Douglas-Peucker within tolerance pixels, small cells that would collapse retry with halved tolerances
+    contour = np.asarray(contour, dtype=np.int32).reshape(-1, 1, 2)
+    while tolerance >= 0.25 and len(contour) > 3:
+        approx_cnt = cv2.approxPolyDP(contour, tolerance, True)
+        if len(approx_cnt) >= 3:
+            return approx_cnt.reshape(-1, 2)
+        tolerance /= 2.0
+    return contour.reshape(-1, 2)
+
+
+def chain_codes(steps):
+    # 4-bit codes of contour steps, steps that are not 8-neighbour moves are escaped
+    steps = np.asarray(steps, dtype=np.int64).reshape(-1, 2)
+    is_move = np.all(np.abs(steps) <= 1, axis=1) & np.any(steps != 0, axis=1)
+    codes = np.full(len(steps), CHAIN_ESCAPE, dtype=np.uint8)
+    codes[is_move] = CHAIN_LUT[(steps[is_move, 0] + 1) * 3 + steps[is_move, 1] + 1]
+    return codes, steps[~is_move].astype(np.int32)
+
+
+def pack_codes(codes):
+    codes = np.append(codes, np.zeros(len(codes) % 2, dtype=np.uint8))
+    return (codes[0::2] | (codes[1::2] << 4)).astype(np.uint8)
+
+
+def unpack_codes(packed, code_num):
+    codes = np.empty(len(packed) * 2, dtype=np.uint8)
+    codes[0::2], codes[1::2] = packed & 15, packed >> 4
+    return codes[:code_num]
+
+
+def encode_chain(offsets, coords):
+    # lossless: first point of each cell, then one 4-bit code per step
+    point_nums = np.diff(offsets)
+    cell_starts = offsets[:-1][point_nums > 0]
+    starts = np.zeros((len(point_nums), 2), dtype=np.int32)
+    starts[point_nums > 0] = coords[cell_starts]
+    step_inds = np.setdiff1d(np.arange(len(coords)), cell_starts, assume_unique=True)
+    codes, escapes = chain_codes(coords[step_inds].astype(np.int64) - coords[step_inds - 1])
+    return {"chain_starts": starts, "chain_codes": pack_codes(codes), "chain_escapes": escapes}
+
+
+def decode_chain(offsets, starts, packed, escapes):
+    point_nums = np.diff(offsets)
+    has_points = point_nums > 0
+    is_start = np.zeros(int(offsets[-1]), dtype=bool)
+    is_start[offsets[:-1][has_points]] = True
+    codes = unpack_codes(packed, len(is_start) - int(np.sum(has_points)))
+    deltas = np.zeros((len(is_start), 2), dtype=np.int64)
+    step_deltas = np.zeros((len(codes), 2), dtype=np.int64)
+    step_deltas[codes != CHAIN_ESCAPE] = CHAIN_STEPS[codes[codes != CHAIN_ESCAPE]]
+    step_deltas[codes == CHAIN_ESCAPE] = escapes
+    deltas[~is_start] = step_deltas
+    # running sums restart from the start point of every cell
+    sums = np.cumsum(deltas, axis=0)
+    cell_base = np.repeat(starts[has_points] - sums[is_start], point_nums[has_points], axis=0)
+    return (sums + cell_base).astype(np.int32)
+
+
+def cell_seg_dict(cell_type, cell_color, contour, centroid=None, bbox=None):
+    # json entry of one cell, bbox kept in HoVer-Net's [[y1, x1], [y2, x2]] layout
+    cell_dict = {"type": int(cell_type), "color": [int(ele) for ele in cell_color], "contour": np.asarray(contour).tolist()}
+    if centroid is not None:
+        cell_dict["centroid"] = [float(ele) for ele in centroid]
+    if bbox is not None:
+        cell_dict["bbox"] = [[int(bbox[1]), int(bbox[0])], [int(bbox[3]), int(bbox[2])]]
+    return cell_dict
+
+
+class RoiSegs:
+    # cells of one ROI as ragged arrays, points of cell i are coords[offsets[i]:offsets[i+1]]
+    # inst_centroids (x, y) and inst_bboxes [x1, y1, x2, y2) are HoVer-Net's own, None for older stores
+    def __init__(self, ids, types, colors, offsets, coords, inst_centroids=None, inst_bboxes=None):
+        self.ids = ids
+        self.types = types
+        self.colors = colors
+        self.offsets = offsets
+        self.coords = coords
+        self.inst_centroids = inst_centroids
+        self.inst_bboxes = inst_bboxes
+        self._id_inds = None
+
+    @classmethod
+    def from_contours(cls, ids, types, colors, contours, inst_centroids=None, inst_bboxes=None):
+        contours = [np.asarray(cnt, dtype=np.int32).reshape(-1, 2) for cnt in contours]
+        offsets = np.zeros(len(contours) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(cnt) for cnt in contours])
+        coords = np.concatenate(contours) if len(contours) > 0 else np.zeros((0, 2), dtype=np.int32)
+        if inst_centroids is not None:
+            inst_centroids = np.asarray(inst_centroids, dtype=np.float64).reshape(-1, 2)
+        if inst_bboxes is not None:
+            inst_bboxes = np.asarray(inst_bboxes, dtype=np.int32).reshape(-1, 4)
+        return cls(np.array([str(ele) for ele in ids], dtype=str), np.asarray(types, dtype=np.int32),
+                   np.asarray(colors, dtype=np.uint8).reshape(-1, 3), offsets, coords, inst_centroids, inst_bboxes)
+
+    @classmethod
+    def from_dict(cls, roi_seg_dict):
+        cell_ids = list(roi_seg_dict.keys())
+        cell_dicts = [roi_seg_dict[key] for key in cell_ids]
+        inst_centroids, inst_bboxes = None, None
+        if all(["centroid" in ele for ele in cell_dicts]):
+            inst_centroids = [ele["centroid"] for ele in cell_dicts]
+        if all(["bbox" in ele for ele in cell_dicts]):
+            inst_bboxes = np.asarray([ele["bbox"] for ele in cell_dicts], dtype=np.int32).reshape(-1, 2, 2)[:, :, ::-1].reshape(-1, 4)
+        return cls.from_contours(cell_ids, [ele["type"] for ele in cell_dicts], [ele["color"] for ele in cell_dicts],
+                                 [ele["contour"] for ele in cell_dicts], inst_centroids, inst_bboxes)
+
+    def to_dict(self):
+        roi_seg_dict = {}
+        for ind, cell_id in enumerate(self.ids.tolist()):
+            roi_seg_dict[cell_id] = cell_seg_dict(self.types[ind], self.colors[ind], self.contour(ind),
+                                                  None if self.inst_centroids is None else self.inst_centroids[ind],
+                                                  None if self.inst_bboxes is None else self.inst_bboxes[ind])
+        return roi_seg_dict
+
+    def arrays(self):
+        seg_arrays = {"ids": self.ids, "types": self.types, "colors": self.colors, "offsets": self.offsets, "coords": self.coords}
+        if self.inst_centroids is not None:
+            seg_arrays["inst_centroids"] = self.inst_centroids
+        if self.inst_bboxes is not None:
+            seg_arrays["inst_bboxes"] = self.inst_bboxes
+        return seg_arrays
+
+    def __len__(self):
+        return len(self.types)
+
+    def contour(self, ind):
+        return self.coords[self.offsets[ind]:self.offsets[ind + 1]]
+
+    def contours(self):
+        # opencv (n, 1, 2) int32 contours, views into coords
+        cnt_coords = self.coords.reshape(-1, 1, 2)
+        return [cnt_coords[start:end] for start, end in zip(self.offsets[:-1].tolist(), self.offsets[1:].tolist())]
+
+    def centroids(self):
+        # mean contour point of every cell, (x, y), zeros for empty contours as in contour_bboxes
+        centers = np.zeros((len(self), 2), dtype=np.float64)
+        point_nums = np.diff(self.offsets)
+        filled = np.flatnonzero(point_nums > 0)
+        if len(filled) > 0:
+            point_sums = np.add.reduceat(self.coords.astype(np.int64), self.offsets[filled], axis=0)
+            centers[filled] = point_sums / point_nums[filled][:, None]
+        return centers
+
+    def cell_inds(self, cell_ids):
+        if self._id_inds is None:
+            self._id_inds = {cell_id: ind for ind, cell_id in enumerate(self.ids.tolist())}
+        return np.array([self._id_inds[str(ele)] for ele in cell_ids], dtype=np.int64)
+
+
+class RoiSegsWriter:
+    # cells added one by one, json entries and contour points go to disk as they come
+    def __init__(self, roi_seg_dir, roi_name, seg_exts=(".npz", ), coord_encoding="raw"):
+        self.seg_paths = {ext: os.path.join(roi_seg_dir, roi_name + ext) for ext in seg_exts}
+        self.coord_encoding = coord_encoding
+        self.tmp_prefix = os.path.join(roi_seg_dir, ".tmp-{}-{}".format(os.getpid(), roi_name))
+        self.json_fp, self.coord_fp = None, None
+        if ".json" in seg_exts:
+            self.json_fp = open(self.tmp_prefix + ".json", "w")
+            self.json_fp.write("{")
+        if ".npz" in seg_exts:
+            self.coord_fp = open(self.tmp_prefix + ".coords", "wb")
+        self.ids, self.types, self.colors, self.point_nums = [], [], [], []
+        self.inst_centroids, self.inst_bboxes = [], []
+        self.has_centroids, self.has_bboxes = True, True
+        # chain encoding spools the step codes instead of the points
+        self.chain_starts, self.chain_escapes = [], []
+
+    def add(self, cell_id, cell_type, cell_color, contour, centroid=None, bbox=None):
+        contour = np.asarray(contour, dtype=np.int32).reshape(-1, 2)
+        if self.json_fp is not None:
+            # same text as json.dump of the whole dict
+            self.json_fp.write("{}{}: {}".format(", " if len(self.ids) > 0 else "", json.dumps(str(cell_id)),
+                                                 json.dumps(cell_seg_dict(cell_type, cell_color, contour, centroid, bbox))))
+        if self.coord_fp is not None and self.coord_encoding == "chain":
+            codes, escapes = chain_codes(np.diff(contour, axis=0))
+            self.coord_fp.write(codes.tobytes())
+            self.chain_starts.append(contour[0] if len(contour) > 0 else [0, 0])
+            self.chain_escapes.append(escapes)
+        elif self.coord_fp is not None:
+            self.coord_fp.write(contour.astype("<i4").tobytes())
+        self.ids.append(str(cell_id))
+        self.types.append(int(cell_type))
+        self.colors.append(cell_color)
+        self.point_nums.append(len(contour))
+        self.has_centroids = self.has_centroids and centroid is not None
+        self.inst_centroids.append(centroid if centroid is not None else [0.0, 0.0])
+        self.has_bboxes = self.has_bboxes and bbox is not None
+        self.inst_bboxes.append(bbox if bbox is not None else [0, 0, 0, 0])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _write_npz(self, npz_path):
+        offsets = np.zeros(len(self.ids) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(self.point_nums)
+        seg_arrays = {"ids": np.array(self.ids, dtype=str), "types": np.array(self.types, dtype=np.int32),
+                      "colors": np.array(self.colors, dtype=np.uint8).reshape(-1, 3), "offsets": offsets}
+        if self.has_centroids:
+            seg_arrays["inst_centroids"] = np.array(self.inst_centroids, dtype=np.float64).reshape(-1, 2)
+        if self.has_bboxes:
+            seg_arrays["inst_bboxes"] = np.array(self.inst_bboxes, dtype=np.int32).reshape(-1, 4)
+        if self.coord_encoding == "chain":
+            seg_arrays["chain_starts"] = np.array(self.chain_starts, dtype=np.int32).reshape(-1, 2)
+            seg_arrays["chain_codes"] = pack_codes(np.fromfile(self.tmp_prefix + ".coords", dtype=np.uint8))
+            seg_arrays["chain_escapes"] = np.concatenate([np.zeros((0, 2), dtype=np.int32), ] + self.chain_escapes)
+        # uncompressed members like np.savez, spooled coords copied in behind their npy header
+        with zipfile.ZipFile(npz_path, "w", zipfile.ZIP_STORED, allowZip64=True) as zf:
+            for key, arr in seg_arrays.items():
+                with zf.open(key + ".npy", "w", force_zip64=True) as member:
+                    np.lib.format.write_array(member, arr, allow_pickle=False)
+            if self.coord_encoding == "raw":
+                with zf.open("coords.npy", "w", force_zip64=True) as member, open(self.tmp_prefix + ".coords", "rb") as coord_fp:
+                    coord_header = {"descr": np.lib.format.dtype_to_descr(np.dtype("<i4")), "fortran_order": False, "shape": (int(offsets[-1]), 2)}
+                    np.lib.format.write_array_header_1_0(member, coord_header)
+                    shutil.copyfileobj(coord_fp, member, 1 << 20)
+
+    def close(self):
+        if self.json_fp is not None:
+            self.json_fp.write("}")
+            self.json_fp.close()
+            os.replace(self.tmp_prefix + ".json", self.seg_paths[".json"])
+        if self.coord_fp is not None:
+            self.coord_fp.close()
+            self._write_npz(self.tmp_prefix + ".npz")
+            os.remove(self.tmp_prefix + ".coords")
+            os.replace(self.tmp_prefix + ".npz", self.seg_paths[".npz"])
+
+
+def _npz_memmaps(npz_path):
+    # arrays of an uncompressed npz mapped in place, None if any member is compressed
+    arrays = {}
+    with zipfile.ZipFile(npz_path) as zf, open(npz_path, "rb") as fp:
+        for info in zf.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                return None
+            fp.seek(info.header_offset)
+            name_len, extra_len = struct.unpack("<HH", fp.read(30)[26:30])
+            fp.seek(info.header_offset + 30 + name_len + extra_len)
+            version = np.lib.format.read_magic(fp)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(fp)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(fp)
+            key = os.path.splitext(info.filename)[0]
+            if int(np.prod(shape)) == 0:
+                arrays[key] = np.zeros(shape, dtype=dtype)
+            else:
+                # plain ndarray views of the mapping slice faster than memmap ones
+                arrays[key] = np.asarray(np.memmap(npz_path, dtype=dtype, mode="r", offset=fp.tell(), shape=shape,
+                                                   order="F" if fortran_order else "C"))
+    return arrays
+
+
+def find_roi_seg(roi_seg_dir, roi_name):
+    # binary store first, json otherwise
+    for seg_ext in SEG_FORMATS:
+        roi_seg_path = os.path.join(roi_seg_dir, roi_name + seg_ext)
+        if os.path.exists(roi_seg_path):
+            return roi_seg_path
+    return os.path.join(roi_seg_dir, roi_name + SEG_FORMATS[0])
+
+
+def load_roi_segs(roi_seg_path, mmap=False):
+    if not os.path.exists(roi_seg_path):
+        sys.exit("{} not exist.".format(roi_seg_path))
+    if roi_seg_path.endswith(".json"):
+        with open(roi_seg_path, "r") as fp:
+            return RoiSegs.from_dict(json.load(fp))
+    arrays = _npz_memmaps(roi_seg_path) if mmap else None
+    if arrays is None:
+        with np.load(roi_seg_path) as npz:
+            arrays = {key: npz[key] for key in npz.files}
+    if "coords" not in arrays:
+        if mmap:
+            print("{} stores chain coded contours, they are decoded into memory instead of mapped".format(roi_seg_path))
+        arrays["coords"] = decode_chain(arrays["offsets"], arrays["chain_starts"], arrays["chain_codes"], arrays["chain_escapes"])
+    return RoiSegs(arrays["ids"], arrays["types"], arrays["colors"], arrays["offsets"], arrays["coords"],
+                   arrays.get("inst_centroids", None), arrays.get("inst_bboxes", None))
+
+
+def save_roi_segs(roi_seg_path, roi_segs, coord_encoding="raw"):
+    tmp_path = os.path.join(os.path.dirname(roi_seg_path), ".tmp-{}-{}".format(os.getpid(), os.path.basename(roi_seg_path)))
+    if roi_seg_path.endswith(".json"):
+        with open(tmp_path, "w") as fp:
+            json.dump(roi_segs.to_dict(), fp)
+    else:
+        # uncompressed so that members can be memory-mapped, chain coded contours are decoded on load
+        seg_arrays = roi_segs.arrays()
+        if coord_encoding == "chain":
+            seg_arrays.update(encode_chain(roi_segs.offsets, seg_arrays.pop("coords")))
+        with open(tmp_path, "wb") as fp:
+            np.savez(fp, **seg_arrays)
+    os.replace(tmp_path, roi_seg_path)
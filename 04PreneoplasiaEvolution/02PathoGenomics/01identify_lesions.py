@@ -3,12 +3,15 @@
 import os, sys
 import argparse, json
 
+from catalog_utils import load_lesions, parse_lesion_name
+
 
 def set_args():
     parser = argparse.ArgumentParser(description = "Identify lesions for genomics correlations")
     parser.add_argument("--data_root",        type=str,       default="/Data")
     parser.add_argument("--pathgenom_dir",    type=str,       default="Pathogenomics")
     parser.add_argument("--slide_roi_dir",    type=str,       default="SlidesROIs")
+    parser.add_argument("--catalog_name",     type=str,       default="Catalog.db")
 
     args = parser.parse_args()
     return args
@@ -37,9 +40,16 @@ if __name__ == "__main__":
     print("There are {} lesions in Japan Cohort.".format(len(japan_lesion_dict)))
     ChinaJapan = {**china_lesion_dict, **japan_lesion_dict}
     print("There are {} lesions together.".format(len(ChinaJapan)))
+    # lesion to slide mapping from the cohort catalog when available
+    lesion_slide_dict = {}
+    catalog_path = os.path.join(args.data_root, args.slide_roi_dir, args.catalog_name)
+    if os.path.exists(catalog_path):
+        for cur_dataset in ["China", "Japan"]:
+            lesion_df = load_lesions(catalog_path, cur_dataset)
+            lesion_slide_dict.update(zip(lesion_df["lesion"], lesion_df["slide"]))
     genom_lesion_dict = {}
     for lesion_name, label in ChinaJapan.items():
-        slide_name = lesion_name[:lesion_name.rfind("-")]
+        slide_name = lesion_slide_dict.get(lesion_name, parse_lesion_name(lesion_name)[1])
         if slide_name in slide_lst and slide_histology_dict[slide_name] == label:
             genom_lesion_dict[lesion_name] = label
     print("There are {} lesions can be used for genomics analysis.".format(len(genom_lesion_dict)))
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+import os, sys
+import json, re, sqlite3
+import pandas as pd
+
+
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS lesions (
+    dataset TEXT, lesion TEXT, patient TEXT, slide TEXT, stage TEXT,
+    w_start INTEGER, h_start INTEGER, width INTEGER, height INTEGER,
+    PRIMARY KEY (dataset, lesion));
+CREATE TABLE IF NOT EXISTS artifacts (
+    dataset TEXT, lesion TEXT, kind TEXT, path TEXT, mtime REAL,
+    PRIMARY KEY (dataset, lesion, kind, path));
+CREATE INDEX IF NOT EXISTS artifact_kind ON artifacts (dataset, kind);
+"""
+
+
+def parse_lesion_name(lesion_name):
+    # <patient>-<slide id>-<roi>, geometry is encoded as Wstart/Hstart/Wlen/Hlen with 6 digits
+    dash_indices = [match.start() for match in re.finditer("-", lesion_name)]
+    patient = lesion_name[:dash_indices[-2]] if len(dash_indices) >= 2 else None
+    slide = lesion_name[:dash_indices[-1]] if len(dash_indices) >= 1 else None
+    geometry = {}
+    for key in ["Wstart", "Hstart", "Wlen", "Hlen"]:
+        match = re.search(key + r"(\d{6})", lesion_name)
+        geometry[key] = int(match.group(1)) if match else None
+
+    return patient, slide, geometry
+
+
+def scan_dataset(dataset_root, dataset):
+    # lesions & every derived file named after a lesion, one pass over the dataset directory
+    lesion_stage_dict = {}
+    lesion_stage_path = os.path.join(dataset_root, "{}LesionStages.json".format(dataset))
+    if os.path.exists(lesion_stage_path):
+        with open(lesion_stage_path) as fp:
+            lesion_stage_dict = json.load(fp)
+    artifact_rows = []
+    for kind in sorted(os.listdir(dataset_root)):
+        kind_dir = os.path.join(dataset_root, kind)
+        if not os.path.isdir(kind_dir):
+            continue
+        for entry in os.scandir(kind_dir):
+            if entry.name.startswith("."):
+                continue
+            lesion = entry.name.split(".")[0]
+            artifact_rows.append((dataset, lesion, kind, entry.path, entry.stat().st_mtime))
+    lesion_names = set(lesion_stage_dict.keys()) | set([ele[1] for ele in artifact_rows if ele[2] in ["RegionROIs", "MacenkoROIs"]])
+    png_paths = {ele[1]: ele[3] for ele in artifact_rows if ele[3].endswith(".png") and ele[2] in ["RegionROIs", "MacenkoROIs"]}
+
+    lesion_rows = []
+    for lesion in sorted(lesion_names):
+        patient, slide, geometry = parse_lesion_name(lesion)
+        width, height = geometry["Wlen"], geometry["Hlen"]
+        if (width is None or height is None) and lesion in png_paths:
+            # only building the catalog reads png headers, readers copied to other stages do without tile_utils
+            from tile_utils import read_png_size
+            width, height = read_png_size(png_paths[lesion])
+        lesion_rows.append((dataset, lesion, patient, slide, lesion_stage_dict.get(lesion, None),
+                            geometry["Wstart"], geometry["Hstart"], width, height))
+    artifact_rows = [ele for ele in artifact_rows if ele[1] in lesion_names]
+
+    return lesion_rows, artifact_rows
+
+
+def build_catalog(catalog_path, data_root, datasets):
+    conn = sqlite3.connect(catalog_path)
+    conn.executescript(CATALOG_SCHEMA)
+    for dataset in datasets:
+        dataset_root = os.path.join(data_root, dataset)
+        if not os.path.exists(dataset_root):
+            print("{} not exist, skip".format(dataset_root))
+            continue
+        lesion_rows, artifact_rows = scan_dataset(dataset_root, dataset)
+        with conn:
+            conn.execute("DELETE FROM lesions WHERE dataset = ?", (dataset, ))
+            conn.execute("DELETE FROM artifacts WHERE dataset = ?", (dataset, ))
+            conn.executemany("INSERT INTO lesions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", lesion_rows)
+            conn.executemany("INSERT INTO artifacts VALUES (?, ?, ?, ?, ?)", artifact_rows)
+        print("{}: {} lesions, {} files".format(dataset, len(lesion_rows), len(artifact_rows)))
+    conn.close()
+
+
+def load_lesions(catalog_path, dataset=None):
+    with sqlite3.connect(catalog_path) as conn:
+        if dataset is None:
+            return pd.read_sql_query("SELECT * FROM lesions", conn)
+        return pd.read_sql_query("SELECT * FROM lesions WHERE dataset = ?", conn, params=(dataset, ))
+
+
+def load_artifacts(catalog_path, dataset, kind, ext=""):
+    # {lesion: path} of one kind of derived file, e.g. RegionSegs, optionally only files ending with ext
+    with sqlite3.connect(catalog_path) as conn:
+        rows = conn.execute("SELECT lesion, path FROM artifacts WHERE dataset = ? AND kind = ? AND path GLOB ? ORDER BY lesion",
+                            (dataset, kind, "*" + ext)).fetchall()
+    return {lesion: path for lesion, path in rows}
+
+
+def list_lesions(catalog_path, dataset, kind_dir, ext):
+    # sorted lesions with a <lesion><ext> file in kind_dir, the work list of a stage
+    # read from the catalog unless files were added or removed after it was built, listdir otherwise
+    kind = os.path.basename(os.path.normpath(kind_dir))
+    if os.path.exists(catalog_path) and os.path.getmtime(catalog_path) >= os.path.getmtime(kind_dir):
+        lesion_paths = load_artifacts(catalog_path, dataset, kind, ext)
+        if len(lesion_paths) > 0:
+            return sorted(lesion_paths.keys())
+    return sorted([os.path.splitext(ele)[0] for ele in os.listdir(kind_dir) if ele.endswith(ext)])
@@ -5,6 +5,8 @@ import argparse, shutil, json, re
 import numpy as np
 import pandas as pd
 
+from catalog_utils import load_lesions
+
 
 def set_args():
     parser = argparse.ArgumentParser(description = "Combine Features")
@@ -12,6 +14,7 @@ def set_args():
     parser.add_argument("--slide_roi_dir",    type=str,       default="SlidesROIs")
     parser.add_argument("--demographic_dir",  type=str,       default="ClinicoDemographics")
     parser.add_argument("--combine_dir",      type=str,       default="CombineAnalysis")
+    parser.add_argument("--catalog_name",     type=str,       default="Catalog.db")
     parser.add_argument("--rand_seed",        type=int,       default=1234)    
 
     args = parser.parse_args()
@@ -31,6 +34,12 @@ if __name__ == "__main__":
     dset_race_dict = {dset: race for dset, race in zip(datasets, dset_races)}
     dataset_lst, race_lst, smoke_lst = [], [], []
     fea_dfs = []
+    # lesion to patient mapping from the cohort catalog when available
+    lesion_patient_dict = {}
+    catalog_path = os.path.join(args.data_root, args.slide_roi_dir, args.catalog_name)
+    if os.path.exists(catalog_path):
+        lesion_df = load_lesions(catalog_path)
+        lesion_patient_dict = {(dset, lesion): pat for dset, lesion, pat in zip(lesion_df["dataset"], lesion_df["lesion"], lesion_df["patient"])}
     for cur_dataset in datasets:
         roi_data_root = os.path.join(args.data_root, args.slide_roi_dir, cur_dataset)
         lesion_fea_path = os.path.join(roi_data_root, "{}LesionFeatures.csv".format(cur_dataset))
@@ -49,8 +58,11 @@ if __name__ == "__main__":
         pat_smoke_dict = {pat:smoke for pat, smoke in zip(dset_patient_id_lst, dset_smoke_stat_lst)}
         dset_lesion_lst = [ele for ele in cur_fea_df["Lesions"].tolist()]
         for cur_lesion in dset_lesion_lst:
-            dash_indices = [match.start() for match in re.finditer("-", cur_lesion)]
-            cur_pat = cur_lesion[:dash_indices[-2]]
+            if (cur_dataset, cur_lesion) in lesion_patient_dict:
+                cur_pat = lesion_patient_dict[(cur_dataset, cur_lesion)]
+            else:
+                dash_indices = [match.start() for match in re.finditer("-", cur_lesion)]
+                cur_pat = cur_lesion[:dash_indices[-2]]
             smoke_lst.append(pat_smoke_dict[cur_pat])
     combine_df = pd.concat(fea_dfs)
     combine_df["Dataset"] = dataset_lst